@@ -1,35 +1,43 @@
-from fastapi import APIRouter, HTTPException, Depends, Body
+from fastapi import APIRouter, HTTPException, Depends, Body, Response
 from typing import List, Dict
 from firebase_config import db
+from firestore_async import get_doc, update_doc
 from firebase_admin import auth
-from middleware import verify_admin
+from middleware import verify_admin, invalidate_user_cache
+from indice_emails import guardar_indice_email, eliminar_indice_email
+from paginacion import AdminPageParams, fetch_page
+from contadores import crear_con_contador, eliminar_con_contador, obtener_totales, USUARIOS, PRODUCTOS, ARTICULOS, COMPRAS
+from borrado_cascada import programar_borrado, consulta, coleccion, documentos, estado_borrado, reintentar_borrado, comentarios_huerfanos, MAX_RUTAS
 
 router = APIRouter()
 
 # Obtener todos los usuarios
 @router.get("/users")
-async def get_all_users(admin: Dict = Depends(verify_admin)):
+async def get_all_users(response: Response, page: AdminPageParams = Depends(), admin: Dict = Depends(verify_admin)):
     try:
-        users = db.collection("usuarios").stream()
-        return [{"id": user.id, **user.to_dict()} for user in users]
+        return await fetch_page(db.collection("usuarios"), page, response, ("nombre", "email", "role"))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Obtener todos los productos
 @router.get("/products")
-async def get_all_products(admin: Dict = Depends(verify_admin)):
+async def get_all_products(response: Response, page: AdminPageParams = Depends(), admin: Dict = Depends(verify_admin)):
     try:
-        products = db.collection("productos").stream()
-        return [{"id": product.id, **product.to_dict()} for product in products]
+        return await fetch_page(db.collection("productos"), page, response, ("nombre", "precio", "stock", "categoria", "fecha_creacion"))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Obtener todos los artículos
 @router.get("/articles")
-async def get_all_articles(admin: Dict = Depends(verify_admin)):
+async def get_all_articles(response: Response, page: AdminPageParams = Depends(), admin: Dict = Depends(verify_admin)):
     try:
-        articles = db.collection("articulos").stream()
-        return [{"id": article.id, **article.to_dict()} for article in articles]
+        return await fetch_page(db.collection("articulos"), page, response, ("titulo", "categoria", "fecha_publicacion", "likes"))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -37,33 +45,25 @@ async def get_all_articles(admin: Dict = Depends(verify_admin)):
 @router.get("/stats")
 async def get_stats(admin: Dict = Depends(verify_admin)):
     try:
-        # Contar usuarios
-        users_count = len(list(db.collection("usuarios").stream()))
-        
-        # Contar productos
-        products_count = len(list(db.collection("productos").stream()))
-        
-        # Contar artículos
-        articles_count = len(list(db.collection("articulos").stream()))
-        
-        # Contar compras
-        compras_count = len(list(db.collection("compras").stream()))
+        # Leer los contadores mantenidos en las altas y bajas
+        totales = await obtener_totales([USUARIOS, PRODUCTOS, ARTICULOS, COMPRAS])
         
         return {
-            "total_users": users_count,
-            "total_products": products_count,
-            "total_articles": articles_count,
-            "total_compras": compras_count
+            "total_users": totales[USUARIOS],
+            "total_products": totales[PRODUCTOS],
+            "total_articles": totales[ARTICULOS],
+            "total_compras": totales[COMPRAS]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Listar todas las compras
 @router.get("/compras")
-async def get_all_compras(admin: Dict = Depends(verify_admin)):
+async def get_all_compras(response: Response, page: AdminPageParams = Depends(), admin: Dict = Depends(verify_admin)):
     try:
-        compras = db.collection("compras").stream()
-        return [{"id": compra.id, **compra.to_dict()} for compra in compras]
+        return await fetch_page(db.collection("compras"), page, response, ("fecha", "total"))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -73,7 +73,7 @@ async def delete_user(user_id: str, admin: Dict = Depends(verify_admin)):
     try:
         # Verificar que el usuario existe en Firestore
         user_ref = db.collection("usuarios").document(user_id)
-        user_doc = user_ref.get()
+        user_doc = await get_doc(user_ref)
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado en Firestore")
         
@@ -93,23 +93,19 @@ async def delete_user(user_id: str, admin: Dict = Depends(verify_admin)):
             )
         
         # Eliminar datos del usuario de Firestore
-        user_ref.delete()
+        await eliminar_con_contador(user_ref, USUARIOS)
+        invalidate_user_cache(user_id)
+        await eliminar_indice_email(user_email)
         
-        # Eliminar artículos y productos asociados si hay email
+        # Eliminar artículos (con sus comentarios) y productos asociados en segundo plano
+        trabajo_id = None
         if user_email:
-            # Eliminar artículos del usuario
-            articles_ref = db.collection("articulos")
-            articles = articles_ref.where("email", "==", user_email).stream()
-            for article in articles:
-                article.reference.delete()
-                
-            # Eliminar productos del usuario
-            products_ref = db.collection("productos")
-            products = products_ref.where("email", "==", user_email).stream()
-            for product in products:
-                product.reference.delete()
+            trabajo_id = await programar_borrado(f"usuario {user_id}", [
+                consulta("articulos", "autor_email", user_email, ARTICULOS),
+                consulta("productos", "usuario_email", user_email, PRODUCTOS, recursivo=False)
+            ])
         
-        return {"message": "Usuario eliminado correctamente de Auth y Firestore"}
+        return {"message": "Usuario eliminado correctamente de Auth y Firestore", "borrado_id": trabajo_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -119,11 +115,11 @@ async def delete_product(product_id: str, admin: Dict = Depends(verify_admin)):
     try:
         # Verificar que el producto existe
         product_ref = db.collection("productos").document(product_id)
-        if not product_ref.get().exists:
+        if not (await get_doc(product_ref)).exists:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
             
         # Eliminar producto
-        product_ref.delete()
+        await eliminar_con_contador(product_ref, PRODUCTOS)
         return {"message": "Producto eliminado correctamente"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -134,12 +130,13 @@ async def delete_article(article_id: str, admin: Dict = Depends(verify_admin)):
     try:
         # Verificar que el artículo existe
         article_ref = db.collection("articulos").document(article_id)
-        if not article_ref.get().exists:
+        if not (await get_doc(article_ref)).exists:
             raise HTTPException(status_code=404, detail="Artículo no encontrado")
             
-        # Eliminar artículo
-        article_ref.delete()
-        return {"message": "Artículo eliminado correctamente"}
+        # Eliminar artículo; sus comentarios y respuestas se borran en segundo plano
+        await eliminar_con_contador(article_ref, ARTICULOS)
+        trabajo_id = await programar_borrado(f"comentarios del artículo {article_id}", [coleccion(article_ref.collection("comentarios"))])
+        return {"message": "Artículo eliminado correctamente", "borrado_id": trabajo_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -148,9 +145,9 @@ async def delete_article(article_id: str, admin: Dict = Depends(verify_admin)):
 async def delete_compra(compra_id: str, admin: Dict = Depends(verify_admin)):
     try:
         compra_ref = db.collection("compras").document(compra_id)
-        if not compra_ref.get().exists:
+        if not (await get_doc(compra_ref)).exists:
             raise HTTPException(status_code=404, detail="Compra no encontrada")
-        compra_ref.delete()
+        await eliminar_con_contador(compra_ref, COMPRAS)
         return {"message": "Compra eliminada correctamente"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -193,7 +190,8 @@ async def create_user(data: Dict = Body(...), admin: Dict = Depends(verify_admin
             "seguidos": []
         }
         
-        db.collection("usuarios").document(user_record.uid).set(user_data)
+        await crear_con_contador(db.collection("usuarios").document(user_record.uid), user_data, USUARIOS)
+        await guardar_indice_email(email, user_record.uid)
         
         return user_data
         
@@ -207,7 +205,7 @@ async def update_user(user_id: str, data: Dict = Body(...), admin: Dict = Depend
     try:
         # Verificar que el usuario existe en Firestore
         user_ref = db.collection("usuarios").document(user_id)
-        user_doc = user_ref.get()
+        user_doc = await get_doc(user_ref)
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
@@ -253,14 +251,49 @@ async def update_user(user_id: str, data: Dict = Body(...), admin: Dict = Depend
                 pass
         
         # Actualizar en Firestore
-        user_ref.update(update_data)
+        await update_doc(user_ref, update_data)
+        # El rol puede haber cambiado: no reutilizar los datos cacheados por verify_admin
+        invalidate_user_cache(user_id)
+        if "email" in update_data:
+            await guardar_indice_email(update_data["email"], user_id, current_data.get("email"))
         
         # Retornar datos actualizados
-        updated_user = user_ref.get().to_dict()
+        updated_user = (await get_doc(user_ref)).to_dict()
         updated_user["uid"] = user_id
         return updated_user
         
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al actualizar usuario: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error al actualizar usuario: {str(e)}")
+
+# Estado de un borrado en cascada en segundo plano
+@router.get("/borrados/{borrado_id}")
+async def get_borrado(borrado_id: str, admin: Dict = Depends(verify_admin)):
+    estado = await estado_borrado(borrado_id)
+    if estado is None:
+        raise HTTPException(status_code=404, detail="Borrado no encontrado")
+    return estado
+
+# Reintentar los objetivos que fallaron en un borrado
+@router.post("/borrados/{borrado_id}/reintentar")
+async def retry_borrado(borrado_id: str, admin: Dict = Depends(verify_admin)):
+    if await estado_borrado(borrado_id) is None:
+        raise HTTPException(status_code=404, detail="Borrado no encontrado")
+    if not await reintentar_borrado(borrado_id):
+        raise HTTPException(status_code=409, detail="El borrado no tiene objetivos fallidos")
+    return await estado_borrado(borrado_id)
+
+# Eliminar comentarios de artículos que ya no existen
+@router.post("/borrados/comentarios-huerfanos")
+async def delete_orphan_comments(admin: Dict = Depends(verify_admin)):
+    huerfanos = await comentarios_huerfanos()
+    if not huerfanos:
+        return {"message": "No hay comentarios huérfanos", "borrado_id": None}
+    # Un trabajo guarda sus rutas en un solo documento: si hay más, se vuelve a lanzar
+    programados = huerfanos[:MAX_RUTAS]
+    borrado_id = await programar_borrado("comentarios huérfanos", [documentos(programados)])
+    message = f"{len(programados)} comentarios huérfanos programados para borrar"
+    if len(huerfanos) > len(programados):
+        message += f" (de {len(huerfanos)}; vuelve a lanzarlo cuando termine para el resto)"
+    return {"message": message, "borrado_id": borrado_id}
@@ -8,10 +8,15 @@ import httpx
 from dotenv import load_dotenv
 import logging
 import base64
-import cloudinary
 import json
 
 from firebase_config import db
+from firestore_async import get_doc, set_doc, update_doc
+from middleware import verify_token, invalidate_user_cache
+from contadores import crear_con_contador, eliminar_con_contador, USUARIOS, PRODUCTOS, ARTICULOS
+from indice_emails import guardar_indice_email, eliminar_indice_email
+from subida_imagenes import subir_archivo, validar_tamano
+from borrado_cascada import programar_borrado, consulta
 
 # Configurar logging
 logging.basicConfig(
@@ -106,7 +111,8 @@ async def register_user(user: UserRegister):
             "seguidores": user.seguidores or [],
             "seguidos": user.seguidos or []
         }
-        db.collection("usuarios").document(user_record.uid).set(user_data)
+        await crear_con_contador(db.collection("usuarios").document(user_record.uid), user_data, USUARIOS)
+        await guardar_indice_email(user.email, user_record.uid)
         
         # Autenticar automáticamente al usuario después del registro
         # usando la misma lógica que el login
@@ -207,7 +213,7 @@ async def login_user(user: UserLogin) -> Dict[str, str]:
             
             # Obtener el usuario de Firebase
             user_record = auth.get_user_by_email(user.email)            # Obtener la foto de perfil y rol desde Firestore
-            user_doc = db.collection("usuarios").document(user_record.uid).get()
+            user_doc = await get_doc(db.collection("usuarios").document(user_record.uid))
             foto_url = ""
             role = "user"
             biografia = ""
@@ -280,12 +286,14 @@ async def login_with_google(id_token: str = Body(..., embed=True)):
 
             # Verificar si el usuario ya existe para preservar su foto personalizada
             user_ref = db.collection("usuarios").document(user_info["uid"])
-            existing_user = user_ref.get()
+            existing_user = await get_doc(user_ref)
             
             if existing_user.exists:
                 # Usuario existente - preservar foto personalizada
-                user_ref.set(user_info, merge=True)                # Obtener datos actualizados incluyendo la foto existente
-                updated_user = user_ref.get().to_dict()
+                await set_doc(user_ref, user_info, merge=True)
+                await guardar_indice_email(user_info["email"], user_info["uid"], existing_user.to_dict().get("email"))
+                # Obtener datos actualizados incluyendo la foto existente
+                updated_user = (await get_doc(user_ref)).to_dict()
                 return {
                     "idToken": data.get("idToken"),
                     "refreshToken": data.get("refreshToken"),
@@ -300,7 +308,8 @@ async def login_with_google(id_token: str = Body(..., embed=True)):
                 user_info["foto"] = ""
                 user_info["biografia"] = ""
                 user_info["role"] = "user"
-                user_ref.set(user_info, merge=True)
+                await crear_con_contador(user_ref, user_info, USUARIOS, merge=True)
+                await guardar_indice_email(user_info["email"], user_info["uid"])
                 return {
                     "idToken": data.get("idToken"),
                     "refreshToken": data.get("refreshToken"),
@@ -422,16 +431,10 @@ async def update_profile(
             # Validar tipo y tamaño
             if foto.content_type not in ["image/png", "image/jpeg", "image/jpg", "image/gif"]:
                 raise HTTPException(status_code=400, detail="Tipo de imagen no soportado")
-            contents = await foto.read()
-            if len(contents) > 10 * 1024 * 1024:
-                raise HTTPException(status_code=400, detail="La imagen supera los 10MB")
+            validar_tamano(foto)
             # Subir a Cloudinary
             try:
-                result = cloudinary.uploader.upload(
-                    contents,
-                    folder="profile_images",
-                    resource_type="auto"
-                )
+                result = await subir_archivo(foto, "profile_images")
                 firestore_data["foto"] = result["secure_url"]
             except Exception as img_err:
                 logger.error(f"Error subiendo imagen a Cloudinary: {str(img_err)}")
@@ -443,17 +446,20 @@ async def update_profile(
         # Actualizar en Firestore
         if firestore_data:
             # Obtener el documento actual para preservar datos no actualizados
-            current_doc = db.collection("usuarios").document(uid).get()
+            current_doc = await get_doc(db.collection("usuarios").document(uid))
             current_data = current_doc.to_dict() if current_doc.exists else {}
             # Combinar datos actuales con nuevos datos
             updated_data = {**current_data, **firestore_data}
-            db.collection("usuarios").document(uid).set(updated_data, merge=True)
+            await set_doc(db.collection("usuarios").document(uid), updated_data, merge=True)
+            invalidate_user_cache(uid)
+            if "email" in firestore_data:
+                await guardar_indice_email(firestore_data["email"], uid, user.email)
             logger.info(f"Updated Firestore for user {uid}")
         
         logger.info(f"Profile update successful for user {uid}")
         
         # Obtener los datos actualizados para retornar al frontend
-        updated_doc = db.collection("usuarios").document(uid).get()
+        updated_doc = await get_doc(db.collection("usuarios").document(uid))
         updated_user_data = updated_doc.to_dict() if updated_doc.exists else {}
         
         return {"message": "Perfil actualizado con éxito", "data": updated_user_data}
@@ -517,16 +523,10 @@ async def update_profile_with_password(
             # Validar tipo y tamaño
             if foto.content_type not in ["image/png", "image/jpeg", "image/jpg", "image/gif"]:
                 raise HTTPException(status_code=400, detail="Tipo de imagen no soportado")
-            contents = await foto.read()
-            if len(contents) > 10 * 1024 * 1024:
-                raise HTTPException(status_code=400, detail="La imagen supera los 10MB")
+            validar_tamano(foto)
             # Subir a Cloudinary
             try:
-                result = cloudinary.uploader.upload(
-                    contents,
-                    folder="profile_images",
-                    resource_type="auto"
-                )
+                result = await subir_archivo(foto, "profile_images")
                 firestore_data["foto"] = result["secure_url"]
             except Exception as img_err:
                 logger.error(f"Error subiendo imagen a Cloudinary: {str(img_err)}")
@@ -539,17 +539,20 @@ async def update_profile_with_password(
         # Actualizar en Firestore
         if firestore_data:
             # Obtener el documento actual para preservar datos no actualizados
-            current_doc = db.collection("usuarios").document(uid).get()
+            current_doc = await get_doc(db.collection("usuarios").document(uid))
             current_data = current_doc.to_dict() if current_doc.exists else {}
             # Combinar datos actuales con nuevos datos
             updated_data = {**current_data, **firestore_data}
-            db.collection("usuarios").document(uid).set(updated_data, merge=True)
+            await set_doc(db.collection("usuarios").document(uid), updated_data, merge=True)
+            invalidate_user_cache(uid)
+            if "email" in firestore_data:
+                await guardar_indice_email(firestore_data["email"], uid, user.email)
             logger.info(f"Updated Firestore for user {uid}")
         
         logger.info(f"Profile with password update successful for user {uid}")
         
         # Obtener los datos actualizados para retornar al frontend
-        updated_doc = db.collection("usuarios").document(uid).get()
+        updated_doc = await get_doc(db.collection("usuarios").document(uid))
         updated_user_data = updated_doc.to_dict() if updated_doc.exists else {}
         
         return {"message": "Perfil y contraseña actualizados con éxito", "data": updated_user_data}
@@ -594,7 +597,7 @@ async def delete_account(account_data: DeleteAccount):
         
         # Eliminar datos del usuario de Firestore
         user_ref = db.collection("usuarios").document(account_data.uid)
-        user_doc = user_ref.get()
+        user_doc = await get_doc(user_ref)
         
         if not user_doc.exists:
             raise HTTPException(
@@ -602,20 +605,17 @@ async def delete_account(account_data: DeleteAccount):
                 detail="No se encontraron los datos del usuario"
             )
             
-        user_ref.delete()
+        await eliminar_con_contador(user_ref, USUARIOS)
+        await eliminar_indice_email(account_data.email)
+        invalidate_user_cache(account_data.uid)
         
-        # Eliminar artículos y productos asociados
-        articles_ref = db.collection("articulos")
-        articles = articles_ref.where("email", "==", account_data.email).stream()
-        for article in articles:
-            article.reference.delete()
-            
-        products_ref = db.collection("productos")
-        products = products_ref.where("email", "==", account_data.email).stream()
-        for product in products:
-            product.reference.delete()
+        # Eliminar artículos (con sus comentarios) y productos asociados en segundo plano
+        trabajo_id = await programar_borrado(f"cuenta {account_data.uid}", [
+            consulta("articulos", "autor_email", account_data.email, ARTICULOS),
+            consulta("productos", "usuario_email", account_data.email, PRODUCTOS, recursivo=False)
+        ])
         
-        return {"message": "Cuenta eliminada con éxito"}
+        return {"message": "Cuenta eliminada con éxito", "borrado_id": trabajo_id}
         
     except HTTPException as he:
         raise he
@@ -631,11 +631,11 @@ async def follow_user(uid: str, body: FollowRequest):
     current_user_uid = body.current_user_uid
     try:
         # Verificar que el usuario a seguir existe
-        user_to_follow = db.collection("usuarios").document(uid).get()
+        user_to_follow = await get_doc(db.collection("usuarios").document(uid))
         if not user_to_follow.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         # Verificar que el usuario actual existe
-        current_user = db.collection("usuarios").document(current_user_uid).get()
+        current_user = await get_doc(db.collection("usuarios").document(current_user_uid))
         if not current_user.exists:
             raise HTTPException(status_code=404, detail="Usuario actual no encontrado")
         # Actualizar seguidores del usuario a seguir
@@ -644,14 +644,14 @@ async def follow_user(uid: str, body: FollowRequest):
             user_to_follow_data["seguidores"] = []
         if current_user_uid not in user_to_follow_data["seguidores"]:
             user_to_follow_data["seguidores"].append(current_user_uid)
-            db.collection("usuarios").document(uid).update({"seguidores": user_to_follow_data["seguidores"]})
+            await update_doc(db.collection("usuarios").document(uid), {"seguidores": user_to_follow_data["seguidores"]})
         # Actualizar seguidos del usuario actual
         current_user_data = current_user.to_dict()
         if "seguidos" not in current_user_data:
             current_user_data["seguidos"] = []
         if uid not in current_user_data["seguidos"]:
             current_user_data["seguidos"].append(uid)
-            db.collection("usuarios").document(current_user_uid).update({"seguidos": current_user_data["seguidos"]})
+            await update_doc(db.collection("usuarios").document(current_user_uid), {"seguidos": current_user_data["seguidos"]})
         return {"message": "Usuario seguido con éxito"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -661,23 +661,23 @@ async def unfollow_user(uid: str, body: FollowRequest):
     current_user_uid = body.current_user_uid
     try:
         # Verificar que el usuario a dejar de seguir existe
-        user_to_unfollow = db.collection("usuarios").document(uid).get()
+        user_to_unfollow = await get_doc(db.collection("usuarios").document(uid))
         if not user_to_unfollow.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         # Verificar que el usuario actual existe
-        current_user = db.collection("usuarios").document(current_user_uid).get()
+        current_user = await get_doc(db.collection("usuarios").document(current_user_uid))
         if not current_user.exists:
             raise HTTPException(status_code=404, detail="Usuario actual no encontrado")
         # Actualizar seguidores del usuario a dejar de seguir
         user_to_unfollow_data = user_to_unfollow.to_dict()
         if "seguidores" in user_to_unfollow_data and current_user_uid in user_to_unfollow_data["seguidores"]:
             user_to_unfollow_data["seguidores"].remove(current_user_uid)
-            db.collection("usuarios").document(uid).update({"seguidores": user_to_unfollow_data["seguidores"]})
+            await update_doc(db.collection("usuarios").document(uid), {"seguidores": user_to_unfollow_data["seguidores"]})
         # Actualizar seguidos del usuario actual
         current_user_data = current_user.to_dict()
         if "seguidos" in current_user_data and uid in current_user_data["seguidos"]:
             current_user_data["seguidos"].remove(uid)
-            db.collection("usuarios").document(current_user_uid).update({"seguidos": current_user_data["seguidos"]})
+            await update_doc(db.collection("usuarios").document(current_user_uid), {"seguidos": current_user_data["seguidos"]})
         return {"message": "Dejado de seguir al usuario con éxito"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -685,7 +685,7 @@ async def unfollow_user(uid: str, body: FollowRequest):
 @router.get("/followers/{uid}")
 async def get_followers(uid: str):
     try:
-        user = db.collection("usuarios").document(uid).get()
+        user = await get_doc(db.collection("usuarios").document(uid))
         if not user.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
@@ -695,7 +695,7 @@ async def get_followers(uid: str):
         # Obtener información detallada de los seguidores
         followers_data = []
         for follower_uid in followers:
-            follower = db.collection("usuarios").document(follower_uid).get()
+            follower = await get_doc(db.collection("usuarios").document(follower_uid))
             if follower.exists:
                 follower_data = follower.to_dict()
                 followers_data.append({
@@ -712,7 +712,7 @@ async def get_followers(uid: str):
 @router.get("/following/{uid}")
 async def get_following(uid: str):
     try:
-        user = db.collection("usuarios").document(uid).get()
+        user = await get_doc(db.collection("usuarios").document(uid))
         if not user.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
@@ -722,7 +722,7 @@ async def get_following(uid: str):
         # Obtener información detallada de los usuarios seguidos
         following_data = []
         for following_uid in following:
-            following_user = db.collection("usuarios").document(following_uid).get()
+            following_user = await get_doc(db.collection("usuarios").document(following_uid))
             if following_user.exists:
                 following_user_data = following_user.to_dict()
                 following_data.append({
@@ -741,22 +741,22 @@ async def remove_follower(uid: str, body: FollowRequest):
     follower_uid = body.current_user_uid
     try:
         # Eliminar follower_uid de la lista de seguidores de uid
-        user_doc = db.collection("usuarios").document(uid).get()
+        user_doc = await get_doc(db.collection("usuarios").document(uid))
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         user_data = user_doc.to_dict()
         seguidores = user_data.get("seguidores", [])
         if follower_uid in seguidores:
             seguidores.remove(follower_uid)
-            db.collection("usuarios").document(uid).update({"seguidores": seguidores})
+            await update_doc(db.collection("usuarios").document(uid), {"seguidores": seguidores})
         # Eliminar uid de la lista de seguidos del follower
-        follower_doc = db.collection("usuarios").document(follower_uid).get()
+        follower_doc = await get_doc(db.collection("usuarios").document(follower_uid))
         if follower_doc.exists:
             follower_data = follower_doc.to_dict()
             seguidos = follower_data.get("seguidos", [])
             if uid in seguidos:
                 seguidos.remove(uid)
-                db.collection("usuarios").document(follower_uid).update({"seguidos": seguidos})
+                await update_doc(db.collection("usuarios").document(follower_uid), {"seguidos": seguidos})
         return {"message": "Seguidor eliminado correctamente"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -783,7 +783,7 @@ async def get_current_uid_ws(websocket: WebSocket):
         token = token.replace('Bearer ', '')
     
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_token(token)
         return decoded_token['uid']
     except Exception as e:
         raise Exception('Token inválido o expirado') 
\ No newline at end of file
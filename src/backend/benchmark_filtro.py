@@ -0,0 +1,81 @@
+"""
+Micro-benchmark del filtro de respuestas del asistente sobre respuestas realistas de
+1200 caracteres (el máximo que se devuelve), comparando la expresión regular anterior
+con el filtro precompilado de filtro_respuestas, tanto completo como incremental.
+
+Uso:
+    python benchmark_filtro.py [--repeticiones 2000] [--tamano-token 4]
+"""
+import argparse
+import random
+import re
+import statistics
+import time
+from filtro_respuestas import respuesta_bloqueada, EscanerRespuesta
+
+LONGITUD_RESPUESTA = 1200
+
+FRASES_ES = [
+    "Los envíos suelen tardar entre 2 y 5 días laborables en toda España.",
+    "Puedes solicitar una devolución contactando con soporte dentro de los 14 días siguientes a la recepción del pedido.",
+    "Haz clic en el botón \"Añadir al carrito\" en la página del producto o desde la vista de la tienda.",
+    "En la página de cada producto se muestra el stock disponible.",
+    "Accede a la sección \"Artículos guardados\" en tu perfil para ver todos los artículos que has guardado.",
+    "Si el problema persiste, contacta con soporte en info@crpghub.com o al teléfono +34 123 456 789.",
+]
+FRASES_EN = [
+    "This is what you have to do if the order does not arrive.",
+    "You can also check it here, then go to the next page.",
+]
+
+def filtro_anterior(texto):
+    # Implementación previa de chat.py, reconstruida en cada llamada
+    palabras_ingles = r"the|and|you|for|with|that|this|have|from|are|your|example|help|issue|user|question|answer|doubt|imagine|each|unique|week|day|days|english|spanish|hello|hi|please|thank you|sorry|yes|no|can|could|would|should|will|may|might|must|shall|do|does|did|done|has|had|having|been|being|was|were|am|is|it|its|they|them|their|there|here|how|what|when|where|who|why|which|about|because|but|if|or|as|at|by|on|in|to|of|not|so|just|now|then|than|also|too|very|really|still|even|only|again|always|never|sometimes|often|usually|ever|once|twice|first|second|third|next|last|before|after|since|until|while|during|through|across|over|under|between|among|against|toward|upon|within|without|along|around|behind|beside|beyond|except|inside|outside|above|below|near|far|off|onto|into|upon|via|per|plus|minus|versus|vs|etc|etc\."
+    ingles = bool(re.search(rf"((?:{palabras_ingles})[\s,.!?]*){5,}", texto, re.IGNORECASE))
+    roleplay = bool(re.search(r"imagine that you are|supongamos que eres|act as|actúa como|let's pretend|escenario:|scenario:", texto, re.IGNORECASE))
+    return ingles or roleplay
+
+def generar_respuesta(frases, rng):
+    texto = ""
+    while len(texto) < LONGITUD_RESPUESTA:
+        texto += rng.choice(frases) + " "
+    return texto[:LONGITUD_RESPUESTA]
+
+def escanear_incremental(texto, tamano_token):
+    escaner = EscanerRespuesta()
+    for i in range(0, len(texto), tamano_token):
+        if escaner.alimentar(texto[i:i + tamano_token]):
+            return True
+    return escaner.terminar()
+
+def medir(nombre, funcion, respuestas, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        texto = respuestas[len(tiempos) % len(respuestas)]
+        inicio = time.perf_counter()
+        funcion(texto)
+        tiempos.append((time.perf_counter() - inicio) * 1e6)
+    tiempos.sort()
+    print(f"  {nombre:<24} media {statistics.mean(tiempos):8.1f} µs | p50 {tiempos[len(tiempos) // 2]:8.1f} µs"
+          f" | p99 {tiempos[int(len(tiempos) * 0.99) - 1]:8.1f} µs")
+
+def main(args):
+    rng = random.Random(42)
+    casos = {
+        "español": [generar_respuesta(FRASES_ES, rng) for _ in range(50)],
+        "mezcla con inglés": [generar_respuesta(FRASES_ES + FRASES_EN, rng) for _ in range(50)],
+        # Peor caso para la expresión anterior: palabras en inglés sin llegar a la racha
+        "adversario": [("the and you for: " * 100)[:LONGITUD_RESPUESTA]],
+    }
+    for caso, respuestas in casos.items():
+        print(f"Respuestas de {LONGITUD_RESPUESTA} caracteres ({caso}):")
+        medir("regex anterior", filtro_anterior, respuestas, args.repeticiones)
+        medir("filtro precompilado", respuesta_bloqueada, respuestas, args.repeticiones)
+        medir(f"incremental ({args.tamano_token} chars)",
+              lambda texto: escanear_incremental(texto, args.tamano_token), respuestas, args.repeticiones)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark del filtro de respuestas del asistente")
+    parser.add_argument("--repeticiones", type=int, default=2000)
+    parser.add_argument("--tamano-token", type=int, default=4, help="Caracteres por fragmento en el modo incremental")
+    main(parser.parse_args())
@@ -0,0 +1,298 @@
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from uuid import uuid4
+from firebase_config import db
+from firestore_async import run_blocking, stream_docs, get_all_docs, get_doc, set_doc, run_transaction
+from contadores import incrementar, eliminar_con_contador
+
+# Borrados en cascada en segundo plano. El endpoint borra (o desvincula) el documento
+# principal y programa aquí los dependientes: artículos y productos de un usuario,
+# respuestas de comentarios, mensajes de chats... que se eliminan por lotes, con
+# reintentos y con el progreso consultable desde /admin/borrados/{id}.
+# El estado de cada trabajo se guarda en borrados/{id} con los objetivos pendientes
+# descritos por rutas y consultas, así que un reinicio o un despliegue no lo pierde: al
+# arrancar se reanudan los trabajos que se quedaron a medias.
+logger = logging.getLogger(__name__)
+
+BORRADOS_COLLECTION = "borrados"
+MAX_BATCH_DELETES = 500
+# Borrados por transacción, dejando sitio a la escritura del contador
+MAX_LOTE = MAX_BATCH_DELETES - 1
+MAX_INTENTOS = 5
+# Rutas sueltas por trabajo: se guardan en su documento, que no puede pasar de 1 MiB
+MAX_RUTAS = 5000
+# Cada cuánto se guarda, como mucho, el progreso de un trabajo en curso
+GUARDAR_CADA = 5
+# Un trabajo en curso que lleva más de esto sin guardar progreso se da por abandonado
+# (el proceso que lo ejecutaba se reinició) y se puede reanudar
+BORRADO_LEASE_SECONDS = 300
+ESTADOS_ACTIVOS = ["pendiente", "en_curso"]
+CAMPOS_PUBLICOS = (
+    "id", "descripcion", "estado", "documentos_borrados", "objetivos",
+    "objetivos_completados", "errores", "creado", "finalizado"
+)
+
+# Trabajos que se están ejecutando en este proceso
+_trabajos: Dict[str, dict] = {}
+_tareas = set()
+
+def documentos(refs: List, contador: Optional[str] = None) -> dict:
+    """Unos documentos concretos con todas sus subcolecciones"""
+    if len(refs) > MAX_RUTAS:
+        raise ValueError(f"Como máximo {MAX_RUTAS} documentos por borrado")
+    return {"rutas": [ref.path for ref in refs], "contador": contador, "recursivo": True}
+
+def coleccion(ref) -> dict:
+    """Una (sub)colección completa, aunque su documento padre ya no exista"""
+    ruta = f"{ref.parent.path}/{ref.id}" if ref.parent is not None else ref.id
+    return {"coleccion": ruta, "contador": None, "recursivo": True}
+
+def consulta(coleccion: str, campo: str, valor, contador: Optional[str] = None, recursivo: bool = True) -> dict:
+    """Los documentos de coleccion con campo == valor; sin subcolecciones se borran por lotes directos"""
+    return {"consulta": {"coleccion": coleccion, "campo": campo, "valor": valor}, "contador": contador, "recursivo": recursivo}
+
+def _ref_trabajo(trabajo_id: str):
+    return db.collection(BORRADOS_COLLECTION).document(trabajo_id)
+
+def _publico(datos: dict) -> dict:
+    return {campo: datos.get(campo) for campo in CAMPOS_PUBLICOS}
+
+def _serializar(objetivo: dict) -> dict:
+    # De las rutas solo se guardan las que faltan
+    datos = {k: v for k, v in objetivo.items() if k != "procesados"}
+    if "rutas" in objetivo:
+        datos["rutas"] = objetivo["rutas"][objetivo.get("procesados", 0):]
+    return datos
+
+async def _guardar(trabajo: dict, forzar: bool = False):
+    ahora = time.time()
+    if not forzar and ahora - trabajo["_guardado"] < GUARDAR_CADA:
+        return
+    datos = _publico(trabajo)
+    datos["pendientes"] = [_serializar(objetivo) for objetivo in trabajo["_pendientes"] + trabajo["_en_curso"]]
+    # Mientras el trabajo sigue activo, cada guardado renueva el plazo antes de darlo por abandonado
+    datos["activo_hasta"] = ahora + BORRADO_LEASE_SECONDS if trabajo["estado"] in ESTADOS_ACTIVOS else None
+    trabajo["_guardado"] = ahora
+    try:
+        if forzar:
+            await _con_reintentos(set_doc, _ref_trabajo(trabajo["id"]), datos)
+        else:
+            await set_doc(_ref_trabajo(trabajo["id"]), datos)
+    except Exception as e:
+        # El trabajo sigue; el progreso se vuelve a intentar guardar en el siguiente plazo
+        logger.error(f"Error guardando el borrado en cascada {trabajo['id']}: {e}")
+
+async def programar_borrado(descripcion: str, objetivos: List[dict]) -> str:
+    """Guarda el trabajo, lo lanza en segundo plano y devuelve su id"""
+    trabajo_id = str(uuid4())
+    trabajo = {
+        "id": trabajo_id,
+        "descripcion": descripcion,
+        "estado": "pendiente",
+        "documentos_borrados": 0,
+        "objetivos": len(objetivos),
+        "objetivos_completados": 0,
+        "errores": [],
+        "creado": time.time(),
+        "finalizado": None,
+        "_pendientes": objetivos,
+        "_en_curso": [],
+        "_guardado": 0
+    }
+    await _guardar(trabajo, forzar=True)
+    _lanzar(trabajo)
+    return trabajo_id
+
+async def estado_borrado(trabajo_id: str) -> Optional[dict]:
+    # Si corre en este proceso, la copia en memoria lleva el progreso más reciente
+    trabajo = _trabajos.get(trabajo_id)
+    if trabajo is not None:
+        return _publico(trabajo)
+    doc = await get_doc(_ref_trabajo(trabajo_id))
+    return _publico(doc.to_dict()) if doc.exists else None
+
+def _reclamar_tx(transaction, ref, reintentar: bool) -> Optional[dict]:
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    datos = snapshot.to_dict()
+    abandonado = datos.get("estado") in ESTADOS_ACTIVOS and (datos.get("activo_hasta") or 0) < time.time()
+    fallido = reintentar and datos.get("estado") == "error"
+    if not abandonado and not fallido:
+        return None
+    if not datos.get("pendientes"):
+        # Terminó justo antes de guardar el estado final
+        transaction.update(ref, {"estado": "completado", "finalizado": time.time(), "activo_hasta": None})
+        return None
+    transaction.update(ref, {"estado": "pendiente", "errores": [], "activo_hasta": time.time() + BORRADO_LEASE_SECONDS})
+    return {
+        **_publico(datos),
+        "estado": "pendiente",
+        "errores": [],
+        "_pendientes": datos["pendientes"],
+        "_en_curso": [],
+        "_guardado": 0
+    }
+
+async def reintentar_borrado(trabajo_id: str) -> bool:
+    """Vuelve a lanzar los objetivos que fallaron; False si no hay nada que reintentar"""
+    if trabajo_id in _trabajos:
+        return False
+    trabajo = await run_transaction(_reclamar_tx, _ref_trabajo(trabajo_id), True)
+    if trabajo is None:
+        return False
+    _lanzar(trabajo)
+    return True
+
+async def reanudar_borrados() -> int:
+    """Reanuda los trabajos abandonados a medias por un proceso que ya no está"""
+    docs = await stream_docs(db.collection(BORRADOS_COLLECTION).where("estado", "in", ESTADOS_ACTIVOS).select([]))
+    reanudados = 0
+    for doc in docs:
+        # La transacción evita que dos workers que arrancan a la vez reanuden el mismo
+        trabajo = await run_transaction(_reclamar_tx, doc.reference, False)
+        if trabajo is not None:
+            _lanzar(trabajo)
+            reanudados += 1
+    return reanudados
+
+async def _reanudar():
+    try:
+        reanudados = await reanudar_borrados()
+        if reanudados:
+            logger.info(f"Borrados en cascada reanudados: {reanudados}")
+    except Exception as e:
+        logger.error(f"Error reanudando los borrados en cascada: {e}")
+
+def lanzar_reanudacion():
+    """Programa la reanudación de los borrados interrumpidos (llamar desde el arranque de la app)"""
+    _programar(_reanudar())
+
+def _programar(corrutina):
+    tarea = asyncio.get_running_loop().create_task(corrutina)
+    # Mantener una referencia para que la tarea no se recolecte a medias
+    _tareas.add(tarea)
+    tarea.add_done_callback(_tareas.discard)
+
+def _lanzar(trabajo: dict):
+    _trabajos[trabajo["id"]] = trabajo
+    _programar(_ejecutar(trabajo))
+
+async def _con_reintentos(fn, *args):
+    for intento in range(MAX_INTENTOS):
+        try:
+            return await fn(*args)
+        except Exception:
+            if intento == MAX_INTENTOS - 1:
+                raise
+            await asyncio.sleep(0.5 * 2 ** intento)
+
+async def _refs_consulta(consulta: dict) -> List:
+    query = db.collection(consulta["coleccion"]).where(consulta["campo"], "==", consulta["valor"])
+    docs = await stream_docs(query.select([]).limit(MAX_LOTE))
+    return [doc.reference for doc in docs]
+
+def _subcolecciones(ref) -> List:
+    return list(ref.collections())
+
+async def _borrar_recursivo(ref, contador: Optional[str] = None) -> int:
+    # recursive_delete usa BulkWriter y elimina también todas las subcolecciones
+    if not contador:
+        return await run_blocking(db.recursive_delete, ref)
+    # El documento principal se borra y descuenta en una transacción que comprueba que
+    # existe: un reintento, o un borrado del propio usuario mientras corre el trabajo, no
+    # descuenta dos veces. Después solo quedan sus subcolecciones: recursive_delete sobre
+    # el documento lo volvería a borrar y a contar
+    borrados = int(await eliminar_con_contador(ref, contador))
+    for subcoleccion in await run_blocking(_subcolecciones, ref):
+        borrados += await run_blocking(db.recursive_delete, subcoleccion)
+    return borrados
+
+def _borrar_lote_tx(transaction, refs: List, contador: Optional[str]) -> int:
+    # Solo se borran (y descuentan) los documentos que siguen existiendo
+    existentes = [snapshot.reference for snapshot in transaction.get_all(refs) if snapshot.exists]
+    for ref in existentes:
+        transaction.delete(ref)
+    if contador and existentes:
+        incrementar(transaction, contador, -len(existentes))
+    return len(existentes)
+
+async def _borrar_lote(refs: List, contador: Optional[str]) -> int:
+    return await run_transaction(_borrar_lote_tx, refs, contador)
+
+def _avanzar(objetivo: dict, cantidad: int):
+    # Solo las listas de rutas necesitan recordar por dónde van
+    if "rutas" in objetivo:
+        objetivo["procesados"] = objetivo.get("procesados", 0) + cantidad
+
+async def _borrar_refs(trabajo: dict, objetivo: dict, refs: List):
+    if objetivo["recursivo"]:
+        for ref in refs:
+            trabajo["documentos_borrados"] += await _con_reintentos(_borrar_recursivo, ref, objetivo["contador"])
+            _avanzar(objetivo, 1)
+            await _guardar(trabajo)
+    else:
+        for inicio in range(0, len(refs), MAX_LOTE):
+            lote = refs[inicio:inicio + MAX_LOTE]
+            trabajo["documentos_borrados"] += await _con_reintentos(_borrar_lote, lote, objetivo["contador"])
+            _avanzar(objetivo, len(lote))
+            await _guardar(trabajo)
+
+async def _ejecutar_objetivo(trabajo: dict, objetivo: dict):
+    if "coleccion" in objetivo:
+        trabajo["documentos_borrados"] += await _con_reintentos(_borrar_recursivo, db.collection(objetivo["coleccion"]))
+        return
+    if "consulta" in objetivo:
+        # Página a página hasta que no quede nada: lo ya borrado deja de aparecer, así que
+        # reanudar o reintentar es volver a lanzar la misma consulta
+        while True:
+            refs = await _con_reintentos(_refs_consulta, objetivo["consulta"])
+            if not refs:
+                return
+            await _borrar_refs(trabajo, objetivo, refs)
+    rutas = objetivo["rutas"][objetivo.get("procesados", 0):]
+    await _borrar_refs(trabajo, objetivo, [db.document(ruta) for ruta in rutas])
+
+async def _ejecutar(trabajo: dict):
+    trabajo_id = trabajo["id"]
+    try:
+        trabajo["estado"] = "en_curso"
+        trabajo["_en_curso"], trabajo["_pendientes"] = trabajo["_pendientes"], []
+        await _guardar(trabajo, forzar=True)
+        en_curso = trabajo["_en_curso"]
+        while en_curso:
+            objetivo = en_curso[0]
+            try:
+                await _ejecutar_objetivo(trabajo, objetivo)
+                trabajo["objetivos_completados"] += 1
+            except Exception as e:
+                logger.error(f"Borrado en cascada {trabajo_id} ({trabajo['descripcion']}): {e}")
+                trabajo["errores"].append(str(e))
+                trabajo["_pendientes"].append(objetivo)
+            en_curso.pop(0)
+            await _guardar(trabajo)
+        trabajo["estado"] = "error" if trabajo["_pendientes"] else "completado"
+        trabajo["finalizado"] = time.time()
+        await _guardar(trabajo, forzar=True)
+        logger.info(f"Borrado en cascada {trabajo_id} ({trabajo['descripcion']}): {trabajo['estado']}, "
+                    f"{trabajo['documentos_borrados']} documentos")
+    finally:
+        _trabajos.pop(trabajo_id, None)
+
+async def comentarios_huerfanos() -> List:
+    """Comentarios cuyo artículo ya no existe (borrados antes de la cascada)"""
+    comentarios = await stream_docs(db.collection_group("comentarios").select([]))
+    por_articulo: Dict[str, list] = {}
+    for comentario in comentarios:
+        articulo_ref = comentario.reference.parent.parent
+        if articulo_ref is not None:
+            por_articulo.setdefault(articulo_ref.path, []).append(comentario.reference)
+    huerfanos = []
+    articulos = [refs[0].parent.parent for refs in por_articulo.values()]
+    for inicio in range(0, len(articulos), MAX_BATCH_DELETES):
+        for articulo in await get_all_docs(articulos[inicio:inicio + MAX_BATCH_DELETES]):
+            if not articulo.exists:
+                huerfanos += por_articulo[articulo.reference.path]
+    return huerfanos
@@ -0,0 +1,103 @@
+import os
+import json
+import asyncio
+from typing import Awaitable, Callable, Dict
+
+# Pub/sub para el reparto de eventos del chat directo por WebSocket. Cada worker se
+# suscribe a los chats que tienen sockets abiertos en él y publica los eventos en el
+# broker, que los entrega a todos los workers suscritos (incluido el que publica).
+# Sin WS_BROKER_URL se usa el broker en memoria, válido para un único proceso.
+WS_BROKER_URL = os.getenv("WS_BROKER_URL")
+PREFIJO_CANAL = "ws_chat:"
+
+Manejador = Callable[[str, dict], Awaitable[None]]
+
+class Broker:
+    async def publicar(self, chat_id: str, mensaje: dict):
+        raise NotImplementedError
+
+    async def suscribir(self, chat_id: str, manejador: Manejador):
+        raise NotImplementedError
+
+    async def desuscribir(self, chat_id: str):
+        raise NotImplementedError
+
+    async def cerrar(self):
+        pass
+
+class BrokerMemoria(Broker):
+    def __init__(self):
+        self._manejadores: Dict[str, Manejador] = {}
+
+    async def publicar(self, chat_id: str, mensaje: dict):
+        manejador = self._manejadores.get(chat_id)
+        if manejador is not None:
+            await manejador(chat_id, mensaje)
+
+    async def suscribir(self, chat_id: str, manejador: Manejador):
+        self._manejadores[chat_id] = manejador
+
+    async def desuscribir(self, chat_id: str):
+        self._manejadores.pop(chat_id, None)
+
+class BrokerRedis(Broker):
+    """
+    Broker sobre el pub/sub de Redis. Acepta cualquier cliente compatible con
+    redis.asyncio (por ejemplo fakeredis.aioredis.FakeRedis para pruebas locales).
+    """
+    def __init__(self, cliente):
+        self._cliente = cliente
+        self._pubsub = cliente.pubsub(ignore_subscribe_messages=True)
+        self._manejadores: Dict[str, Manejador] = {}
+        self._lector = None
+
+    @classmethod
+    def desde_url(cls, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("WS_BROKER_URL requiere el paquete redis (pip install redis)")
+        return cls(redis.from_url(url))
+
+    async def publicar(self, chat_id: str, mensaje: dict):
+        await self._cliente.publish(PREFIJO_CANAL + chat_id, json.dumps(mensaje))
+
+    async def suscribir(self, chat_id: str, manejador: Manejador):
+        self._manejadores[chat_id] = manejador
+        await self._pubsub.subscribe(PREFIJO_CANAL + chat_id)
+        if self._lector is None:
+            self._lector = asyncio.get_running_loop().create_task(self._leer())
+
+    async def desuscribir(self, chat_id: str):
+        self._manejadores.pop(chat_id, None)
+        await self._pubsub.unsubscribe(PREFIJO_CANAL + chat_id)
+
+    async def _leer(self):
+        while True:
+            try:
+                mensaje = await self._pubsub.get_message(timeout=1.0)
+                if mensaje is None or mensaje.get("type") != "message":
+                    continue
+                canal = mensaje["channel"]
+                if isinstance(canal, bytes):
+                    canal = canal.decode()
+                manejador = self._manejadores.get(canal[len(PREFIJO_CANAL):])
+                if manejador is not None:
+                    await manejador(canal[len(PREFIJO_CANAL):], json.loads(mensaje["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Error leyendo del broker de chat:", e)
+                await asyncio.sleep(1)
+
+    async def cerrar(self):
+        if self._lector is not None:
+            self._lector.cancel()
+            self._lector = None
+        await self._pubsub.close()
+        await self._cliente.close()
+
+def crear_broker(url: str = WS_BROKER_URL) -> Broker:
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return BrokerRedis.desde_url(url)
+    return BrokerMemoria()
@@ -0,0 +1,137 @@
+import os
+import math
+import time
+import asyncio
+import operator
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+from texto import normalizar_texto
+
+# Caché de respuestas del asistente. La mayoría de preguntas son las mismas del FAQ de
+# ASSISTANT_CONTEXT, así que se guarda la respuesta generada por clave (pregunta
+# normalizada + últimos mensajes del historial) y, si hay modelo de embeddings
+# configurado, también se reutilizan respuestas de preguntas casi idénticas.
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "1024"))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", str(24 * 3600)))
+# Similitud coseno mínima para considerar dos preguntas equivalentes
+CHAT_CACHE_SIMILARITY = float(os.getenv("CHAT_CACHE_SIMILARITY", "0.92"))
+# Máximo de mensajes previos que forman parte de la clave
+HISTORIAL_CLAVE = 6
+# Entradas más recientes del mismo contexto que se comparan por similitud en cada fallo
+CHAT_CACHE_CANDIDATES = int(os.getenv("CHAT_CACHE_CANDIDATES", "64"))
+
+_cache: "OrderedDict[str, dict]" = OrderedDict()
+_metricas = {"hits": 0, "hits_semanticos": 0, "misses": 0, "errores_embedding": 0}
+
+def _hash(texto: str) -> str:
+    return hashlib.sha256(texto.encode()).hexdigest()
+
+def _contexto(historial: Optional[List[dict]]) -> str:
+    mensajes = (historial or [])[-HISTORIAL_CLAVE:]
+    return _hash("\n".join(f"{m.get('role')}:{normalizar_texto(m.get('content'))}" for m in mensajes))
+
+def _normalizar_vector(vector: List[float]) -> Optional[tuple]:
+    # Con vectores unitarios la similitud coseno se reduce al producto escalar
+    norma = math.sqrt(sum(x * x for x in vector))
+    return tuple(x / norma for x in vector) if norma else None
+
+def _producto(a: tuple, b: tuple) -> float:
+    return sum(map(operator.mul, a, b))
+
+def _vigente(clave: str) -> Optional[dict]:
+    entrada = _cache.get(clave)
+    if entrada is None:
+        return None
+    if entrada["expira"] <= time.time():
+        del _cache[clave]
+        return None
+    _cache.move_to_end(clave)
+    return entrada
+
+def _candidatos(contexto: str) -> List[tuple]:
+    # Las más recientes primero; se copian los vectores para compararlos fuera del bucle
+    candidatos = []
+    ahora = time.time()
+    for clave in reversed(_cache):
+        entrada = _cache[clave]
+        if entrada["contexto"] == contexto and entrada["embedding"] is not None and entrada["expira"] > ahora:
+            candidatos.append((clave, entrada["embedding"]))
+            if len(candidatos) == CHAT_CACHE_CANDIDATES:
+                break
+    return candidatos
+
+def _mas_similar(embedding: tuple, candidatos: List[tuple]) -> Optional[str]:
+    mejor, mejor_similitud = None, CHAT_CACHE_SIMILARITY
+    for clave, vector in candidatos:
+        similitud = _producto(embedding, vector)
+        if similitud >= mejor_similitud:
+            mejor, mejor_similitud = clave, similitud
+    return mejor
+
+async def _buscar_similar(contexto: str, embedding: tuple) -> Optional[dict]:
+    candidatos = _candidatos(contexto)
+    if not candidatos:
+        return None
+    # Comparar miles de dimensiones bloquearía el bucle de eventos
+    clave = await asyncio.get_running_loop().run_in_executor(None, _mas_similar, embedding, candidatos)
+    return _vigente(clave) if clave is not None else None
+
+async def buscar(
+    pregunta: str,
+    historial: Optional[List[dict]] = None,
+    embedder: Optional[Callable[[str], Awaitable[List[float]]]] = None
+) -> dict:
+    """
+    Busca la respuesta cacheada para la pregunta. Devuelve la consulta (clave, contexto,
+    embedding y respuesta, None si no hay acierto) para pasarla después a guardar().
+    """
+    texto = normalizar_texto(pregunta)
+    contexto = _contexto(historial)
+    consulta = {"clave": _hash(f"{contexto}|{texto}"), "contexto": contexto, "embedding": None, "respuesta": None}
+
+    entrada = _vigente(consulta["clave"])
+    if entrada is not None:
+        _metricas["hits"] += 1
+        consulta["respuesta"] = entrada["respuesta"]
+        return consulta
+
+    # El embedding solo se calcula si no hay coincidencia exacta
+    if embedder is not None and texto:
+        try:
+            consulta["embedding"] = _normalizar_vector(await embedder(texto) or [])
+        except Exception as e:
+            _metricas["errores_embedding"] += 1
+            print("Error calculando embedding para la caché del asistente:", e)
+        if consulta["embedding"]:
+            entrada = await _buscar_similar(contexto, consulta["embedding"])
+            if entrada is not None:
+                _metricas["hits_semanticos"] += 1
+                consulta["respuesta"] = entrada["respuesta"]
+                return consulta
+
+    _metricas["misses"] += 1
+    return consulta
+
+def guardar(consulta: dict, respuesta: str):
+    _cache[consulta["clave"]] = {
+        "respuesta": respuesta,
+        "contexto": consulta["contexto"],
+        "embedding": consulta["embedding"],
+        "expira": time.time() + CHAT_CACHE_TTL
+    }
+    _cache.move_to_end(consulta["clave"])
+    while len(_cache) > CHAT_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+def vaciar():
+    _cache.clear()
+
+def metricas() -> dict:
+    consultas = _metricas["hits"] + _metricas["hits_semanticos"] + _metricas["misses"]
+    aciertos = _metricas["hits"] + _metricas["hits_semanticos"]
+    return {
+        **_metricas,
+        "entradas": len(_cache),
+        "tasa_acierto": round(aciertos / consultas, 4) if consultas else 0.0
+    }
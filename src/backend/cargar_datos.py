@@ -1,6 +1,10 @@
 import json
 import os
+import asyncio
 from firebase_config import db
+from contadores import recalcular
+from indice_emails import indexar_emails_existentes
+from migraciones import indexar_respuestas_existentes
 
 # Ruta base a la carpeta "data" donde están los JSON
 BASE_PATH = os.path.join(os.path.dirname(__file__), "data")
@@ -24,6 +28,9 @@ def subir_coleccion(nombre_archivo, nombre_coleccion):
                     com_ref.set(comentario_data)
 
                     for respuesta_id, respuesta_data in respuestas.items():
+                        # articulo_id permite cargar el hilo con una consulta de grupo
+                        respuesta_data["articulo_id"] = doc_id
+                        respuesta_data["comentario_padre"] = comentario_id
                         com_ref.collection("respuestas").document(respuesta_id).set(respuesta_data)
 
             else:
@@ -32,6 +39,9 @@ def subir_coleccion(nombre_archivo, nombre_coleccion):
 
         print(f"✅ {len(data)} documentos subidos a '{nombre_coleccion}'")
 
+    # La carga masiva no pasa por los contadores: recalcular el total de la colección
+    asyncio.run(recalcular(nombre_coleccion))
+
 # Ejecutar para cada colección
 # subir_coleccion("usuarios.json", "usuarios")
 # subir_coleccion("productos.json", "productos")
@@ -46,6 +56,19 @@ def limpiar_fotos_google():
             print(f"Limpiando foto de usuario: {data.get('email', user.id)}")
             db.collection("usuarios").document(user.id).update({"foto": ""})
 
+# Crear el índice usuarios_por_email para los usuarios existentes (la migración de
+# arranque lo hace sola; esto permite lanzarla a mano)
+def indexar_emails():
+    total = indexar_emails_existentes()
+    print(f"Índice de emails actualizado ({total} usuarios)")
+
+# Añadir articulo_id a las respuestas existentes para la consulta de grupo de
+# GET /articulos/{id}/comentarios (la migración de arranque lo hace sola; esto permite
+# lanzarla a mano)
+def indexar_respuestas():
+    total = indexar_respuestas_existentes()
+    print(f"Respuestas de comentarios actualizadas ({total})")
+
 if __name__ == "__main__":
     limpiar_fotos_google()
     print("Limpieza completada.")
@@ -1,8 +1,15 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
 import ollama
-import re
+import json
+import os
+import cache_respuestas
+from indice_faq import IndiceFAQ
+from filtro_respuestas import respuesta_bloqueada, EscanerRespuesta
+from middleware import verify_admin, verify_token
+from planificador_asistente import planificador, AsistenteOcupado
 
 router = APIRouter()
 
@@ -89,58 +96,202 @@ INSTRUCCIONES GENERALES:
 - Enfócate en ayudar con los temas anteriores.
 """
 
+# Índice de recuperación sobre las entradas del FAQ: cada petición solo lleva las relevantes
+indice_faq = IndiceFAQ(ASSISTANT_CONTEXT)
+# Mensajes previos del historial que recibe el modelo (caben más al no enviar el FAQ entero)
+HISTORIAL_MODELO = 6
+
+MODELO = 'mistral:instruct'
+OPCIONES_MODELO = {
+    "num_predict": 500,  # Aumentado significativamente para respuestas más completas
+    "temperature": 0.5,
+    "top_k": 40,
+    "top_p": 0.9,
+    "repeat_penalty": 1.2,
+    "num_ctx": 2048,  # Contexto más amplio
+    "stop": []  # No parar en tokens específicos
+}
+# Limitar la respuesta a 1200 caracteres (permite respuestas completas)
+MAX_RESPUESTA = 1200
+
+RESPUESTA_FILTRADA = "Lo siento, solo puedo responder en español y de forma directa. ¿Puedes reformular tu pregunta?"
+RESPUESTA_FALLBACK = "Lo siento, no he podido generar una respuesta válida. Por favor, intenta de nuevo o contacta con soporte."
+RESPUESTA_OCUPADO = "El asistente está atendiendo muchas consultas en este momento. Inténtalo de nuevo en unos segundos."
+RESPUESTAS_NO_VALIDAS = ['no lo sé', 'no se', 'no sé', 'no tengo respuesta', 'no puedo responder', 'null', 'none']
+
+# Modelo de embeddings para la búsqueda por similitud en la caché (desactivada si no se define)
+MODELO_EMBEDDINGS = os.getenv("CHAT_CACHE_EMBEDDINGS_MODEL")
+
+# Cliente asíncrono: la generación no bloquea el event loop
+_ollama = ollama.AsyncClient()
+
+async def _embedding(texto: str):
+    response = await _ollama.embeddings(model=MODELO_EMBEDDINGS, prompt=texto)
+    return response['embedding']
+
+async def _buscar_en_cache(message: ChatMessage) -> dict:
+    # La clave de la caché se calcula sobre el mismo historial que recibe el modelo
+    return await cache_respuestas.buscar(
+        message.message,
+        (message.history or [])[-HISTORIAL_MODELO:],
+        _embedding if MODELO_EMBEDDINGS else None
+    )
+
+def _guardar_en_cache(consulta: dict, respuesta: str):
+    # Ni los fallos de generación ni las respuestas filtradas se cachean: la misma pregunta
+    # puede generar después una respuesta válida
+    if respuesta not in (RESPUESTA_FALLBACK, RESPUESTA_FILTRADA):
+        cache_respuestas.guardar(consulta, respuesta)
+
+def respuesta_no_valida(texto):
+    return not texto or texto.strip() == '' or texto.strip().lower() in RESPUESTAS_NO_VALIDAS
+
+def construir_mensajes(message: ChatMessage):
+    # Construir historial para el modelo (máximo HISTORIAL_MODELO previos)
+    history_msgs = []
+    if message.history:
+        history_msgs = message.history[-HISTORIAL_MODELO:]
+    
+    # La consulta de recuperación incluye la última pregunta previa para que las
+    # preguntas de seguimiento ("¿y cuánto cuesta?") encuentren su sección
+    consulta = message.message
+    previas = [m.get("content", "") for m in history_msgs if m.get("role") == "user"]
+    if previas:
+        consulta = f"{previas[-1]} {consulta}"
+    
+    # Mensajes para el modelo: contexto relevante, historial y mensaje actual
+    return [
+        {"role": "system", "content": indice_faq.construir_prompt(consulta)},
+        *history_msgs,
+        {"role": "user", "content": message.message}
+    ]
+
+async def _usuario(request: Request) -> str:
+    # Turno de la cola: el uid si la petición viene autenticada, si no la IP del cliente
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        try:
+            return (await verify_token(authorization.split("Bearer ")[-1]))['uid']
+        except Exception:
+            pass
+    return request.client.host if request.client else "anonimo"
+
+def _ocupado():
+    return HTTPException(status_code=503, detail=RESPUESTA_OCUPADO, headers={"Retry-After": "5"})
+
+def _evento(tipo: str, datos: dict) -> str:
+    return f"event: {tipo}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
 @router.post("/chat")
-async def chat(message: ChatMessage):
+async def chat(message: ChatMessage, request: Request):
     try:
-        # Construir historial para el modelo (máximo 3 previos)
-        history_msgs = []
-        if message.history:
-            # Solo los últimos 3 mensajes previos
-            history_msgs = message.history[-3:]
-        
-        # Mensajes para el modelo: contexto, historial y mensaje actual
-        model_messages = [
-            {"role": "system", "content": ASSISTANT_CONTEXT},
-            *history_msgs,
-            {"role": "user", "content": message.message}
-        ]
-        
-        response = ollama.chat(
-            model='mistral:instruct',
-            messages=model_messages,
-            options={
-                "num_predict": 500,  # Aumentado significativamente para respuestas más completas
-                "temperature": 0.5,
-                "top_k": 40,
-                "top_p": 0.9,
-                "repeat_penalty": 1.2,
-                "num_ctx": 2048,  # Contexto más amplio
-                "stop": []  # No parar en tokens específicos
-            }
-        )
-        assistant_response = response['message']['content']
+        consulta = await _buscar_en_cache(message)
+        if consulta["respuesta"] is not None:
+            return {"response": consulta["respuesta"]}
 
-        # --- FILTRO Y RECORTE DE RESPUESTA (menos estricto) ---
-        def contiene_ingles(texto):
-            # Solo bloquea si hay 5 o más palabras en inglés seguidas
-            palabras_ingles = r"the|and|you|for|with|that|this|have|from|are|your|example|help|issue|user|question|answer|doubt|imagine|each|unique|week|day|days|english|spanish|hello|hi|please|thank you|sorry|yes|no|can|could|would|should|will|may|might|must|shall|do|does|did|done|has|had|having|been|being|was|were|am|is|it|its|they|them|their|there|here|how|what|when|where|who|why|which|about|because|but|if|or|as|at|by|on|in|to|of|not|so|just|now|then|than|also|too|very|really|still|even|only|again|always|never|sometimes|often|usually|ever|once|twice|first|second|third|next|last|before|after|since|until|while|during|through|across|over|under|between|among|against|toward|upon|within|without|along|around|behind|beside|beyond|except|inside|outside|above|below|near|far|off|onto|into|upon|via|per|plus|minus|versus|vs|etc|etc\."
-            return bool(re.search(rf"((?:{palabras_ingles})[\s,.!?]*){5,}", texto, re.IGNORECASE))
+        async with planificador.turno(await _usuario(request)):
+            response = await _ollama.chat(
+                model=MODELO,
+                messages=construir_mensajes(message),
+                options=OPCIONES_MODELO
+            )
+        assistant_response = response['message']['content']
 
-        def contiene_roleplay(texto):
-            # Solo bloquea si detecta frases muy claras de roleplay
-            return bool(re.search(r"imagine that you are|supongamos que eres|act as|actúa como|let's pretend|escenario:|scenario:", texto, re.IGNORECASE))        # Limitar la respuesta a 1200 caracteres (permite respuestas completas)
-        if len(assistant_response) > 1200:
-            assistant_response = assistant_response[:1200] + "..."
+        if len(assistant_response) > MAX_RESPUESTA:
+            assistant_response = assistant_response[:MAX_RESPUESTA] + "..."
 
-        if contiene_ingles(assistant_response) or contiene_roleplay(assistant_response):
-            assistant_response = "Lo siento, solo puedo responder en español y de forma directa. ¿Puedes reformular tu pregunta?"
+        if respuesta_bloqueada(assistant_response):
+            assistant_response = RESPUESTA_FILTRADA
         
         # --- MENSAJE DE FALLBACK SI LA RESPUESTA NO ES VÁLIDA ---
-        if not assistant_response or assistant_response.strip() == '' or assistant_response.strip().lower() in ['no lo sé', 'no se', 'no sé', 'no tengo respuesta', 'no puedo responder', 'null', 'none']:
-            assistant_response = "Lo siento, no he podido generar una respuesta válida. Por favor, intenta de nuevo o contacta con soporte."
+        if respuesta_no_valida(assistant_response):
+            assistant_response = RESPUESTA_FALLBACK
 
+        _guardar_en_cache(consulta, assistant_response)
         return {"response": assistant_response}
+    except AsistenteOcupado:
+        raise _ocupado()
     except Exception as e:
         print("ERROR EN /chat:", e)
         # No exponer detalles del error interno al cliente
-        raise HTTPException(status_code=500, detail="Error interno del servidor. El asistente no está disponible temporalmente.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Error interno del servidor. El asistente no está disponible temporalmente.")
+
+async def _generar_stream(message: ChatMessage, usuario: str):
+    """
+    Eventos SSE: "token" con cada fragmento generado, "replace" si un filtro invalida
+    lo ya enviado (el cliente debe sustituir el texto) y "done" con la respuesta final.
+    """
+    texto = ""
+    escaner = EscanerRespuesta()
+    try:
+        consulta = await _buscar_en_cache(message)
+        if consulta["respuesta"] is not None:
+            # Respuesta ya conocida: se envía entera sin pasar por el modelo
+            yield _evento("token", {"token": consulta["respuesta"]})
+            yield _evento("done", {"response": consulta["respuesta"]})
+            return
+
+        # El turno se mantiene mientras dura la generación
+        async with planificador.turno(usuario):
+            stream = await _ollama.chat(
+                model=MODELO,
+                messages=construir_mensajes(message),
+                options=OPCIONES_MODELO,
+                stream=True
+            )
+            try:
+                async for parte in stream:
+                    token = parte['message']['content']
+                    if not token:
+                        continue
+                    recortado = len(texto) + len(token) > MAX_RESPUESTA
+                    if recortado:
+                        token = token[:MAX_RESPUESTA - len(texto)] + "..."
+                    texto += token
+
+                    # Filtro incremental: cada fragmento se analiza una sola vez
+                    if escaner.alimentar(token):
+                        yield _evento("replace", {"response": RESPUESTA_FILTRADA})
+                        yield _evento("done", {"response": RESPUESTA_FILTRADA})
+                        return
+
+                    yield _evento("token", {"token": token})
+                    if recortado:
+                        break
+            finally:
+                # Si el cliente se desconecta o se corta la respuesta, dejar de generar
+                if hasattr(stream, "aclose"):
+                    await stream.aclose()
+
+        if escaner.terminar():
+            texto = RESPUESTA_FILTRADA
+            yield _evento("replace", {"response": texto})
+        elif respuesta_no_valida(texto):
+            yield _evento("replace", {"response": RESPUESTA_FALLBACK})
+            texto = RESPUESTA_FALLBACK
+        _guardar_en_cache(consulta, texto)
+        yield _evento("done", {"response": texto})
+    except AsistenteOcupado:
+        yield _evento("error", {"detail": RESPUESTA_OCUPADO, "busy": True})
+    except Exception as e:
+        print("ERROR EN /chat/stream:", e)
+        yield _evento("error", {"detail": "Error interno del servidor. El asistente no está disponible temporalmente."})
+
+@router.post("/chat/stream")
+async def chat_stream(message: ChatMessage, request: Request):
+    # Con la cola llena se responde ya con 503 en lugar de abrir el stream
+    if planificador.lleno():
+        raise _ocupado()
+    return StreamingResponse(
+        _generar_stream(message, await _usuario(request)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/chat/cache/stats")
+async def chat_cache_stats(admin: dict = Depends(verify_admin)):
+    return cache_respuestas.metricas()
+
+@router.get("/chat/queue/stats")
+async def chat_queue_stats(admin: dict = Depends(verify_admin)):
+    return planificador.metricas()
@@ -1,13 +1,32 @@
-from fastapi import APIRouter, HTTPException, Depends, Body, Header
+from fastapi import APIRouter, HTTPException, Depends, Body, Header, Query, Response
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from firebase_config import db
+from firestore_async import get_doc, get_all_docs, stream_docs, update_doc, delete_doc, commit_batch, run_transaction
 from datetime import datetime
 from uuid import uuid4
-from firebase_admin import auth
-from middleware import get_token_header
+import time
+import logging
+from pydantic import ValidationError
+from firebase_admin import firestore
+from middleware import get_token_header, verify_token
+from paginacion import NEXT_CURSOR_HEADER, MAX_PAGE_SIZE
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# Los mensajes de cada chat se guardan en la subcolección chats/{id}/messages y el
+# documento del chat solo lleva una vista previa acotada, así añadir un mensaje cuesta
+# lo mismo con 5 mensajes que con 5000. Los chats antiguos con el array "messages"
+# embebido se pasan a la subcolección la primera vez que se les añade un mensaje.
+MESSAGES_SUBCOLLECTION = "messages"
+PREVIEW_SIZE = 10
+MAX_BATCH_WRITES = 500
+# Campos del listado de chats: nunca se descargan los mensajes
+SUMMARY_FIELDS = ["id", "name", "created_at", "updated_at", "message_count", "preview"]
+PREVIEW_CONTENT_LENGTH = 120
+# Límite de chats por migración desde localStorage
+MAX_MIGRATE_CHATS = 1000
 
 # Modelos
 class Message(BaseModel):
@@ -25,10 +44,106 @@ class ChatRename(BaseModel):
 class ChatMigrate(BaseModel):
     chats: List[dict]  # Recibe la estructura completa de los chats desde localStorage
 
+def message_id(sequence: int) -> str:
+    # IDs ordenables: el orden por __name__ es el orden de inserción
+    return f"{sequence:020d}-{uuid4().hex[:8]}"
+
+def legacy_message_id(position: int) -> str:
+    # Deterministas: si dos peticiones migran el mismo chat a la vez escriben los mismos
+    # documentos en lugar de duplicar el historial
+    return f"{position:020d}-legacy"
+
+def messages_ref(chat_id: str):
+    return db.collection("chats").document(chat_id).collection(MESSAGES_SUBCOLLECTION)
+
+def message_writes(chat_id: str, messages: List[dict], first_sequence: int) -> List[tuple]:
+    """Escrituras (ref, datos) para guardar los mensajes en la subcolección"""
+    return [
+        (messages_ref(chat_id).document(message_id(first_sequence + i)), msg)
+        for i, msg in enumerate(messages)
+    ]
+
+async def commit_writes(writes: List[tuple]):
+    # Un batch de Firestore admite como máximo 500 operaciones
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for ref, data in writes[start:start + MAX_BATCH_WRITES]:
+            batch.set(ref, data)
+        await commit_batch(batch)
+
+async def load_message_page(chat_id: str, limit: int, before: Optional[str] = None) -> tuple:
+    """Página de mensajes (más recientes primero, devuelta en orden cronológico) y cursor"""
+    query = messages_ref(chat_id).order_by("__name__", direction="DESCENDING")
+    if before:
+        query = query.where("__name__", "<", messages_ref(chat_id).document(before))
+    docs = await stream_docs(query.limit(limit))
+    cursor = docs[-1].id if len(docs) == limit else None
+    return [{"id": d.id, **d.to_dict()} for d in reversed(docs)], cursor
+
+def chat_summary(chat_id: str, chat: dict) -> dict:
+    preview = chat.get("preview") or chat.get("messages") or []
+    last = preview[-1] if preview else None
+    return {
+        "id": chat.get("id", chat_id),
+        "name": chat.get("name"),
+        "created_at": chat.get("created_at"),
+        "updated_at": chat.get("updated_at"),
+        "message_count": chat.get("message_count", len(chat.get("messages", []))),
+        "last_message": {
+            "role": last.get("role"),
+            "content": (last.get("content") or "")[:PREVIEW_CONTENT_LENGTH],
+            "timestamp": last.get("timestamp")
+        } if last else None
+    }
+
+def _finish_legacy_migration_tx(transaction, doc_ref):
+    snapshot = doc_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail="Chat no encontrado")
+    chat = snapshot.to_dict()
+    if "messages" not in chat:
+        # Otra petición terminó la migración
+        return chat
+    legacy = chat.pop("messages")
+    chat["preview"] = legacy[-PREVIEW_SIZE:]
+    chat["message_count"] = len(legacy)
+    transaction.update(doc_ref, {
+        "messages": firestore.DELETE_FIELD,
+        "preview": chat["preview"],
+        "message_count": chat["message_count"]
+    })
+    return chat
+
+async def migrate_legacy_messages(doc_ref, chat: dict) -> dict:
+    """Pasa los mensajes embebidos de un chat antiguo a la subcolección"""
+    legacy = chat["messages"]
+    # Los mensajes pueden pasar de las 500 escrituras de una transacción: se copian por
+    # lotes con IDs deterministas y solo el cierre (quitar el array) es transaccional
+    await commit_writes([
+        (messages_ref(doc_ref.id).document(legacy_message_id(i)), msg)
+        for i, msg in enumerate(legacy)
+    ])
+    return await run_transaction(_finish_legacy_migration_tx, doc_ref)
+
+def _append_message_tx(transaction, doc_ref, msg: dict):
+    # La vista previa se recalcula con el documento leído en la transacción: dos mensajes
+    # simultáneos no pueden pisarse la preview
+    snapshot = doc_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise HTTPException(status_code=404, detail="Chat no encontrado")
+    chat = snapshot.to_dict()
+    for ref, data in message_writes(doc_ref.id, [msg], time.time_ns()):
+        transaction.set(ref, data)
+    transaction.update(doc_ref, {
+        "preview": (chat.get("preview", []) + [msg])[-PREVIEW_SIZE:],
+        "message_count": firestore.Increment(1),
+        "updated_at": datetime.utcnow().isoformat()
+    })
+
 # Utilidad para obtener el UID del usuario autenticado desde el token
 async def get_current_uid(token: str = Depends(get_token_header)):
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_token(token)
         return decoded_token['uid']
     except Exception:
         raise HTTPException(status_code=401, detail="Token inválido o expirado")
@@ -39,67 +154,145 @@ async def create_chat(chat: ChatCreate = Body(...), uid: str = Depends(get_curre
     now = datetime.utcnow().isoformat()
     chat_id = str(uuid4())
     name = chat.name or f"Chat {datetime.now().strftime('%d/%m/%Y %H:%M')}"
+    messages = [m.dict() for m in chat.messages] if chat.messages else []
     chat_doc = {
         "id": chat_id,
         "user": uid,
         "name": name,
         "created_at": now,
         "updated_at": now,
-        "messages": [m.dict() for m in chat.messages] if chat.messages else []
+        "preview": messages[-PREVIEW_SIZE:],
+        "message_count": len(messages)
     }
-    db.collection("chats").document(chat_id).set(chat_doc)
-    return chat_doc
+    await commit_writes(
+        [(db.collection("chats").document(chat_id), chat_doc)]
+        + message_writes(chat_id, messages, time.time_ns())
+    )
+    return {**chat_doc, "messages": messages}
 
 # 2. Obtener todos los chats del usuario
 @router.get("/chats")
-async def get_chats(uid: str = Depends(get_current_uid)):
-    chats_ref = db.collection("chats").where("user", "==", uid).order_by("updated_at", direction="DESCENDING").stream()
-    chats = [c.to_dict() for c in chats_ref]
-    return chats
+async def get_chats(
+    response: Response,
+    uid: str = Depends(get_current_uid),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = Query(None)
+):
+    # Solo los campos del resumen: ni el historial ni el array de los chats antiguos
+    query = db.collection("chats").where("user", "==", uid).order_by("updated_at", direction="DESCENDING").select(SUMMARY_FIELDS)
+    if start_after:
+        cursor = await get_doc(db.collection("chats").document(start_after))
+        if not cursor.exists or cursor.get("user") != uid:
+            raise HTTPException(status_code=400, detail="Cursor de paginación no válido")
+        query = query.start_after(cursor)
+    if limit:
+        query = query.limit(limit)
+    chats_ref = await stream_docs(query)
+    if limit and len(chats_ref) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = chats_ref[-1].id
+    
+    summaries = {c.id: c.to_dict() for c in chats_ref}
+    # Chats antiguos sin contador: se leen completos y se migran a la subcolección, que
+    # deja guardados la vista previa y el contador para los siguientes listados
+    legacy = [db.collection("chats").document(chat_id) for chat_id, chat in summaries.items() if "message_count" not in chat]
+    if legacy:
+        for doc in await get_all_docs(legacy):
+            if not doc.exists:
+                continue
+            chat = doc.to_dict()
+            if "messages" in chat:
+                try:
+                    chat = await migrate_legacy_messages(doc.reference, chat)
+                except Exception as e:
+                    # El resumen se puede dar igualmente con el array embebido
+                    logger.error(f"Error migrando el chat {doc.id}: {e}")
+            summaries[doc.id] = chat
+    return [chat_summary(c.id, summaries[c.id]) for c in chats_ref]
 
-# 3. Obtener los mensajes de un chat
+# 3. Obtener un chat: sus datos y la página de mensajes más recientes. El resto del
+# historial se pide a /chats/{id}/messages con el cursor (next_cursor o X-Next-Cursor)
 @router.get("/chats/{chat_id}")
-async def get_chat(chat_id: str, uid: str = Depends(get_current_uid)):
-    doc = db.collection("chats").document(chat_id).get()
+async def get_chat(
+    chat_id: str,
+    response: Response,
+    uid: str = Depends(get_current_uid),
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)
+):
+    doc_ref = db.collection("chats").document(chat_id)
+    doc = await get_doc(doc_ref)
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     chat = doc.to_dict()
     if chat.get("user") != uid:
         raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
+    if "messages" in chat:
+        chat = await migrate_legacy_messages(doc_ref, chat)
+    
+    chat["messages"], cursor = await load_message_page(chat_id, limit)
+    chat["next_cursor"] = cursor
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
     return chat
 
+# Mensajes de un chat por páginas, de los más recientes a los más antiguos.
+# Cada página se devuelve en orden cronológico y el cursor (cabecera X-Next-Cursor)
+# es el id del mensaje más antiguo, que se pasa como "before" para la anterior.
+@router.get("/chats/{chat_id}/messages")
+async def get_chat_messages(
+    chat_id: str,
+    response: Response,
+    uid: str = Depends(get_current_uid),
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = Query(None)
+):
+    doc_ref = db.collection("chats").document(chat_id)
+    doc = await get_doc(doc_ref)
+    if not doc.exists:
+        raise HTTPException(status_code=404, detail="Chat no encontrado")
+    chat = doc.to_dict()
+    if chat.get("user") != uid:
+        raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
+    if "messages" in chat:
+        await migrate_legacy_messages(doc_ref, chat)
+    
+    messages, cursor = await load_message_page(chat_id, limit, before)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
+    return messages
+
 # 4. Añadir mensaje a un chat
 @router.post("/chats/{chat_id}/messages")
 async def add_message(chat_id: str, message: Message = Body(...), uid: str = Depends(get_current_uid)):
     doc_ref = db.collection("chats").document(chat_id)
-    doc = doc_ref.get()
+    doc = await get_doc(doc_ref)
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     chat = doc.to_dict()
     if chat.get("user") != uid:
         raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
-    messages = chat.get("messages", [])
     msg = message.dict()
     if not msg.get("timestamp"):
         msg["timestamp"] = datetime.utcnow().isoformat()
-    messages.append(msg)
-    doc_ref.update({
-        "messages": messages,
-        "updated_at": datetime.utcnow().isoformat()
-    })
+    
+    if "messages" in chat:
+        # Chat antiguo: mover los mensajes embebidos a la subcolección antes del nuevo
+        await migrate_legacy_messages(doc_ref, chat)
+    
+    # Nuevo mensaje y vista previa en una transacción (sin reescribir el historial)
+    await run_transaction(_append_message_tx, doc_ref, msg)
     return {"success": True}
 
 # 5. Renombrar un chat
 @router.patch("/chats/{chat_id}")
 async def rename_chat(chat_id: str, data: ChatRename, uid: str = Depends(get_current_uid)):
     doc_ref = db.collection("chats").document(chat_id)
-    doc = doc_ref.get()
+    doc = await get_doc(doc_ref)
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     chat = doc.to_dict()
     if chat.get("user") != uid:
         raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
-    doc_ref.update({
+    await update_doc(doc_ref, {
         "name": data.name,
         "updated_at": datetime.utcnow().isoformat()
     })
@@ -109,31 +302,85 @@ async def rename_chat(chat_id: str, data: ChatRename, uid: str = Depends(get_cur
 @router.delete("/chats/{chat_id}")
 async def delete_chat(chat_id: str, uid: str = Depends(get_current_uid)):
     doc_ref = db.collection("chats").document(chat_id)
-    doc = doc_ref.get()
+    doc = await get_doc(doc_ref)
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     chat = doc.to_dict()
     if chat.get("user") != uid:
         raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
-    doc_ref.delete()
+    # Borrar primero los mensajes de la subcolección, por lotes
+    messages = await stream_docs(messages_ref(chat_id).select([]))
+    for start in range(0, len(messages), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for message_doc in messages[start:start + MAX_BATCH_WRITES]:
+            batch.delete(message_doc.reference)
+        await commit_batch(batch)
+    await delete_doc(doc_ref)
     return {"success": True}
 
+def validate_migrated_chat(index: int, chat) -> dict:
+    """Normaliza un chat de localStorage; 400 con su posición si no es válido"""
+    if not isinstance(chat, dict):
+        raise HTTPException(status_code=400, detail=f"Chat {index}: formato no válido")
+    messages = chat.get("messages") or []
+    if not isinstance(messages, list):
+        raise HTTPException(status_code=400, detail=f"Chat {index}: 'messages' debe ser una lista")
+    try:
+        # El widget guarda el rol como "type"; se aceptan ambas formas
+        messages = [
+            Message(role=m.get("role") or m.get("type"), content=m.get("content"), timestamp=m.get("timestamp")).dict()
+            for m in messages
+        ]
+    except (AttributeError, ValidationError):
+        raise HTTPException(status_code=400, detail=f"Chat {index}: hay mensajes sin 'role' o 'content' válidos")
+    name = chat.get("name")
+    return {
+        "name": name if isinstance(name, str) and name.strip() else None,
+        "created_at": chat.get("created_at") if isinstance(chat.get("created_at"), str) else None,
+        "messages": messages
+    }
+
 # 7. Migrar chats desde localStorage
 @router.post("/chats/migrate")
 async def migrate_chats(data: ChatMigrate = Body(...), uid: str = Depends(get_current_uid)):
+    if len(data.chats) > MAX_MIGRATE_CHATS:
+        raise HTTPException(status_code=400, detail=f"Se pueden migrar como máximo {MAX_MIGRATE_CHATS} chats")
+    # Validar todo antes de escribir nada
+    chats = [validate_migrated_chat(i, chat) for i, chat in enumerate(data.chats)]
+    
     now = datetime.utcnow().isoformat()
     migrated = []
-    for chat in data.chats:
+    writes = []
+    for chat in chats:
         chat_id = str(uuid4())
-        name = chat.get("name") or f"Chat {datetime.now().strftime('%d/%m/%Y %H:%M')}"
+        messages = chat["messages"]
         chat_doc = {
             "id": chat_id,
             "user": uid,
-            "name": name,
-            "created_at": chat.get("created_at", now),
+            "name": chat["name"] or f"Chat {datetime.now().strftime('%d/%m/%Y %H:%M')}",
+            "created_at": chat["created_at"] or now,
             "updated_at": now,
-            "messages": chat.get("messages", [])
+            "preview": messages[-PREVIEW_SIZE:],
+            "message_count": len(messages)
         }
-        db.collection("chats").document(chat_id).set(chat_doc)
-        migrated.append(chat_doc)
-    return {"migrated": migrated} 
\ No newline at end of file
+        # Mensajes antes que el chat: si un lote falla, no queda un chat sin historial
+        writes += message_writes(chat_id, messages, time.time_ns())
+        writes.append((db.collection("chats").document(chat_id), chat_doc))
+        migrated.append({**chat_doc, "messages": messages})
+    
+    # Todas las escrituras en lotes de hasta 500 operaciones
+    chunks = []
+    total_chunks = (len(writes) + MAX_BATCH_WRITES - 1) // MAX_BATCH_WRITES
+    for number, start in enumerate(range(0, len(writes), MAX_BATCH_WRITES), 1):
+        chunk = writes[start:start + MAX_BATCH_WRITES]
+        try:
+            await commit_writes(chunk)
+        except Exception as e:
+            logger.error(f"Migración de chats de {uid}: fallo en el lote {number}/{total_chunks}: {e}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error al migrar los chats (lote {number} de {total_chunks}). Se guardaron {start} de {len(writes)} escrituras."
+            )
+        chunks.append({"chunk": number, "writes": len(chunk)})
+        logger.info(f"Migración de chats de {uid}: lote {number}/{total_chunks} ({start + len(chunk)}/{len(writes)} escrituras)")
+    return {"migrated": migrated, "chunks": chunks}
@@ -2,8 +2,11 @@ from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime, timedelta
+from firebase_admin import firestore
 from firebase_config import db
+from firestore_async import get_doc, stream_docs, set_doc, update_doc, delete_doc, commit_batch, run_transaction
 from middleware import get_current_uid
+from borrado_cascada import programar_borrado, consulta
 
 router = APIRouter()
 
@@ -17,10 +20,114 @@ class DirectChatCreate(BaseModel):
 class EditMessageBody(BaseModel):
     content: str
 
+# Los mensajes no leídos se mantienen por participante en el propio documento del chat
+# (unread_counts.{uid}), así la bandeja de entrada se resuelve con una sola consulta.
+def unread_field(uid: str) -> str:
+    return f"unread_counts.{uid}"
+
+# Marca de agua de lectura: timestamp del último mensaje que el usuario ha leído
+def last_read_field(uid: str) -> str:
+    return f"last_read_at.{uid}"
+
+# Máximo de mensajes marcados por lectura (una transacción admite 500 escrituras)
+READ_RECEIPTS_LIMIT = 200
+
+# Chats creados antes de existir unread_counts: el primer Increment de un envío o el 0
+# de una lectura crean un mapa parcial, así que lo que se comprueba es que cada
+# participante tenga su clave, no que exista el mapa.
+def missing_unread_counts(chat_data: dict) -> List[str]:
+    unread_counts = chat_data.get("unread_counts") or {}
+    return [p for p in chat_data.get("participants", []) if p not in unread_counts]
+
+# Cálculo completo de los contadores que faltan (solo se hace una vez por participante).
+# Solo lee: las escrituras las añade quien lo llama, dentro de la misma transacción.
+def _missing_unread_updates(transaction, chat_id: str, chat_data: dict) -> dict:
+    missing = missing_unread_counts(chat_data)
+    if not missing:
+        return {}
+    counts = {p: 0 for p in missing}
+    query = db.collection("direct_messages").where("chat_id", "==", chat_id)
+    for msg in query.stream(transaction=transaction):
+        msg_data = msg.to_dict()
+        for p in missing:
+            if msg_data.get("sender") != p and p not in msg_data.get("read_by", []):
+                counts[p] += 1
+    return {unread_field(p): count for p, count in counts.items()}
+
+def _backfill_unread_tx(transaction, chat_id):
+    chat_ref = db.collection("direct_chats").document(chat_id)
+    chat = chat_ref.get(transaction=transaction)
+    if not chat.exists:
+        return {}
+    chat_data = chat.to_dict()
+    unread_counts = dict(chat_data.get("unread_counts") or {})
+    updates = _missing_unread_updates(transaction, chat_id, chat_data)
+    if updates:
+        transaction.update(chat_ref, updates)
+        unread_counts.update({field.split(".", 1)[1]: count for field, count in updates.items()})
+    return unread_counts
+
+async def backfill_unread_counts(chat_id: str) -> dict:
+    """Completa los contadores de los participantes sin clave en unread_counts"""
+    return await run_transaction(_backfill_unread_tx, chat_id)
+
+def _delete_message_tx(transaction, msg_ref, msg_data):
+    chat_ref = db.collection("direct_chats").document(msg_data["chat_id"])
+    chat = chat_ref.get(transaction=transaction)
+    transaction.delete(msg_ref)
+    if not chat.exists:
+        return
+    chat_data = chat.to_dict()
+    unread_counts = chat_data.get("unread_counts") or {}
+    last_read_at = chat_data.get("last_read_at") or {}
+    chat_update = {}
+    for p, count in unread_counts.items():
+        if p == msg_data["sender"] or p in msg_data.get("read_by", []) or count <= 0:
+            continue
+        # Anterior a la marca de agua de lectura: ya estaba leído
+        if last_read_at.get(p) and msg_data.get("timestamp") and msg_data["timestamp"] <= last_read_at[p]:
+            continue
+        chat_update[unread_field(p)] = count - 1
+    if chat_update:
+        transaction.update(chat_ref, chat_update)
+
+def _mark_read_tx(transaction, chat_id, uid):
+    chat_ref = db.collection("direct_chats").document(chat_id)
+    chat = chat_ref.get(transaction=transaction)
+    if not chat.exists:
+        raise HTTPException(status_code=404, detail="Chat no encontrado")
+    chat_data = chat.to_dict()
+    if uid not in chat_data["participants"]:
+        raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
+    # Nada pendiente: evitar escrituras en cada evento "read" del WebSocket
+    if (chat_data.get("unread_counts") or {}).get(uid) == 0:
+        return 0
+    # Chat antiguo: completar antes el contador del resto de participantes
+    chat_update = _missing_unread_updates(transaction, chat_id, chat_data)
+    chat_update.pop(unread_field(uid), None)
+    # Solo los mensajes posteriores a la última lectura
+    query = db.collection("direct_messages").where("chat_id", "==", chat_id)
+    last_read_at = (chat_data.get("last_read_at") or {}).get(uid)
+    if last_read_at:
+        query = query.where("timestamp", ">", last_read_at)
+    query = query.order_by("timestamp", direction="DESCENDING").limit(READ_RECEIPTS_LIMIT)
+    messages = list(query.stream(transaction=transaction))
+    updated_count = 0
+    for msg in messages:
+        msg_data = msg.to_dict()
+        if msg_data.get("sender") != uid and uid not in msg_data.get("read_by", []):
+            transaction.update(msg.reference, {"read_by": firestore.ArrayUnion([uid])})
+            updated_count += 1
+    chat_update[unread_field(uid)] = 0
+    if messages:
+        chat_update[last_read_field(uid)] = messages[0].to_dict().get("timestamp")
+    transaction.update(chat_ref, chat_update)
+    return updated_count
+
 @router.post("/direct-chats")
 async def create_direct_chat(chat: DirectChatCreate, uid: str = Depends(get_current_uid)):
     # Verificar que el participante existe
-    participant = db.collection("usuarios").document(chat.participant_id).get()
+    participant = await get_doc(db.collection("usuarios").document(chat.participant_id))
     if not participant.exists:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
@@ -29,9 +136,9 @@ async def create_direct_chat(chat: DirectChatCreate, uid: str = Depends(get_curr
     participants_key = f"{participants[0]}_{participants[1]}"
     
     # Verificar que no existe ya un chat entre estos usuarios
-    existing_chat = db.collection("direct_chats").where(
+    existing_chat = await get_doc(db.collection("direct_chats").where(
         "participants_key", "==", participants_key
-    ).limit(1).get()
+    ).limit(1))
     
     if existing_chat:
         return existing_chat[0].to_dict()
@@ -42,35 +149,29 @@ async def create_direct_chat(chat: DirectChatCreate, uid: str = Depends(get_curr
         "participants_key": participants_key,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow(),
-        "last_message": None
+        "last_message": None,
+        "unread_counts": {p: 0 for p in participants}
     }
     
     chat_ref = db.collection("direct_chats").document()
-    chat_ref.set(chat_data)
+    await set_doc(chat_ref, chat_data)
     
     return {**chat_data, "id": chat_ref.id}
 
 @router.get("/direct-chats")
 async def get_user_chats(uid: str = Depends(get_current_uid)):
-    chats = db.collection("direct_chats").where(
+    chats = await stream_docs(db.collection("direct_chats").where(
         "participants", "array_contains", uid
-    ).order_by("updated_at", direction="DESCENDING").stream()
+    ).order_by("updated_at", direction="DESCENDING"))
     
     result = []
     for chat in chats:
         chat_data = {"id": chat.id, **chat.to_dict()}
         
-        # Obtener todos los mensajes de este chat y filtrar en memoria
-        all_messages = db.collection("direct_messages").where(
-            "chat_id", "==", chat.id
-        ).stream()
-        
-        unread_count = 0
-        for msg in all_messages:
-            msg_data = msg.to_dict()
-            # Solo contar mensajes que no son del usuario actual y que no ha leído
-            if msg_data.get("sender") != uid and uid not in msg_data.get("read_by", []):
-                unread_count += 1
+        # El contador se mantiene en send_message / mark_chat_as_read
+        if missing_unread_counts(chat_data):
+            chat_data["unread_counts"] = await backfill_unread_counts(chat.id)
+        unread_count = max((chat_data.get("unread_counts") or {}).get(uid, 0), 0)
         
         chat_data["has_unread_messages"] = unread_count > 0
         chat_data["unread_count"] = unread_count
@@ -80,44 +181,83 @@ async def get_user_chats(uid: str = Depends(get_current_uid)):
 
 @router.post("/direct-chats/{chat_id}/messages")
 async def send_message(chat_id: str, message: DirectMessage, uid: str = Depends(get_current_uid)):
-    # Verificar que el chat existe y el usuario es participante
-    chat = db.collection("direct_chats").document(chat_id).get()
+    participants = await get_chat_participants(chat_id, uid)
+    return await save_direct_message(chat_id, participants, uid, message.content, message.type)
+
+async def get_chat_participants(chat_id: str, uid: str) -> List[str]:
+    """Participantes del chat; 404 si no existe y 403 si el usuario no participa"""
+    chat = await get_doc(db.collection("direct_chats").document(chat_id))
     if not chat.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     
     chat_data = chat.to_dict()
     if uid not in chat_data["participants"]:
         raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
+    # Antes del primer Increment de un envío, para no perder los no leídos antiguos
+    if missing_unread_counts(chat_data):
+        await backfill_unread_counts(chat_id)
+    return chat_data["participants"]
+
+async def save_direct_message(chat_id: str, participants: List[str], uid: str, content: str, message_type: str = "text") -> dict:
+    """
+    Guarda un mensaje de un participante ya verificado. Lo usan el endpoint REST y
+    el WebSocket, que comprueba la participación una sola vez al conectar.
+    """
+    return (await save_direct_messages(chat_id, participants, [(uid, content, message_type)]))[0]
+
+async def save_direct_messages(chat_id: str, participants: List[str], messages: List[tuple]) -> List[dict]:
+    """
+    Guarda en orden varios mensajes (sender, content, type) de un chat con un único
+    batch y una sola actualización de last_message y de los contadores de no leídos.
+    """
+    batch = db.batch()
+    saved = []
+    unread = {p: 0 for p in participants}
+    last_timestamp = None
+    for sender, content, message_type in messages:
+        # Timestamps estrictamente crecientes para conservar el orden al consultar
+        timestamp = datetime.utcnow()
+        if last_timestamp is not None and timestamp <= last_timestamp:
+            timestamp = last_timestamp + timedelta(microseconds=1)
+        last_timestamp = timestamp
+        message_data = {
+            "chat_id": chat_id,
+            "sender": sender,
+            "content": content,
+            "type": message_type,
+            "timestamp": timestamp,
+            "read_by": [sender]
+        }
+        message_ref = db.collection("direct_messages").document()
+        batch.set(message_ref, message_data)
+        saved.append({**message_data, "id": message_ref.id})
+        for participant in participants:
+            if participant != sender:
+                unread[participant] += 1
     
-    # Crear mensaje
-    message_data = {
-        "chat_id": chat_id,
-        "sender": uid,
-        "content": message.content,
-        "type": message.type,
-        "timestamp": datetime.utcnow(),
-        "read_by": [uid]
-    }
-    
-    message_ref = db.collection("direct_messages").document()
-    message_ref.set(message_data)
-    
-    # Actualizar último mensaje del chat
-    db.collection("direct_chats").document(chat_id).update({
+    # Guardar los mensajes, actualizar el último mensaje e incrementar los no leídos
+    # del resto de participantes en una sola escritura atómica
+    last = saved[-1]
+    chat_update = {
         "last_message": {
-            "content": message.content,
-            "sender": uid,
-            "timestamp": message_data["timestamp"]
+            "content": last["content"],
+            "sender": last["sender"],
+            "timestamp": last["timestamp"]
         },
-        "updated_at": message_data["timestamp"]
-    })
+        "updated_at": last["timestamp"]
+    }
+    for participant, count in unread.items():
+        if count:
+            chat_update[unread_field(participant)] = firestore.Increment(count)
+    batch.update(db.collection("direct_chats").document(chat_id), chat_update)
+    await commit_batch(batch)
     
-    return {**message_data, "id": message_ref.id}
+    return saved
 
 @router.get("/direct-chats/{chat_id}/messages")
 async def get_chat_messages(chat_id: str, uid: str = Depends(get_current_uid), limit: int = Query(50, ge=1, le=100), before: Optional[str] = Query(None)):
     # Verificar que el chat existe y el usuario es participante
-    chat = db.collection("direct_chats").document(chat_id).get()
+    chat = await get_doc(db.collection("direct_chats").document(chat_id))
     if not chat.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     chat_data = chat.to_dict()
@@ -130,36 +270,21 @@ async def get_chat_messages(chat_id: str, uid: str = Depends(get_current_uid), l
     if before:
         query = query.where("timestamp", "<", before)
     query = query.order_by("timestamp", direction="DESCENDING").limit(limit)
-    messages = query.stream()
+    messages = await stream_docs(query)
     return [{"id": msg.id, **msg.to_dict()} for msg in messages]
 
 @router.post("/direct-chats/{chat_id}/read")
 async def mark_chat_as_read(chat_id: str, uid: str = Depends(get_current_uid)):
-    # Verificar que el chat existe y el usuario es participante
-    chat = db.collection("direct_chats").document(chat_id).get()
-    if not chat.exists:
-        raise HTTPException(status_code=404, detail="Chat no encontrado")
-    chat_data = chat.to_dict()
-    if uid not in chat_data["participants"]:
-        raise HTTPException(status_code=403, detail="No tienes acceso a este chat")
-    # Buscar todos los mensajes no leídos por el usuario
-    messages = db.collection("direct_messages").where(
-        "chat_id", "==", chat_id
-    ).order_by("timestamp", direction="DESCENDING").limit(50).stream()
-    updated_count = 0
-    for msg in messages:
-        msg_data = msg.to_dict()
-        if uid not in msg_data.get("read_by", []):
-            new_read_by = msg_data.get("read_by", []) + [uid]
-            db.collection("direct_messages").document(msg.id).update({"read_by": new_read_by})
-            updated_count += 1
+    # Una única transacción: comprobar acceso, añadir el uid a read_by de los mensajes
+    # nuevos (ArrayUnion), mover la marca de agua y poner a cero los no leídos
+    updated_count = await run_transaction(_mark_read_tx, chat_id, uid)
     return {"updated": updated_count}
 
 @router.patch("/direct-messages/{message_id}")
 async def edit_direct_message(message_id: str, data: EditMessageBody, uid: str = Depends(get_current_uid)):
     content = data.content
     msg_ref = db.collection("direct_messages").document(message_id)
-    msg = msg_ref.get()
+    msg = await get_doc(msg_ref)
     if not msg.exists:
         raise HTTPException(status_code=404, detail="Mensaje no encontrado")
     msg_data = msg.to_dict()
@@ -173,25 +298,26 @@ async def edit_direct_message(message_id: str, data: EditMessageBody, uid: str =
         timestamp = timestamp.replace(tzinfo=None)
     if (datetime.utcnow() - timestamp) > timedelta(minutes=15):
         raise HTTPException(status_code=403, detail="Solo puedes editar mensajes durante los primeros 15 minutos tras enviarlos")
-    msg_ref.update({"content": content, "edited": True})
+    await update_doc(msg_ref, {"content": content, "edited": True})
     return {"success": True}
 
 @router.delete("/direct-messages/{message_id}")
 async def delete_direct_message(message_id: str, uid: str = Depends(get_current_uid)):
     msg_ref = db.collection("direct_messages").document(message_id)
-    msg = msg_ref.get()
+    msg = await get_doc(msg_ref)
     if not msg.exists:
         raise HTTPException(status_code=404, detail="Mensaje no encontrado")
     msg_data = msg.to_dict()
     if msg_data["sender"] != uid:
         raise HTTPException(status_code=403, detail="Solo puedes eliminar tus propios mensajes")
-    msg_ref.delete()
+    # Borrar el mensaje y descontarlo de los no leídos de quien no lo hubiera leído
+    await run_transaction(_delete_message_tx, msg_ref, msg_data)
     return {"success": True}
 
 @router.patch("/direct-chats/{chat_id}/leave")
 async def leave_direct_chat(chat_id: str, uid: str = Depends(get_current_uid)):
     chat_ref = db.collection("direct_chats").document(chat_id)
-    chat = chat_ref.get()
+    chat = await get_doc(chat_ref)
     if not chat.exists:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     chat_data = chat.to_dict()
@@ -200,12 +326,11 @@ async def leave_direct_chat(chat_id: str, uid: str = Depends(get_current_uid)):
     # Eliminar el usuario de los participantes
     new_participants = [p for p in chat_data["participants"] if p != uid]
     if new_participants:
-        chat_ref.update({"participants": new_participants})
+        await update_doc(chat_ref, {"participants": new_participants})
     else:
-        # Si no quedan participantes, elimina el chat y sus mensajes
-        chat_ref.delete()
-        # Elimina los mensajes asociados
-        messages = db.collection("direct_messages").where("chat_id", "==", chat_id).stream()
-        for msg in messages:
-            db.collection("direct_messages").document(msg.id).delete()
+        # Si no quedan participantes, elimina el chat y sus mensajes (en segundo plano, por lotes)
+        await delete_doc(chat_ref)
+        await programar_borrado(f"mensajes del chat {chat_id}", [
+            consulta("direct_messages", "chat_id", chat_id, recursivo=False)
+        ])
     return {"success": True} 
\ No newline at end of file
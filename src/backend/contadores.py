@@ -0,0 +1,128 @@
+import time
+import random
+from uuid import uuid4
+from typing import Dict, Iterable, List, Optional
+from firebase_admin import firestore
+from firebase_config import db
+from firestore_async import run_blocking, get_all_docs, commit_batch, run_transaction
+
+# Contadores distribuidos (sharded counters) para los totales del panel de administración.
+# Cada contador vive en contadores/{nombre}/shards/{0..NUM_SHARDS-1} y se incrementa con
+# firestore.Increment sobre un shard aleatorio, en el mismo batch/transacción que crea o
+# borra el documento contado. Leer un total cuesta NUM_SHARDS lecturas, sin importar
+# cuántos documentos tenga la colección. El documento contadores/{nombre} guarda la marca
+# "seeded" de la siembra inicial con count(): que existan shards no implica que el
+# contador incluya los documentos anteriores a este sistema.
+COUNTERS_COLLECTION = "contadores"
+NUM_SHARDS = 10
+# Duración del permiso para sembrar un contador (lo toma un solo worker a la vez)
+SEED_LEASE_SECONDS = 120
+
+# Colecciones contadas por el panel
+USUARIOS = "usuarios"
+PRODUCTOS = "productos"
+ARTICULOS = "articulos"
+COMPRAS = "compras"
+
+def _marcador(nombre: str):
+    return db.collection(COUNTERS_COLLECTION).document(nombre)
+
+def _shards(nombre: str):
+    return _marcador(nombre).collection("shards")
+
+def _random_shard(nombre: str):
+    return _shards(nombre).document(str(random.randrange(NUM_SHARDS)))
+
+def incrementar(writer, nombre: str, cantidad: int = 1):
+    """Añade el incremento del contador a un batch o transacción ya abiertos"""
+    writer.set(_random_shard(nombre), {"count": firestore.Increment(cantidad)}, merge=True)
+
+async def crear_con_contador(ref, data: dict, nombre: str, merge: bool = False):
+    """Crea el documento e incrementa el contador en una única escritura atómica"""
+    batch = db.batch()
+    batch.set(ref, data, merge=merge)
+    incrementar(batch, nombre, 1)
+    await commit_batch(batch)
+
+def _eliminar_si_existe(transaction, ref, nombre):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    transaction.delete(ref)
+    incrementar(transaction, nombre, -1)
+    return True
+
+async def eliminar_con_contador(ref, nombre: str) -> bool:
+    """Borra el documento y decrementa el contador solo si existía (transaccional)"""
+    return await run_transaction(_eliminar_si_existe, ref, nombre)
+
+def _tomar_siembra_tx(transaction, nombre: str, token: str, forzar: bool) -> bool:
+    marcador = _marcador(nombre).get(transaction=transaction)
+    datos = marcador.to_dict() if marcador.exists else {}
+    if datos.get("seeded") and not forzar:
+        return False
+    if datos.get("seeding") and datos.get("seeding_until", 0) > time.time():
+        # Otro worker está sembrando
+        return False
+    transaction.set(_marcador(nombre), {"seeding": token, "seeding_until": time.time() + SEED_LEASE_SECONDS}, merge=True)
+    return True
+
+def _cerrar_siembra_tx(transaction, nombre: str, token: str, ajuste: int) -> bool:
+    marcador = _marcador(nombre).get(transaction=transaction)
+    if not marcador.exists or marcador.to_dict().get("seeding") != token:
+        # El permiso caducó y lo tomó otro worker
+        return False
+    transaction.set(_shards(nombre).document("0"), {"count": firestore.Increment(ajuste)}, merge=True)
+    transaction.set(_marcador(nombre), {
+        "seeded": True,
+        "seeded_at": firestore.SERVER_TIMESTAMP,
+        "seeding": firestore.DELETE_FIELD,
+        "seeding_until": firestore.DELETE_FIELD
+    }, merge=True)
+    return True
+
+async def _suma_shards(nombre: str) -> int:
+    refs = [_shards(nombre).document(str(i)) for i in range(NUM_SHARDS)]
+    return sum(s.to_dict().get("count", 0) for s in await get_all_docs(refs) if s.exists)
+
+def _contar(nombre: str) -> int:
+    # Aggregation query: Firestore cuenta en servidor sin descargar los documentos
+    return db.collection(nombre).count().get()[0][0].value
+
+async def recalcular(nombre: str, forzar: bool = True) -> Optional[int]:
+    """
+    Ajusta el contador al count() de la colección y lo marca como sembrado. Devuelve el
+    total, o None si no se ha sembrado (ya lo estaba u otro worker tiene el permiso).
+    """
+    token = uuid4().hex
+    if not await run_transaction(_tomar_siembra_tx, nombre, token, forzar):
+        return None
+    # En lugar de sobrescribir los shards se suma la diferencia: los incrementos que
+    # lleguen mientras se cuenta se conservan
+    previo = await _suma_shards(nombre)
+    total = await run_blocking(_contar, nombre)
+    if not await run_transaction(_cerrar_siembra_tx, nombre, token, total - previo):
+        return None
+    return total
+
+async def sembrar_contadores(nombres: Iterable[str]) -> List[str]:
+    """Siembra con count() los contadores sin marca "seeded"; devuelve los sembrados"""
+    nombres = list(nombres)
+    sembrados = []
+    for marcador in await get_all_docs([_marcador(nombre) for nombre in nombres]):
+        if not (marcador.exists and marcador.to_dict().get("seeded")):
+            if await recalcular(marcador.id, forzar=False) is not None:
+                sembrados.append(marcador.id)
+    return sembrados
+
+async def obtener_totales(nombres: Iterable[str]) -> Dict[str, int]:
+    """Suma los shards de varios contadores con una sola lectura agrupada"""
+    nombres = list(nombres)
+    # Contadores aún sin sembrar (normalmente ya lo hizo la migración de arranque)
+    await sembrar_contadores(nombres)
+    refs = [_shards(nombre).document(str(i)) for nombre in nombres for i in range(NUM_SHARDS)]
+    totales = {nombre: 0 for nombre in nombres}
+    for snapshot in await get_all_docs(refs):
+        if snapshot.exists:
+            totales[snapshot.reference.parent.parent.id] += snapshot.to_dict().get("count", 0)
+    return totales
@@ -1,6 +1,8 @@
 import os
 from firebase_admin import auth
 from firebase_config import db
+from contadores import incrementar, USUARIOS
+from indice_emails import indexar_email
 from dotenv import load_dotenv
 
 # Cargar variables de entorno desde el archivo .env en la raíz del proyecto
@@ -31,7 +33,12 @@ def create_admin_user():
             "role": "admin"
         }
         
-        db.collection("usuarios").document(user_record.uid).set(admin_data)
+        # Guardar el usuario y actualizar el contador de usuarios en el mismo batch
+        batch = db.batch()
+        batch.set(db.collection("usuarios").document(user_record.uid), admin_data)
+        incrementar(batch, USUARIOS)
+        indexar_email(batch, admin_email, user_record.uid)
+        batch.commit()
         
         print(f"Usuario administrador creado exitosamente: {admin_email}")
         
@@ -0,0 +1,96 @@
+import re
+
+# Filtro de idioma y roleplay para las respuestas del asistente. Las expresiones se
+# compilan una sola vez y el texto se recorre palabra a palabra en una única pasada:
+# el coste es lineal en la longitud de la respuesta y no hay alternancias gigantes
+# con cuantificadores anidados que puedan hacer backtracking.
+PALABRAS_INGLES = frozenset("""
+the and you for with that this have from are your example help issue user question answer
+doubt imagine each unique week day days english spanish hello hi please thank sorry yes no
+can could would should will may might must shall do does did done has had having been being
+was were am is it its they them their there here how what when where who why which about
+because but if or as at by on in to of not so just now then than also too very really still
+even only again always never sometimes often usually ever once twice first second third next
+last before after since until while during through across over under between among against
+toward upon within without along around behind beside beyond except inside outside above
+below near far off onto into via per plus minus versus vs etc
+""".split())
+
+FRASES_ROLEPLAY = (
+    "imagine that you are", "supongamos que eres", "act as", "actúa como",
+    "let's pretend", "escenario:", "scenario:"
+)
+
+# Palabras en inglés seguidas a partir de las cuales se bloquea la respuesta
+MIN_PALABRAS_INGLES = 5
+
+_PALABRA = re.compile(r"\w+")
+_PALABRA_FINAL = re.compile(r"\w+$")
+# Entre dos palabras de una racha solo puede haber espacios y puntuación simple
+_SEPARADOR = re.compile(r"[\s,.!?]*")
+_ROLEPLAY = re.compile("|".join(re.escape(f) for f in FRASES_ROLEPLAY), re.IGNORECASE)
+_LONGITUD_FRASE = max(len(f) for f in FRASES_ROLEPLAY)
+
+def _racha_ingles(texto: str, racha: int = 0):
+    """
+    Recorre el texto y devuelve (racha, bloqueado): la racha de palabras en inglés
+    seguidas al final del texto y si se ha alcanzado MIN_PALABRAS_INGLES.
+    """
+    inicio = 0
+    for palabra in _PALABRA.finditer(texto):
+        if not _SEPARADOR.fullmatch(texto, inicio, palabra.start()):
+            racha = 0
+        racha = racha + 1 if palabra.group().lower() in PALABRAS_INGLES else 0
+        if racha >= MIN_PALABRAS_INGLES:
+            return racha, True
+        inicio = palabra.end()
+    if not _SEPARADOR.fullmatch(texto, inicio):
+        racha = 0
+    return racha, False
+
+def contiene_ingles(texto: str) -> bool:
+    # Solo bloquea si hay 5 o más palabras en inglés seguidas
+    return _racha_ingles(texto)[1]
+
+def contiene_roleplay(texto: str) -> bool:
+    # Solo bloquea si detecta frases muy claras de roleplay
+    return _ROLEPLAY.search(texto) is not None
+
+def respuesta_bloqueada(texto: str) -> bool:
+    return contiene_ingles(texto) or contiene_roleplay(texto)
+
+class EscanerRespuesta:
+    """
+    Versión incremental del filtro para respuestas en streaming: cada fragmento se
+    analiza una sola vez, conservando solo la racha actual, la palabra que puede estar
+    a medias y el final del texto necesario para detectar frases partidas.
+    """
+    def __init__(self):
+        self.bloqueada = False
+        self._racha = 0
+        self._pendiente = ""
+        self._cola = ""
+
+    def alimentar(self, fragmento: str) -> bool:
+        if self.bloqueada:
+            return True
+        ventana = self._cola + fragmento
+        if contiene_roleplay(ventana):
+            self.bloqueada = True
+            return True
+        self._cola = ventana[-(_LONGITUD_FRASE - 1):]
+
+        texto = self._pendiente + fragmento
+        # La última palabra puede continuar en el siguiente fragmento
+        final = _PALABRA_FINAL.search(texto)
+        corte = final.start() if final else len(texto)
+        self._pendiente = texto[corte:]
+        self._racha, self.bloqueada = _racha_ingles(texto[:corte], self._racha)
+        return self.bloqueada
+
+    def terminar(self) -> bool:
+        """Analiza la palabra pendiente al acabar la respuesta"""
+        if not self.bloqueada and self._pendiente:
+            self._racha, self.bloqueada = _racha_ingles(self._pendiente, self._racha)
+            self._pendiente = ""
+        return self.bloqueada
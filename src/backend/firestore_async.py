@@ -0,0 +1,53 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from firebase_admin import firestore
+from firebase_config import db
+
+# El cliente de Firestore es síncrono: cada .get()/.stream()/.set() bloquea el hilo
+# que lo llama. Para no congelar el event loop de FastAPI (y con él el resto de
+# peticiones y WebSockets) todas las operaciones se ejecutan en un pool de hilos
+# acotado y se esperan con await desde los routers.
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(
+    max_workers=FIRESTORE_MAX_WORKERS,
+    thread_name_prefix="firestore"
+)
+
+async def run_blocking(fn, *args, **kwargs):
+    """Ejecuta una llamada bloqueante en el pool de Firestore y espera su resultado"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+# Lectura de un documento (o de una consulta con .get())
+async def get_doc(ref, **kwargs):
+    return await run_blocking(ref.get, **kwargs)
+
+# Lectura completa de una consulta; el stream se consume dentro del hilo
+async def stream_docs(query):
+    return await run_blocking(lambda: list(query.stream()))
+
+async def set_doc(ref, data, merge=False):
+    return await run_blocking(ref.set, data, merge=merge)
+
+async def update_doc(ref, data):
+    return await run_blocking(ref.update, data)
+
+async def delete_doc(ref):
+    return await run_blocking(ref.delete)
+
+async def add_doc(collection_ref, data):
+    return await run_blocking(collection_ref.add, data)
+
+async def get_all_docs(refs):
+    return await run_blocking(lambda: list(db.get_all(refs)))
+
+async def commit_batch(batch):
+    return await run_blocking(batch.commit)
+
+async def run_transaction(fn, *args, max_attempts=5, **kwargs):
+    """Ejecuta fn(transaction, *args) como transacción de Firestore (con reintentos) en el pool"""
+    transaction = db.transaction(max_attempts=max_attempts)
+    return await run_blocking(firestore.transactional(fn), transaction, *args, **kwargs)
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from typing import Optional
+from firebase_config import db
+from firestore_async import get_doc, stream_docs, set_doc, delete_doc
+
+# Índice email normalizado -> uid. Cada entrada es un documento usuarios_por_email/{email}
+# que se mantiene al crear, actualizar y borrar usuarios, de modo que resolver un email
+# es una lectura puntual (o un acierto en la caché en memoria) y nunca un recorrido
+# de la colección de usuarios.
+EMAIL_INDEX_COLLECTION = "usuarios_por_email"
+EMAIL_CACHE_SIZE = 4096
+MAX_BATCH_WRITES = 500
+
+_uid_por_email: "OrderedDict[str, str]" = OrderedDict()
+# Se vuelve True cuando la migración de arranque ha indexado a todos los usuarios existentes
+_indice_completo = False
+
+def normalizar_email(email: Optional[str]) -> str:
+    return (email or "").strip().lower()
+
+def _index_ref(email: str):
+    # "/" no está permitido en los IDs de documento
+    return db.collection(EMAIL_INDEX_COLLECTION).document(normalizar_email(email).replace("/", "%2F"))
+
+def _cachear(email: str, uid: str):
+    _uid_por_email[email] = uid
+    _uid_por_email.move_to_end(email)
+    while len(_uid_por_email) > EMAIL_CACHE_SIZE:
+        _uid_por_email.popitem(last=False)
+
+def indexar_email(writer, email: str, uid: str):
+    """Añade la entrada del índice a un batch o transacción"""
+    writer.set(_index_ref(email), {"uid": uid, "email": normalizar_email(email)})
+    _uid_por_email.pop(normalizar_email(email), None)
+
+def desindexar_email(writer, email: str):
+    writer.delete(_index_ref(email))
+    _uid_por_email.pop(normalizar_email(email), None)
+
+async def guardar_indice_email(email: str, uid: str, email_anterior: Optional[str] = None):
+    if email_anterior and normalizar_email(email_anterior) != normalizar_email(email):
+        await eliminar_indice_email(email_anterior)
+    await set_doc(_index_ref(email), {"uid": uid, "email": normalizar_email(email)})
+    _cachear(normalizar_email(email), uid)
+
+async def eliminar_indice_email(email: str):
+    if not normalizar_email(email):
+        return
+    _uid_por_email.pop(normalizar_email(email), None)
+    await delete_doc(_index_ref(email))
+
+def _marca_indice():
+    # Marca de la migración en la colección común de migraciones (ver migraciones.py)
+    return db.collection("migraciones").document(EMAIL_INDEX_COLLECTION)
+
+def indexar_emails_existentes() -> int:
+    """Crea la entrada del índice de todos los usuarios existentes y deja la marca de completado"""
+    batch = db.batch()
+    pendientes = 0
+    total = 0
+    for user in db.collection("usuarios").select(["email"]).stream():
+        email = user.to_dict().get("email")
+        if not email:
+            continue
+        indexar_email(batch, email, user.id)
+        pendientes += 1
+        total += 1
+        if pendientes == MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+            pendientes = 0
+    if pendientes:
+        batch.commit()
+    _marca_indice().set({"completada": True, "usuarios": total})
+    return total
+
+async def indice_completo() -> bool:
+    global _indice_completo
+    if not _indice_completo:
+        _indice_completo = (await get_doc(_marca_indice())).exists
+    return _indice_completo
+
+async def resolver_uid(email: str) -> Optional[str]:
+    """Devuelve el uid asociado al email (sin distinguir mayúsculas) o None"""
+    email_original = (email or "").strip()
+    email = normalizar_email(email)
+    if not email:
+        return None
+    if email in _uid_por_email:
+        _uid_por_email.move_to_end(email)
+        return _uid_por_email[email]
+
+    entrada = await get_doc(_index_ref(email))
+    if entrada.exists:
+        uid = entrada.to_dict().get("uid")
+        _cachear(email, uid)
+        return uid
+
+    # Usuarios anteriores al índice: búsqueda exacta por el campo indexado email
+    # y alta en el índice para la próxima vez
+    for candidato in dict.fromkeys([email, email_original]):
+        usuarios = await stream_docs(db.collection("usuarios").where("email", "==", candidato).limit(1))
+        if usuarios:
+            await guardar_indice_email(email, usuarios[0].id)
+            return usuarios[0].id
+
+    # Hasta que termine la migración del índice, un email guardado con otras mayúsculas
+    # solo se encuentra recorriendo la colección, como antes de existir el índice
+    if not await indice_completo():
+        for usuario in await stream_docs(db.collection("usuarios").select(["email"])):
+            if normalizar_email(usuario.to_dict().get("email")) == email:
+                await guardar_indice_email(email, usuario.id)
+                return usuario.id
+    return None
+
+async def buscar_usuario_por_email(email: str):
+    """Snapshot del documento del usuario con ese email, o None si no existe"""
+    uid = await resolver_uid(email)
+    if uid is None:
+        return None
+    usuario = await get_doc(db.collection("usuarios").document(uid))
+    if not usuario.exists:
+        # Entrada huérfana (usuario borrado por otra vía)
+        await eliminar_indice_email(email)
+        return None
+    return usuario
@@ -0,0 +1,115 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List
+from texto import normalizar_texto
+
+# Índice BM25 sobre las preguntas del FAQ del asistente. En lugar de enviar el contexto
+# completo en cada petición, se envían solo las entradas relevantes para la pregunta,
+# lo que reduce el prefill y deja sitio en num_ctx para más historial.
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Entradas del FAQ que se incluyen como máximo en el prompt
+MAX_FRAGMENTOS = 5
+
+STOPWORDS = set("""
+a al algo como con cual de del donde el ella en es esta este esto hay la las le lo los
+me mi mis no o para pero por puedo que se si sin sobre su sus te tu tus un una y ya yo
+""".split())
+
+def tokenizar(texto: str) -> List[str]:
+    tokens = []
+    for palabra in normalizar_texto(texto).split():
+        if palabra in STOPWORDS:
+            continue
+        # Reducción mínima de plurales para que "productos" y "producto" coincidan
+        if len(palabra) > 4 and palabra.endswith("es"):
+            palabra = palabra[:-2]
+        elif len(palabra) > 3 and palabra.endswith("s"):
+            palabra = palabra[:-1]
+        tokens.append(palabra)
+    return tokens
+
+def separar_contexto(contexto: str) -> Dict:
+    """
+    Divide el prompt del asistente en introducción, entradas del FAQ (con el título de
+    su sección) e instrucciones generales, que siempre se envían.
+    """
+    partes = {"introduccion": [], "entradas": [], "instrucciones": []}
+    seccion = None
+    en_instrucciones = False
+    for linea in contexto.strip().splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        if linea.startswith("INSTRUCCIONES GENERALES"):
+            en_instrucciones = True
+            partes["instrucciones"].append(linea)
+            continue
+        if en_instrucciones:
+            partes["instrucciones"].append(linea)
+            continue
+        titulo = re.match(r"^\d+\.\s+(.+)$", linea)
+        if titulo:
+            seccion = titulo.group(1)
+        elif linea.startswith("-") and seccion:
+            partes["entradas"].append({"seccion": seccion, "texto": linea})
+        else:
+            partes["introduccion"].append(linea)
+    return {
+        "introduccion": "\n".join(partes["introduccion"]),
+        "entradas": partes["entradas"],
+        "instrucciones": "\n".join(partes["instrucciones"])
+    }
+
+class IndiceFAQ:
+    def __init__(self, contexto: str):
+        partes = separar_contexto(contexto)
+        self.introduccion = partes["introduccion"]
+        self.instrucciones = partes["instrucciones"]
+        self.entradas = partes["entradas"]
+
+        # El título de la sección forma parte del documento de cada entrada
+        self._documentos = [Counter(tokenizar(f"{e['seccion']} {e['texto']}")) for e in self.entradas]
+        self._longitudes = [sum(doc.values()) for doc in self._documentos]
+        self._longitud_media = sum(self._longitudes) / len(self._longitudes) if self._longitudes else 0
+        frecuencias = Counter(token for doc in self._documentos for token in doc)
+        n = len(self._documentos)
+        self._idf = {
+            token: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for token, df in frecuencias.items()
+        }
+
+    def puntuar(self, consulta: str) -> List[float]:
+        tokens = [t for t in tokenizar(consulta) if t in self._idf]
+        puntuaciones = []
+        for doc, longitud in zip(self._documentos, self._longitudes):
+            puntuacion = 0.0
+            for token in tokens:
+                tf = doc.get(token, 0)
+                if tf:
+                    norma = BM25_K1 * (1 - BM25_B + BM25_B * longitud / self._longitud_media)
+                    puntuacion += self._idf[token] * tf * (BM25_K1 + 1) / (tf + norma)
+            puntuaciones.append(puntuacion)
+        return puntuaciones
+
+    def buscar(self, consulta: str, limite: int = MAX_FRAGMENTOS) -> List[dict]:
+        """Entradas con puntuación positiva, de más a menos relevante"""
+        puntuaciones = self.puntuar(consulta)
+        orden = sorted(range(len(puntuaciones)), key=lambda i: puntuaciones[i], reverse=True)
+        return [self.entradas[i] for i in orden[:limite] if puntuaciones[i] > 0]
+
+    def construir_prompt(self, consulta: str, limite: int = MAX_FRAGMENTOS) -> str:
+        """Prompt de sistema con la introducción, las entradas relevantes y las instrucciones"""
+        seleccion = self.buscar(consulta, limite)
+        # Mantener el orden original del FAQ agrupando por sección
+        seleccion.sort(key=self.entradas.index)
+        lineas = [self.introduccion]
+        seccion = None
+        for entrada in seleccion:
+            if entrada["seccion"] != seccion:
+                seccion = entrada["seccion"]
+                lineas.append(f"\n{seccion}")
+            lineas.append(entrada["texto"])
+        lineas.append(f"\n{self.instrucciones}")
+        return "\n".join(lineas)
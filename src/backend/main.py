@@ -1,21 +1,31 @@
-from fastapi import FastAPI, HTTPException, Body, Depends, Header
+from fastapi import FastAPI, HTTPException, Body, Depends, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Form, File, UploadFile
 from firebase_config import db
+from firestore_async import get_doc, stream_docs, set_doc, update_doc, delete_doc, run_transaction
+from paginacion import PageParams, fetch_page, NEXT_CURSOR_HEADER
+from middleware import get_token_header, verify_token
+from indice_emails import buscar_usuario_por_email
+from subida_imagenes import es_imagen, subir_archivo, subir_imagenes, LimiteSubidas
+from contadores import crear_con_contador, eliminar_con_contador, obtener_totales, incrementar, USUARIOS, PRODUCTOS, ARTICULOS, COMPRAS
+from borrado_cascada import programar_borrado, coleccion, lanzar_reanudacion
 from auth import router as auth_router
 from admin import router as admin_router
-from firebase_admin import firestore, auth
+from firebase_admin import firestore
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+from collections import defaultdict
 from cloudinary_config import *  # Importar la configuración
 import cloudinary.uploader
 from pydantic import BaseModel
+import asyncio
 import logging
 import json
 from chat_history import router as chat_history_router
 from chat import router as chat_router
 from chat_routes import router as direct_chat_router
 from ws_chat import router as ws_chat_router
+from migraciones import lanzar_migraciones, migracion_completada, RESPUESTAS_INDEXADAS
 
 # Configuración de logging
 logging.basicConfig(
@@ -55,6 +65,20 @@ app.include_router(direct_chat_router)
 # Incluir el router WebSocket de chat directo
 app.include_router(ws_chat_router)
 
+# Migraciones de datos pendientes (siembra de contadores, índices...) al arrancar
+@app.on_event("startup")
+async def arrancar_migraciones():
+    lanzar_migraciones()
+
+# Borrados en cascada que un reinicio dejó a medias
+@app.on_event("startup")
+async def arrancar_borrados():
+    lanzar_reanudacion()
+
+# Límite del cuerpo de las subidas antes de procesar el multipart (CORS queda por fuera
+# para que el 413 llegue al navegador con sus cabeceras)
+app.add_middleware(LimiteSubidas)
+
 # Configuración de CORS
 app.add_middleware(
     CORSMiddleware,
@@ -71,8 +95,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
+# Campos por los que se permite ordenar los listados paginados
+ORDEN_PRODUCTOS = ("nombre", "precio", "stock", "categoria", "fecha_creacion")
+ORDEN_ARTICULOS = ("titulo", "categoria", "fecha_publicacion", "likes")
+ORDEN_USUARIOS = ("nombre", "email")
+ORDEN_COMENTARIOS = ("timestamp", "fecha")
+# Valores máximos de un filtro "in" de Firestore
+MAX_FILTRO_IN = 30
+
 # Modelo para estadísticas mensuales
 class EstadisticasMensuales(BaseModel):
     fecha: str
@@ -84,11 +117,12 @@ class EstadisticasMensuales(BaseModel):
 @app.post("/admin/estadisticas-mensuales")
 async def guardar_estadisticas_mensuales():
     try:
-        # Obtener totales actuales
-        usuarios = len(list(db.collection("usuarios").stream()))
-        productos = len(list(db.collection("productos").stream()))
-        articulos = len(list(db.collection("articulos").stream()))
-        compras = len(list(db.collection("compras").stream()))
+        # Obtener totales actuales desde los contadores
+        totales = await obtener_totales([USUARIOS, PRODUCTOS, ARTICULOS, COMPRAS])
+        usuarios = totales[USUARIOS]
+        productos = totales[PRODUCTOS]
+        articulos = totales[ARTICULOS]
+        compras = totales[COMPRAS]
         
         # Crear documento con estadísticas
         fecha_actual = datetime.now().strftime("%Y-%m")
@@ -102,7 +136,7 @@ async def guardar_estadisticas_mensuales():
         }
         
         # Guardar en Firestore
-        db.collection("estadisticas_mensuales").document(fecha_actual).set(estadisticas)
+        await set_doc(db.collection("estadisticas_mensuales").document(fecha_actual), estadisticas)
         
         return {"message": "Estadísticas guardadas correctamente", "estadisticas": estadisticas}
     except Exception as e:
@@ -114,7 +148,7 @@ async def obtener_estadisticas_mensuales():
     try:
         # Obtener todas las estadísticas ordenadas por fecha
         stats_ref = db.collection("estadisticas_mensuales").order_by("fecha", direction=firestore.Query.DESCENDING)
-        stats = stats_ref.stream()
+        stats = await stream_docs(stats_ref)
         
         return [{"fecha": doc.id, **doc.to_dict()} for doc in stats]
     except Exception as e:
@@ -125,18 +159,17 @@ async def obtener_estadisticas_mensuales():
 async def root():
     return {"message": "Bienvenido a la API"}
 
-# ✅ Endpoint para obtener productos
+# ✅ Endpoint para obtener productos (paginado con ?limit=&start_after=&order_by=&fields=)
 @app.get("/productos", response_model=List[Dict[str, Any]])
-async def get_productos():
-    productos_ref = db.collection("productos").stream()
-    return [{"id": doc.id, **doc.to_dict()} for doc in productos_ref]
+async def get_productos(response: Response, page: PageParams = Depends()):
+    return await fetch_page(db.collection("productos"), page, response, ORDEN_PRODUCTOS)
 
 @app.get("/productos/{producto_id}", response_model=Dict[str, Any])
 async def obtener_producto(producto_id: str):
     try:
         logger.info(f"Búsqueda de producto: {producto_id}")
         producto_ref = db.collection("productos").document(producto_id)
-        producto = producto_ref.get()
+        producto = await get_doc(producto_ref)
         if not producto.exists:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
         return {"id": producto.id, **producto.to_dict()}
@@ -162,17 +195,8 @@ async def crear_producto(
         logger.info(f"Intento de creación de producto: {sanitize_log_data({'nombre': nombre, 'categoria': categoria, 'usuario': usuario_email})}")
         urls_imagenes = []
         if imagenes:
-            for imagen in imagenes:
-                try:
-                    if hasattr(imagen, 'filename') and imagen.filename and hasattr(imagen, 'content_type') and imagen.content_type and imagen.content_type.startswith("image/"):
-                        contents = await imagen.read()
-                        result = cloudinary.uploader.upload(
-                            contents,
-                            folder="product_images",
-                            resource_type="auto"                        )
-                        urls_imagenes.append(result["secure_url"])
-                except Exception as img_err:
-                    continue
+            # Subida concurrente; las imágenes que fallen se omiten
+            urls_imagenes = await subir_imagenes(imagenes, "product_images", ignorar_errores=True)
 
         # Si no se subió ninguna imagen, usar la imagen por defecto
         if not urls_imagenes:
@@ -192,8 +216,10 @@ async def crear_producto(
         }
         if usuario_email:
             producto["usuario_email"] = usuario_email
-        producto_ref.set(producto)
+        await crear_con_contador(producto_ref, producto, PRODUCTOS)
         return {"id": producto_ref.id, **producto}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en crear_producto: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -220,7 +246,7 @@ async def actualizar_producto(
         logger.info(f"Imágenes existentes recibidas: {imagenes_existentes}")
         
         producto_ref = db.collection("productos").document(producto_id)
-        producto = producto_ref.get()
+        producto = await get_doc(producto_ref)
         if not producto.exists:
             logger.warning(f"Producto no encontrado: {producto_id}")
             raise HTTPException(status_code=404, detail="Producto no encontrado")
@@ -240,16 +266,8 @@ async def actualizar_producto(
         # Si hay imágenes nuevas, procesarlas
         if imagenes:
             logger.info(f"Procesando {len(imagenes)} nuevas imágenes para el producto {producto_id}")
-            for i, imagen in enumerate(imagenes):
-                if hasattr(imagen, 'filename') and imagen.filename and hasattr(imagen, 'content_type') and imagen.content_type and imagen.content_type.startswith("image/"):
-                    contents = await imagen.read()
-                    result = cloudinary.uploader.upload(
-                        contents,
-                        folder="product_images",
-                        resource_type="auto"
-                    )
-                    urls_imagenes.append(result["secure_url"])
-                    logger.info(f"Imagen {i+1} subida a Cloudinary: {result['secure_url']}")
+            urls_imagenes = await subir_imagenes(imagenes, "product_images")
+            logger.info(f"Imágenes subidas a Cloudinary: {urls_imagenes}")
         
         # Si hay imágenes existentes, añadirlas
         if imagenes_existentes:
@@ -272,10 +290,10 @@ async def actualizar_producto(
             logger.warning(f"No se proporcionaron datos para actualizar el producto {producto_id}")
             raise HTTPException(status_code=400, detail="No se proporcionaron datos para actualizar")
         
-        producto_ref.update(data)
+        await update_doc(producto_ref, data)
         logger.info(f"Producto {producto_id} actualizado correctamente en la base de datos")
         
-        producto_actualizado = producto_ref.get().to_dict()
+        producto_actualizado = (await get_doc(producto_ref)).to_dict()
         producto_actualizado["id"] = producto_id
         
         return producto_actualizado
@@ -290,7 +308,7 @@ async def actualizar_producto(
 async def eliminar_producto(producto_id: str):
     try:
         producto_ref = db.collection("productos").document(producto_id)
-        producto = producto_ref.get()
+        producto = await get_doc(producto_ref)
         
         if not producto.exists:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
@@ -307,7 +325,7 @@ async def eliminar_producto(producto_id: str):
             except Exception:
                 pass
         
-        producto_ref.delete()
+        await eliminar_con_contador(producto_ref, PRODUCTOS)
         return {"message": "Producto eliminado correctamente"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -317,13 +335,13 @@ async def eliminar_producto(producto_id: str):
 async def obtener_productos_usuario(usuario_id: str):
     try:
         # Buscar el usuario por UID
-        user_doc = db.collection("usuarios").document(usuario_id).get()
+        user_doc = await get_doc(db.collection("usuarios").document(usuario_id))
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         user_email = user_doc.to_dict().get("email")
         # Buscar productos por email
         productos_ref = db.collection("productos").where("usuario_email", "==", user_email)
-        productos = productos_ref.stream()
+        productos = await stream_docs(productos_ref)
         return [{"id": producto.id, **producto.to_dict()} for producto in productos]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -333,35 +351,59 @@ async def obtener_productos_usuario(usuario_id: str):
 async def obtener_producto_por_id(producto_id: str):
     try:
         producto_ref = db.collection("productos").document(producto_id)
-        producto = producto_ref.get()
+        producto = await get_doc(producto_ref)
         if not producto.exists:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
         return {"id": producto.id, **producto.to_dict()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Endpoint para obtener artículos
+# Endpoint para obtener artículos (paginado con ?limit=&start_after=&order_by=&fields=)
 @app.get("/articulos", response_model=List[Dict[str, Any]])
-async def get_articulos():
-    articulos_ref = db.collection("articulos").stream()
-    return [{"id": doc.id, **doc.to_dict()} for doc in articulos_ref]
+async def get_articulos(response: Response, page: PageParams = Depends()):
+    return await fetch_page(db.collection("articulos"), page, response, ORDEN_ARTICULOS)
 
 # Endpoint para obtener comentarios de un artículo
 @app.get("/articulos/{articulo_id}/comentarios", response_model=List[Dict[str, Any]])
-async def get_comentarios(articulo_id: str):
-    comentarios_ref = db.collection("articulos").document(articulo_id).collection("comentarios").stream()
-    comentarios = []
-    for c in comentarios_ref:
-        comentario_data = c.to_dict()
-        comentario_id = c.id
-        # Obtener respuestas de este comentario
-        respuestas_ref = db.collection("articulos").document(articulo_id).collection("comentarios").document(comentario_id).collection("respuestas").stream()
-        respuestas = [{"id": r.id, **r.to_dict()} for r in respuestas_ref]
-        comentario_data["id"] = comentario_id
-        comentario_data["respuestas"] = respuestas
-        comentarios.append(comentario_data)
+async def get_comentarios(articulo_id: str, response: Response, page: PageParams = Depends()):
+    comentarios = await fetch_page(
+        db.collection("articulos").document(articulo_id).collection("comentarios"),
+        page, response, ORDEN_COMENTARIOS
+    )
+    if not comentarios:
+        return comentarios
+    
+    respuestas_por_comentario = await respuestas_de_comentarios(articulo_id, [c["id"] for c in comentarios])
+    for comentario in comentarios:
+        respuestas = respuestas_por_comentario.get(comentario["id"], [])
+        respuestas.sort(key=lambda r: str(r.get("timestamp", "")))
+        comentario["respuestas"] = respuestas
+        comentario["num_respuestas"] = len(respuestas)
     return comentarios
 
+async def respuestas_de_comentarios(articulo_id: str, comentario_ids: List[str]) -> Dict[str, List[dict]]:
+    """Respuestas de los comentarios de la página, agrupadas por comentario"""
+    comentarios_ref = db.collection("articulos").document(articulo_id).collection("comentarios")
+    if not await migracion_completada(RESPUESTAS_INDEXADAS):
+        # Respuestas antiguas aún sin articulo_id: una consulta por comentario de la página
+        consultas = [stream_docs(comentarios_ref.document(cid).collection("respuestas")) for cid in comentario_ids]
+    else:
+        # Consultas de grupo de colecciones limitadas a los comentarios de la página
+        # ("in" admite como mucho MAX_FILTRO_IN valores), lanzadas a la vez
+        consultas = [
+            stream_docs(
+                db.collection_group("respuestas")
+                .where("articulo_id", "==", articulo_id)
+                .where("comentario_padre", "in", comentario_ids[i:i + MAX_FILTRO_IN])
+            )
+            for i in range(0, len(comentario_ids), MAX_FILTRO_IN)
+        ]
+    respuestas_por_comentario = defaultdict(list)
+    for respuestas in await asyncio.gather(*consultas):
+        for r in respuestas:
+            respuestas_por_comentario[r.reference.parent.parent.id].append({"id": r.id, **r.to_dict()})
+    return respuestas_por_comentario
+
 # Endpoint para simular compra (mock)
 @app.post("/comprar")
 async def comprar(producto_id: str, usuario_id: str):
@@ -370,16 +412,16 @@ async def comprar(producto_id: str, usuario_id: str):
         "producto": producto_id,
         "fecha": firestore.SERVER_TIMESTAMP
     }
-    db.collection("compras").add(compra)
+    await crear_con_contador(db.collection("compras").document(), compra, COMPRAS)
     return {"mensaje": f"Compra registrada de {producto_id} por {usuario_id}"}
 
-# GET /usuarios → Devuelve todos los usuarios
+# GET /usuarios → Devuelve los usuarios (paginado con ?limit=&start_after=&order_by=&fields=)
 @app.get("/usuarios", response_model=List[Dict[str, Any]])
-async def obtener_usuarios():
+async def obtener_usuarios(response: Response, page: PageParams = Depends()):
     try:
-        usuarios_ref = db.collection("usuarios")
-        usuarios = usuarios_ref.stream()
-        return [{"id": usuario.id, **usuario.to_dict()} for usuario in usuarios]
+        return await fetch_page(db.collection("usuarios"), page, response, ORDEN_USUARIOS)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -388,7 +430,7 @@ async def obtener_usuarios():
 async def obtener_articulo(articulo_id: str):
     try:
         articulo_ref = db.collection("articulos").document(articulo_id)
-        articulo = articulo_ref.get()
+        articulo = await get_doc(articulo_ref)
         if not articulo.exists:
             raise HTTPException(status_code=404, detail="Artículo no encontrado")
         return {"id": articulo.id, **articulo.to_dict()}
@@ -407,7 +449,7 @@ async def agregar_comentario(
 ):
     try:
         articulo_ref = db.collection("articulos").document(articulo_id)
-        articulo = articulo_ref.get()
+        articulo = await get_doc(articulo_ref)
         if not articulo.exists:
             raise HTTPException(status_code=404, detail="Artículo no encontrado")
         
@@ -423,29 +465,26 @@ async def agregar_comentario(
             if not imagen.content_type.startswith("image/"):
                 raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
             
-            contents = await imagen.read()
-            result = cloudinary.uploader.upload(
-                contents,
-                folder="comment_images",
-                resource_type="auto"
-            )
+            result = await subir_archivo(imagen, "comment_images")
             comentario_data["imagen"] = result["secure_url"]
 
         # Si es una respuesta, añadir el ID del comentario padre
         if comentario_padre:
             comentario_data["comentario_padre"] = comentario_padre
+            # Necesario para cargar el hilo con la consulta de grupo sobre "respuestas"
+            comentario_data["articulo_id"] = articulo_id
             comentario_ref = articulo_ref.collection("comentarios").document(comentario_padre)
-            comentario = comentario_ref.get()
+            comentario = await get_doc(comentario_ref)
             if not comentario.exists:
                 raise HTTPException(status_code=404, detail="Comentario padre no encontrado")
             
             respuesta_id = comentario_ref.collection("respuestas").document().id
-            comentario_ref.collection("respuestas").document(respuesta_id).set(comentario_data)
+            await set_doc(comentario_ref.collection("respuestas").document(respuesta_id), comentario_data)
             return {"id": respuesta_id, **comentario_data}
         
         # Si es un comentario nuevo
         comentario_id = articulo_ref.collection("comentarios").document().id
-        articulo_ref.collection("comentarios").document(comentario_id).set(comentario_data)
+        await set_doc(articulo_ref.collection("comentarios").document(comentario_id), comentario_data)
         
         return {"id": comentario_id, **comentario_data}
     except Exception as e:
@@ -457,13 +496,15 @@ async def agregar_comentario(
 async def agregar_respuesta(articulo_id: str, comentario_id: str, respuesta: Dict[str, Any]):
     try:
         comentario_ref = db.collection("articulos").document(articulo_id).collection("comentarios").document(comentario_id)
-        comentario = comentario_ref.get()
+        comentario = await get_doc(comentario_ref)
         if not comentario.exists:
             raise HTTPException(status_code=404, detail="Comentario no encontrado")
         
         respuesta["timestamp"] = datetime.now()
+        respuesta["articulo_id"] = articulo_id
+        respuesta["comentario_padre"] = comentario_id
         respuesta_id = comentario_ref.collection("respuestas").document().id
-        comentario_ref.collection("respuestas").document(respuesta_id).set(respuesta)
+        await set_doc(comentario_ref.collection("respuestas").document(respuesta_id), respuesta)
         
         return {"id": respuesta_id, **respuesta}
     except Exception as e:
@@ -486,13 +527,8 @@ async def crear_articulo(
         
         if imagen is not None:
             try:
-                if hasattr(imagen, 'filename') and imagen.filename and hasattr(imagen, 'content_type') and imagen.content_type and imagen.content_type.startswith("image/"):
-                    contents = await imagen.read()
-                    result = cloudinary.uploader.upload(
-                        contents,
-                        folder="blog_images",
-                        resource_type="auto"
-                    )
+                if es_imagen(imagen):
+                    result = await subir_archivo(imagen, "blog_images")
                     url_imagen = result["secure_url"]
             except Exception:
                 url_imagen = gatito_url
@@ -510,7 +546,7 @@ async def crear_articulo(
             "autor_email": autor_email,
             "likes": 0,
         }
-        articulo_ref.set(articulo)
+        await crear_con_contador(articulo_ref, articulo, ARTICULOS)
         return {"id": articulo_ref.id, **articulo}
     except Exception as e:
         logger.error(f"Error creating article: {str(e)}")
@@ -519,21 +555,16 @@ async def crear_articulo(
 @app.post("/upload-image/")
 async def upload_image(file: UploadFile = File(...)):
     try:
-        # Leer el contenido del archivo
-        contents = await file.read()
-        
-        # Subir a Cloudinary
-        result = cloudinary.uploader.upload(
-            contents,
-            folder="blog_images",  # Opcional: organizar imágenes en carpetas
-            resource_type="auto"   # Detecta automáticamente el tipo de archivo
-        )
+        # Subir a Cloudinary directamente desde el fichero temporal
+        result = await subir_archivo(file, "blog_images")
         
         # Devolver la URL pública
         return {
             "url": result["secure_url"],
             "public_id": result["public_id"]
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -544,7 +575,7 @@ async def eliminar_articulo(articulo_id: str):
     try:
         # Obtener el artículo antes de eliminarlo
         articulo_ref = db.collection("articulos").document(articulo_id)
-        articulo = articulo_ref.get()
+        articulo = await get_doc(articulo_ref)
         
         if not articulo.exists:
             raise HTTPException(status_code=404, detail="Artículo no encontrado")
@@ -575,9 +606,11 @@ async def eliminar_articulo(articulo_id: str):
             print("[ELIMINACIÓN] El artículo no tiene imagen en Cloudinary o usa imagen por defecto")
         
         # Eliminar el artículo de la base de datos
-        articulo_ref.delete()
+        await eliminar_con_contador(articulo_ref, ARTICULOS)
         print(f"[ELIMINACIÓN] Artículo eliminado correctamente de la base de datos")
-        return {"message": "Artículo eliminado correctamente"}
+        # Los comentarios y sus respuestas se borran en segundo plano
+        borrado_id = await programar_borrado(f"comentarios del artículo {articulo_id}", [coleccion(articulo_ref.collection("comentarios"))])
+        return {"message": "Artículo eliminado correctamente", "borrado_id": borrado_id}
     except Exception as e:
         print(f"[ERROR] Error en eliminar_articulo: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -601,7 +634,7 @@ async def actualizar_articulo(
         print(f"Datos recibidos: titulo={titulo}, descripcion={descripcion}, categoria={categoria}, imagen_existente={imagen_existente}")
         
         articulo_ref = db.collection("articulos").document(articulo_id)
-        articulo = articulo_ref.get()
+        articulo = await get_doc(articulo_ref)
         if not articulo.exists:
             raise HTTPException(status_code=404, detail="Artículo no encontrado")
 
@@ -616,13 +649,8 @@ async def actualizar_articulo(
         if likes is not None: data["likes"] = int(likes)
         
         # Si hay imagen nueva, súbela a Cloudinary
-        if imagen is not None and hasattr(imagen, 'filename') and imagen.filename and hasattr(imagen, 'content_type') and imagen.content_type and imagen.content_type.startswith("image/"):
-            contents = await imagen.read();
-            result = cloudinary.uploader.upload(
-                contents,
-                folder="blog_images",
-                resource_type="auto"
-            )
+        if es_imagen(imagen):
+            result = await subir_archivo(imagen, "blog_images")
             data["imagen"] = result["secure_url"]
         # Si se proporcionó una imagen existente, úsala
         elif imagen_existente:
@@ -633,8 +661,8 @@ async def actualizar_articulo(
         if not data:
             raise HTTPException(status_code=400, detail="No se proporcionaron datos para actualizar")
 
-        articulo_ref.update(data)
-        articulo_actualizado = articulo_ref.get().to_dict()
+        await update_doc(articulo_ref, data)
+        articulo_actualizado = (await get_doc(articulo_ref)).to_dict()
         articulo_actualizado["id"] = articulo_id
         return articulo_actualizado
     except Exception as e:
@@ -647,20 +675,19 @@ async def guardar_articulo(user_email: str, articulo_id: str):
     try:
         # Verificar que el artículo existe
         articulo_ref = db.collection("articulos").document(articulo_id)
-        articulo = articulo_ref.get()
+        articulo = await get_doc(articulo_ref)
         if not articulo.exists:
             raise HTTPException(status_code=404, detail="Artículo no encontrado")
 
         # Obtener el usuario
-        usuarios_ref = db.collection("usuarios").where("email", "==", user_email).limit(1)
-        usuarios = list(usuarios_ref.stream())
-        if not usuarios:
+        usuario = await buscar_usuario_por_email(user_email)
+        if usuario is None:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        usuario_ref = usuarios[0].reference
+        usuario_ref = usuario.reference
         
         # Obtener los artículos guardados actuales
-        usuario_data = usuario_ref.get().to_dict()
+        usuario_data = usuario.to_dict()
         articulos_guardados = usuario_data.get("articulos_guardados", [])
         
         # Verificar si el artículo ya está guardado
@@ -669,7 +696,7 @@ async def guardar_articulo(user_email: str, articulo_id: str):
         
         # Añadir el artículo a la lista de guardados
         articulos_guardados.append(articulo_id)
-        usuario_ref.update({"articulos_guardados": articulos_guardados})
+        await update_doc(usuario_ref, {"articulos_guardados": articulos_guardados})
         
         return {"message": "Artículo guardado correctamente"}
     except HTTPException as he:
@@ -682,19 +709,18 @@ async def guardar_articulo(user_email: str, articulo_id: str):
 async def obtener_articulos_guardados(user_email: str):
     try:
         # Obtener el usuario
-        usuarios_ref = db.collection("usuarios").where("email", "==", user_email).limit(1)
-        usuarios = list(usuarios_ref.stream())
-        if not usuarios:
+        usuario = await buscar_usuario_por_email(user_email)
+        if usuario is None:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        usuario_data = usuarios[0].to_dict()
+        usuario_data = usuario.to_dict()
         articulos_guardados = usuario_data.get("articulos_guardados", [])
         
         # Obtener los detalles de cada artículo guardado
         articulos = []
         for articulo_id in articulos_guardados:
             articulo_ref = db.collection("articulos").document(articulo_id)
-            articulo = articulo_ref.get()
+            articulo = await get_doc(articulo_ref)
             if articulo.exists:
                 articulos.append({"id": articulo.id, **articulo.to_dict()})
         
@@ -707,15 +733,14 @@ async def obtener_articulos_guardados(user_email: str):
 async def eliminar_articulo_guardado(user_email: str, articulo_id: str):
     try:
         # Obtener el usuario
-        usuarios_ref = db.collection("usuarios").where("email", "==", user_email).limit(1)
-        usuarios = list(usuarios_ref.stream())
-        if not usuarios:
+        usuario = await buscar_usuario_por_email(user_email)
+        if usuario is None:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        usuario_ref = usuarios[0].reference
+        usuario_ref = usuario.reference
         
         # Obtener los artículos guardados actuales
-        usuario_data = usuario_ref.get().to_dict()
+        usuario_data = usuario.to_dict()
         articulos_guardados = usuario_data.get("articulos_guardados", [])
         
         # Verificar si el artículo está guardado
@@ -724,7 +749,7 @@ async def eliminar_articulo_guardado(user_email: str, articulo_id: str):
         
         # Eliminar el artículo de la lista de guardados
         articulos_guardados.remove(articulo_id)
-        usuario_ref.update({"articulos_guardados": articulos_guardados})
+        await update_doc(usuario_ref, {"articulos_guardados": articulos_guardados})
         
         return {"message": "Artículo eliminado de guardados correctamente"}
     except HTTPException as he:
@@ -738,20 +763,19 @@ async def guardar_producto_favorito(user_email: str, producto_id: str):
     try:
         # Verificar que el producto existe
         producto_ref = db.collection("productos").document(producto_id)
-        producto = producto_ref.get()
+        producto = await get_doc(producto_ref)
         if not producto.exists:
             raise HTTPException(status_code=404, detail="Producto no encontrado")
 
         # Obtener el usuario
-        usuarios_ref = db.collection("usuarios").where("email", "==", user_email).limit(1)
-        usuarios = list(usuarios_ref.stream())
-        if not usuarios:
+        usuario = await buscar_usuario_por_email(user_email)
+        if usuario is None:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        usuario_ref = usuarios[0].reference
+        usuario_ref = usuario.reference
         
         # Obtener los productos favoritos actuales
-        usuario_data = usuario_ref.get().to_dict()
+        usuario_data = usuario.to_dict()
         productos_favoritos = usuario_data.get("productos_favoritos", [])
         
         # Verificar si el producto ya está en favoritos
@@ -760,7 +784,7 @@ async def guardar_producto_favorito(user_email: str, producto_id: str):
         
         # Añadir el producto a la lista de favoritos
         productos_favoritos.append(producto_id)
-        usuario_ref.update({"productos_favoritos": productos_favoritos})
+        await update_doc(usuario_ref, {"productos_favoritos": productos_favoritos})
         
         return {"message": "Producto añadido a favoritos correctamente"}
     except HTTPException as he:
@@ -773,19 +797,18 @@ async def guardar_producto_favorito(user_email: str, producto_id: str):
 async def obtener_productos_favoritos(user_email: str):
     try:
         # Obtener el usuario
-        usuarios_ref = db.collection("usuarios").where("email", "==", user_email).limit(1)
-        usuarios = list(usuarios_ref.stream())
-        if not usuarios:
+        usuario = await buscar_usuario_por_email(user_email)
+        if usuario is None:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        usuario_data = usuarios[0].to_dict()
+        usuario_data = usuario.to_dict()
         productos_favoritos = usuario_data.get("productos_favoritos", [])
         
         # Obtener los detalles de cada producto favorito
         productos = []
         for producto_id in productos_favoritos:
             producto_ref = db.collection("productos").document(producto_id)
-            producto = producto_ref.get()
+            producto = await get_doc(producto_ref)
             if producto.exists:
                 productos.append({"id": producto.id, **producto.to_dict()})
         
@@ -798,15 +821,14 @@ async def obtener_productos_favoritos(user_email: str):
 async def eliminar_producto_favorito(user_email: str, producto_id: str):
     try:
         # Obtener el usuario
-        usuarios_ref = db.collection("usuarios").where("email", "==", user_email).limit(1)
-        usuarios = list(usuarios_ref.stream())
-        if not usuarios:
+        usuario = await buscar_usuario_por_email(user_email)
+        if usuario is None:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        usuario_ref = usuarios[0].reference
+        usuario_ref = usuario.reference
         
         # Obtener los productos favoritos actuales
-        usuario_data = usuario_ref.get().to_dict()
+        usuario_data = usuario.to_dict()
         productos_favoritos = usuario_data.get("productos_favoritos", [])
         
         # Verificar si el producto está en favoritos
@@ -815,7 +837,7 @@ async def eliminar_producto_favorito(user_email: str, producto_id: str):
         
         # Eliminar el producto de la lista de favoritos
         productos_favoritos.remove(producto_id)
-        usuario_ref.update({"productos_favoritos": productos_favoritos})
+        await update_doc(usuario_ref, {"productos_favoritos": productos_favoritos})
         
         return {"message": "Producto eliminado de favoritos correctamente"}
     except HTTPException as he:
@@ -837,12 +859,12 @@ class CompraSinUid(BaseModel):
 async def guardar_metodo_pago(uid: str, tipo: str, datos: dict = Body(...)):
     try:
         user_ref = db.collection("usuarios").document(uid)
-        user_doc = user_ref.get()
+        user_doc = await get_doc(user_ref)
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         metodos = user_doc.to_dict().get("metodos_pago", {})
         metodos[tipo] = datos
-        user_ref.update({"metodos_pago": metodos})
+        await update_doc(user_ref, {"metodos_pago": metodos})
         return {"message": f"Método de pago '{tipo}' guardado correctamente"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -851,13 +873,13 @@ async def guardar_metodo_pago(uid: str, tipo: str, datos: dict = Body(...)):
 async def eliminar_metodo_pago(uid: str, tipo: str):
     try:
         user_ref = db.collection("usuarios").document(uid)
-        user_doc = user_ref.get()
+        user_doc = await get_doc(user_ref)
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         metodos = user_doc.to_dict().get("metodos_pago", {})
         if tipo in metodos:
             del metodos[tipo]
-            user_ref.update({"metodos_pago": metodos})
+            await update_doc(user_ref, {"metodos_pago": metodos})
             return {"message": f"Método de pago '{tipo}' eliminado correctamente"}
         else:
             raise HTTPException(status_code=404, detail=f"Método de pago '{tipo}' no encontrado")
@@ -867,7 +889,7 @@ async def eliminar_metodo_pago(uid: str, tipo: str):
 @app.get("/usuarios/{uid}/metodos_pago")
 async def obtener_metodos_pago(uid: str):
     try:
-        doc = db.collection("usuarios").document(uid).get()
+        doc = await get_doc(db.collection("usuarios").document(uid))
         if doc.exists:
             data = doc.to_dict()
             return data.get("metodos_pago", {})
@@ -876,19 +898,63 @@ async def obtener_metodos_pago(uid: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def get_token_header(Authorization: str = Header(...)):
-    if not Authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Formato de token inválido")
-    return Authorization.split("Bearer ")[-1]
-
 async def verify_user(token: str = Depends(get_token_header)):
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_token(token)
         uid = decoded_token['uid']
         return uid
     except Exception:
         raise HTTPException(status_code=401, detail="Token inválido o expirado")
 
+# Reintentos de la transacción de compra ante contención con otros checkouts
+COMPRA_MAX_REINTENTOS = 10
+
+def _registrar_compra_tx(transaction, compra_dict, user_email):
+    # Agrupar cantidades por producto por si el carrito repite alguno
+    cantidades = {}
+    for producto_item in compra_dict['productos']:
+        producto_id = producto_item['id']
+        cantidades[producto_id] = cantidades.get(producto_id, 0) + producto_item['quantity']
+    
+    # Leer todos los productos del carrito de una vez dentro de la transacción
+    refs = [db.collection("productos").document(producto_id) for producto_id in cantidades]
+    snapshots = {snapshot.id: snapshot for snapshot in transaction.get_all(refs)}
+    
+    for producto_ref in refs:
+        producto_id = producto_ref.id
+        cantidad_comprada = cantidades[producto_id]
+        producto_doc = snapshots.get(producto_id)
+        
+        if producto_doc is None or not producto_doc.exists:
+            raise HTTPException(status_code=404, detail=f"Producto {producto_id} no encontrado")
+        
+        producto_data = producto_doc.to_dict()
+        
+        # Verificar que el usuario no esté comprando su propio producto
+        if producto_data.get('usuario_email') == user_email:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"No puedes comprar tu propio producto: {producto_data.get('nombre', 'producto')}"
+            )
+        
+        stock_actual = producto_data.get('stock', 0)
+        
+        # Verificar que hay suficiente stock
+        if stock_actual < cantidad_comprada:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Stock insuficiente para {producto_data.get('nombre', 'producto')}. Disponible: {stock_actual}, solicitado: {cantidad_comprada}"
+            )
+    
+    # Todas las lecturas hechas: descontar stock y registrar la compra
+    for producto_ref in refs:
+        stock_actual = snapshots[producto_ref.id].to_dict().get('stock', 0)
+        transaction.update(producto_ref, {"stock": stock_actual - cantidades[producto_ref.id]})
+    compra_ref = db.collection("compras").document()
+    transaction.set(compra_ref, compra_dict)
+    incrementar(transaction, COMPRAS)
+    return compra_ref.id
+
 @app.post("/compras")
 async def guardar_compra(compra: CompraSinUid, uid: str = Depends(verify_user)):
     try:
@@ -896,48 +962,18 @@ async def guardar_compra(compra: CompraSinUid, uid: str = Depends(verify_user)):
         compra_dict['uid'] = uid
         
         # Obtener el email del usuario que realiza la compra
-        user_doc = db.collection("usuarios").document(uid).get()
+        user_doc = await get_doc(db.collection("usuarios").document(uid))
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
         user_email = user_doc.to_dict().get('email')
         
-        # Validar y actualizar stock de productos
-        for producto_item in compra_dict['productos']:
-            producto_id = producto_item['id']
-            cantidad_comprada = producto_item['quantity']
-            
-            # Obtener el producto actual
-            producto_ref = db.collection("productos").document(producto_id)
-            producto_doc = producto_ref.get()
-            
-            if not producto_doc.exists:
-                raise HTTPException(status_code=404, detail=f"Producto {producto_id} no encontrado")
-            
-            producto_data = producto_doc.to_dict()
-            
-            # Verificar que el usuario no esté comprando su propio producto
-            if producto_data.get('usuario_email') == user_email:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"No puedes comprar tu propio producto: {producto_data.get('nombre', 'producto')}"
-                )
-            
-            stock_actual = producto_data.get('stock', 0)
-            
-            # Verificar que hay suficiente stock
-            if stock_actual < cantidad_comprada:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Stock insuficiente para {producto_data.get('nombre', 'producto')}. Disponible: {stock_actual}, solicitado: {cantidad_comprada}"
-                )
-            
-            # Actualizar el stock
-            nuevo_stock = stock_actual - cantidad_comprada
-            producto_ref.update({"stock": nuevo_stock})
-        
-        # Registrar la compra después de actualizar el stock
-        db.collection("compras").add(compra_dict)
+        # Validar stock, descontarlo y registrar la compra en una única transacción
+        # (Firestore la reintenta si otro checkout modifica los mismos productos)
+        await run_transaction(
+            _registrar_compra_tx, compra_dict, user_email,
+            max_attempts=COMPRA_MAX_REINTENTOS
+        )
         return {"message": "Compra guardada correctamente y stock actualizado"}
     except HTTPException as he:
         raise he
@@ -948,7 +984,7 @@ async def guardar_compra(compra: CompraSinUid, uid: str = Depends(verify_user)):
 async def obtener_compras(uid: str):
     try:
         compras_ref = db.collection("compras").where("uid", "==", uid)
-        compras = [{"id": compra.id, **compra.to_dict()} for compra in compras_ref.stream()]
+        compras = [{"id": compra.id, **compra.to_dict()} for compra in await stream_docs(compras_ref)]
         # Ordenar por fecha (asumiendo string ISO)
         compras.sort(key=lambda x: x.get("fecha", ""), reverse=True)
         return compras
@@ -958,41 +994,32 @@ async def obtener_compras(uid: str):
 # GET /usuarios/uid/{uid} → Devuelve un usuario específico por UID
 @app.get("/usuarios/uid/{uid}")
 async def obtener_usuario_por_uid(uid: str):
-    doc = db.collection("usuarios").document(uid).get()
+    doc = await get_doc(db.collection("usuarios").document(uid))
     if not doc.exists:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     return {"id": doc.id, **doc.to_dict()}
 
 @app.get("/usuarios/email/{email}")
 async def obtener_usuario_por_email(email: str):
-    email = email.strip().lower()
-    usuarios_ref = db.collection("usuarios").where("email", "==", email).limit(1)
-    usuarios = list(usuarios_ref.stream())
-    if not usuarios:
-        # Buscar manualmente por si hay problemas de mayúsculas/minúsculas
-        all_users = db.collection("usuarios").stream()
-        for user in all_users:
-            data = user.to_dict()
-            if data.get("email", "").strip().lower() == email:
-                return {"id": user.id, **data}
+    # Resolución por el índice de emails normalizados (sin recorrer la colección)
+    usuario = await buscar_usuario_por_email(email)
+    if usuario is None:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    return {"id": usuarios[0].id, **usuarios[0].to_dict()}
+    return {"id": usuario.id, **usuario.to_dict()}
 
 @app.delete("/articulos/{articulo_id}/comentarios/{comentario_id}")
 async def eliminar_comentario(articulo_id: str, comentario_id: str, usuario: str = None):
     try:
         comentario_ref = db.collection("articulos").document(articulo_id).collection("comentarios").document(comentario_id)
-        comentario = comentario_ref.get()
+        comentario = await get_doc(comentario_ref)
         if not comentario.exists:
             raise HTTPException(status_code=404, detail="Comentario no encontrado")
         if usuario and comentario.to_dict().get("usuario") != usuario:
             raise HTTPException(status_code=403, detail="No tienes permiso para borrar este comentario")
-        # Eliminar posibles respuestas
-        respuestas_ref = comentario_ref.collection("respuestas").stream()
-        for r in respuestas_ref:
-            comentario_ref.collection("respuestas").document(r.id).delete()
-        comentario_ref.delete()
-        return {"message": "Comentario eliminado correctamente"}
+        # El comentario desaparece ya; sus respuestas se borran en segundo plano
+        await delete_doc(comentario_ref)
+        borrado_id = await programar_borrado(f"respuestas del comentario {comentario_id}", [coleccion(comentario_ref.collection("respuestas"))])
+        return {"message": "Comentario eliminado correctamente", "borrado_id": borrado_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1000,12 +1027,12 @@ async def eliminar_comentario(articulo_id: str, comentario_id: str, usuario: str
 async def eliminar_respuesta(articulo_id: str, comentario_id: str, respuesta_id: str, usuario: str = None):
     try:
         respuesta_ref = db.collection("articulos").document(articulo_id).collection("comentarios").document(comentario_id).collection("respuestas").document(respuesta_id)
-        respuesta = respuesta_ref.get()
+        respuesta = await get_doc(respuesta_ref)
         if not respuesta.exists:
             raise HTTPException(status_code=404, detail="Respuesta no encontrada")
         if usuario and respuesta.to_dict().get("usuario") != usuario:
             raise HTTPException(status_code=403, detail="No tienes permiso para borrar esta respuesta")
-        respuesta_ref.delete()
+        await delete_doc(respuesta_ref)
         return {"message": "Respuesta eliminada correctamente"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1014,12 +1041,12 @@ async def eliminar_respuesta(articulo_id: str, comentario_id: str, respuesta_id:
 @app.get("/usuarios/{uid}/articulos")
 async def get_user_articles(uid: str):
     try:
-        user_doc = db.collection("usuarios").document(uid).get()
+        user_doc = await get_doc(db.collection("usuarios").document(uid))
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         user_email = user_doc.to_dict().get("email")
         articulos_ref = db.collection("articulos").where("autor_email", "==", user_email)
-        articulos = [{"id": doc.id, **doc.to_dict()} for doc in articulos_ref.stream()]
+        articulos = [{"id": doc.id, **doc.to_dict()} for doc in await stream_docs(articulos_ref)]
         return articulos
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -1028,12 +1055,12 @@ async def get_user_articles(uid: str):
 @app.get("/usuarios/{uid}/ventas")
 async def get_user_ventas(uid: str):
     try:
-        user_doc = db.collection("usuarios").document(uid).get()
+        user_doc = await get_doc(db.collection("usuarios").document(uid))
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         user_email = user_doc.to_dict().get("email")
         productos_ref = db.collection("productos").where("usuario_email", "==", user_email)
-        productos = [{"id": doc.id, **doc.to_dict()} for doc in productos_ref.stream()]
+        productos = [{"id": doc.id, **doc.to_dict()} for doc in await stream_docs(productos_ref)]
         return productos
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -1,29 +1,81 @@
+import time
+import hashlib
+from collections import OrderedDict
 from fastapi import HTTPException, Depends, Header
 from firebase_admin import auth
 from firebase_config import db
+from firestore_async import get_doc, run_blocking
+
+# Caché de tokens ya verificados: la verificación de firma (y la descarga de las claves
+# públicas de Google, que firebase_admin cachea según su Cache-Control) solo se hace la
+# primera vez; después se reutiliza el token decodificado hasta su "exp".
+TOKEN_CACHE_SIZE = 2048
+# Caché de los datos de usuario para mostrar nombres (eventos de typing, etc.). Es local a
+# cada worker, así que no sirve para decidir permisos: verify_admin lee siempre el rol
+USER_CACHE_TTL = 300
+
+_token_cache: "OrderedDict[str, dict]" = OrderedDict()
+_user_cache: "OrderedDict[str, tuple]" = OrderedDict()
 
 async def get_token_header(Authorization: str = Header(...)):
     if not Authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Formato de token inválido")
     return Authorization.split("Bearer ")[-1]
 
+async def verify_token(token: str) -> dict:
+    """Verifica un ID token de Firebase reutilizando el resultado hasta que expire"""
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = _token_cache.get(key)
+    if cached is not None and cached.get("exp", 0) > time.time():
+        _token_cache.move_to_end(key)
+        return cached
+    decoded_token = await run_blocking(auth.verify_id_token, token)
+    _token_cache[key] = decoded_token
+    _token_cache.move_to_end(key)
+    while len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return decoded_token
+
+async def get_cached_user(uid: str):
+    """Datos del usuario en Firestore con caché de USER_CACHE_TTL segundos"""
+    cached = _user_cache.get(uid)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    return await get_fresh_user(uid)
+
+async def get_fresh_user(uid: str):
+    """Lee el usuario de Firestore (sin caché) y refresca la entrada cacheada"""
+    user_doc = await get_doc(db.collection("usuarios").document(uid))
+    if not user_doc.exists:
+        _user_cache.pop(uid, None)
+        return None
+    user_data = user_doc.to_dict()
+    _user_cache[uid] = (user_data, time.time() + USER_CACHE_TTL)
+    _user_cache.move_to_end(uid)
+    while len(_user_cache) > TOKEN_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    return user_data
+
+def invalidate_user_cache(uid: str):
+    """Debe llamarse al cambiar el rol de un usuario o eliminarlo"""
+    _user_cache.pop(uid, None)
+
 async def verify_admin(token: str = Depends(get_token_header)):
     try:
         # Verificar el token de Firebase
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_token(token)
         uid = decoded_token['uid']
         
-        # Obtener el usuario de Firestore
-        user_doc = db.collection("usuarios").document(uid).get()
+        # El rol se lee siempre de Firestore: la caché es por worker y otro worker puede
+        # haber degradado o eliminado al usuario
+        user_data = await get_fresh_user(uid)
         
-        if not user_doc.exists:
+        if user_data is None:
             raise HTTPException(
                 status_code=401,
                 detail="Usuario no encontrado"
             )
             
-        user_data = user_doc.to_dict()
-        
         # Verificar si el usuario es administrador
         if user_data.get("role") != "admin":
             raise HTTPException(
@@ -41,7 +93,7 @@ async def verify_admin(token: str = Depends(get_token_header)):
 
 async def get_current_uid(token: str = Depends(get_token_header)):
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_token(token)
         return decoded_token['uid']
     except Exception:
         raise HTTPException(status_code=401, detail="Token inválido o expirado") 
\ No newline at end of file
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from firebase_config import db
+from firestore_async import run_blocking, get_doc
+from contadores import sembrar_contadores, USUARIOS, PRODUCTOS, ARTICULOS, COMPRAS
+from indice_emails import indice_completo, indexar_emails_existentes
+
+# Migraciones de datos que se aplican solas al arrancar la API, en segundo plano para
+# no retrasar el arranque. Cada una comprueba su propia marca antes de hacer nada, así
+# que repetirlas en cada reinicio (o en varios workers a la vez) es inocuo.
+logger = logging.getLogger(__name__)
+
+# Marcas de las migraciones terminadas: migraciones/{nombre}
+MIGRACIONES_COLLECTION = "migraciones"
+MAX_BATCH_WRITES = 500
+RESPUESTAS_INDEXADAS = "respuestas_articulo_id"
+
+_tarea = None
+_completadas = set()
+
+def _marca(nombre: str):
+    return db.collection(MIGRACIONES_COLLECTION).document(nombre)
+
+async def migracion_completada(nombre: str) -> bool:
+    # Solo se cachea el sí: mientras no termine hay que volver a mirar
+    if nombre not in _completadas and (await get_doc(_marca(nombre))).exists:
+        _completadas.add(nombre)
+    return nombre in _completadas
+
+def indexar_respuestas_existentes() -> int:
+    """
+    Añade articulo_id y comentario_padre a las respuestas anteriores a la consulta de
+    grupo de GET /articulos/{id}/comentarios y deja la marca de completado
+    """
+    batch = db.batch()
+    pendientes = 0
+    total = 0
+    for respuesta in db.collection_group("respuestas").stream():
+        data = respuesta.to_dict()
+        # Ruta: articulos/{articulo}/comentarios/{comentario}/respuestas/{respuesta}
+        comentario_ref = respuesta.reference.parent.parent
+        articulo_id = comentario_ref.parent.parent.id
+        if data.get("articulo_id") == articulo_id and data.get("comentario_padre") == comentario_ref.id:
+            continue
+        batch.update(respuesta.reference, {"articulo_id": articulo_id, "comentario_padre": comentario_ref.id})
+        pendientes += 1
+        total += 1
+        if pendientes == MAX_BATCH_WRITES:
+            batch.commit()
+            batch = db.batch()
+            pendientes = 0
+    if pendientes:
+        batch.commit()
+    _marca(RESPUESTAS_INDEXADAS).set({"completada": True, "respuestas": total})
+    return total
+
+async def ejecutar_migraciones():
+    try:
+        sembrados = await sembrar_contadores([USUARIOS, PRODUCTOS, ARTICULOS, COMPRAS])
+        if sembrados:
+            logger.info(f"Contadores sembrados con count(): {', '.join(sembrados)}")
+    except Exception as e:
+        logger.error(f"Error sembrando los contadores: {e}")
+    try:
+        if not await indice_completo():
+            total = await run_blocking(indexar_emails_existentes)
+            logger.info(f"Índice de emails creado para {total} usuarios")
+    except Exception as e:
+        logger.error(f"Error creando el índice de emails: {e}")
+    try:
+        if not await migracion_completada(RESPUESTAS_INDEXADAS):
+            total = await run_blocking(indexar_respuestas_existentes)
+            _completadas.add(RESPUESTAS_INDEXADAS)
+            logger.info(f"Respuestas de comentarios indexadas: {total}")
+    except Exception as e:
+        logger.error(f"Error indexando las respuestas de comentarios: {e}")
+
+def lanzar_migraciones():
+    """Programa las migraciones en el bucle de eventos (llamar desde el arranque de la app)"""
+    global _tarea
+    # Mantener la referencia para que la tarea no se recolecte a medias
+    _tarea = asyncio.get_running_loop().create_task(ejecutar_migraciones())
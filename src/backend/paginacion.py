@@ -0,0 +1,85 @@
+import re
+from typing import Any, Dict, Iterable, List, Optional
+from fastapi import HTTPException, Query, Response
+from firebase_admin import firestore
+from firestore_async import get_doc, stream_docs
+
+# Cabecera en la que se devuelve el cursor de la siguiente página. El cuerpo sigue
+# siendo una lista para no romper a los clientes que ya consumen estos endpoints.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = 100
+# Los listados del panel de administración siempre van paginados
+ADMIN_PAGE_SIZE = 50
+
+_FIELD_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+class PageParams:
+    """Parámetros comunes de paginación por cursor, ordenación y proyección"""
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        start_after: Optional[str] = Query(None),
+        order_by: Optional[str] = Query(None),
+        order: str = Query("asc", pattern="^(asc|desc)$"),
+        fields: Optional[str] = Query(None)
+    ):
+        self.limit = limit
+        self.start_after = start_after
+        self.order_by = order_by
+        self.order = order
+        self.fields = parse_fields(fields)
+
+class AdminPageParams(PageParams):
+    """Como PageParams, pero con un tamaño de página por defecto en lugar de la lista completa"""
+    def __init__(
+        self,
+        limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        start_after: Optional[str] = Query(None),
+        order_by: Optional[str] = Query(None),
+        order: str = Query("asc", pattern="^(asc|desc)$"),
+        fields: Optional[str] = Query(None)
+    ):
+        super().__init__(limit, start_after, order_by, order, fields)
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    parsed = [f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id"]
+    for field in parsed:
+        if not _FIELD_RE.match(field):
+            raise HTTPException(status_code=400, detail=f"Campo no válido: {field}")
+    # Solo se pidió el id: basta con proyectar un campo vacío
+    return parsed or ["__name__"]
+
+async def fetch_page(
+    collection_ref,
+    page: PageParams,
+    response: Response,
+    allowed_order: Iterable[str] = ()
+) -> List[Dict[str, Any]]:
+    """Lee una página de la colección y deja el cursor siguiente en la cabecera de respuesta"""
+    if page.order_by and page.order_by not in allowed_order:
+        raise HTTPException(status_code=400, detail=f"No se puede ordenar por '{page.order_by}'")
+
+    query = collection_ref
+    if page.fields:
+        query = query.select(page.fields)
+    if page.order_by:
+        direction = firestore.Query.DESCENDING if page.order == "desc" else firestore.Query.ASCENDING
+        query = query.order_by(page.order_by, direction=direction)
+    elif page.limit or page.start_after:
+        # Orden estable por id para que el cursor sea determinista
+        query = query.order_by("__name__")
+
+    if page.start_after:
+        cursor = await get_doc(collection_ref.document(page.start_after))
+        if not cursor.exists:
+            raise HTTPException(status_code=400, detail="Cursor de paginación no válido")
+        query = query.start_after(cursor)
+    if page.limit:
+        query = query.limit(page.limit)
+
+    docs = await stream_docs(query)
+    if page.limit and len(docs) == page.limit:
+        response.headers[NEXT_CURSOR_HEADER] = docs[-1].id
+    return [{"id": doc.id, **doc.to_dict()} for doc in docs]
@@ -0,0 +1,113 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+# Control de admisión para el modelo local: como mucho ASSISTANT_MAX_CONCURRENT
+# generaciones a la vez; el resto espera en una cola por usuario que se atiende por
+# turnos, para que un usuario con muchas peticiones no deje sin servicio a los demás.
+# Con la cola llena (o tras esperar demasiado) se responde enseguida con 503.
+ASSISTANT_MAX_CONCURRENT = int(os.getenv("ASSISTANT_MAX_CONCURRENT", "2"))
+ASSISTANT_MAX_QUEUE = int(os.getenv("ASSISTANT_MAX_QUEUE", "32"))
+ASSISTANT_QUEUE_TIMEOUT = float(os.getenv("ASSISTANT_QUEUE_TIMEOUT", "30"))
+# Esperas recientes usadas para las métricas
+MUESTRAS_ESPERA = 500
+
+class AsistenteOcupado(Exception):
+    pass
+
+class PlanificadorAsistente:
+    def __init__(self, max_concurrentes: int = ASSISTANT_MAX_CONCURRENT, max_cola: int = ASSISTANT_MAX_QUEUE,
+                 timeout: float = ASSISTANT_QUEUE_TIMEOUT):
+        self.max_concurrentes = max_concurrentes
+        self.max_cola = max_cola
+        self.timeout = timeout
+        self._en_curso = 0
+        self._pendientes = 0
+        # usuario -> esperas pendientes; el orden del OrderedDict es el turno
+        self._colas: "OrderedDict[str, deque]" = OrderedDict()
+        self._esperas = deque(maxlen=MUESTRAS_ESPERA)
+        self._completadas = 0
+        self._rechazadas = 0
+        self._expiradas = 0
+
+    def lleno(self) -> bool:
+        return self._en_curso >= self.max_concurrentes and self._pendientes >= self.max_cola
+
+    def _quitar(self, usuario: str, espera: asyncio.Future):
+        cola = self._colas.get(usuario)
+        if cola is None or espera not in cola:
+            return
+        cola.remove(espera)
+        self._pendientes -= 1
+        if not cola:
+            del self._colas[usuario]
+
+    async def adquirir(self, usuario: str):
+        if self._en_curso < self.max_concurrentes and not self._pendientes:
+            self._en_curso += 1
+            self._esperas.append(0.0)
+            return
+        if self._pendientes >= self.max_cola:
+            self._rechazadas += 1
+            raise AsistenteOcupado()
+
+        espera = asyncio.get_running_loop().create_future()
+        self._colas.setdefault(usuario, deque()).append(espera)
+        self._pendientes += 1
+        inicio = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(espera), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if espera.done() and not espera.cancelled():
+                # El turno llegó a la vez que el timeout o la desconexión: devolverlo
+                self.liberar()
+            else:
+                espera.cancel()
+                self._quitar(usuario, espera)
+            if isinstance(e, asyncio.TimeoutError):
+                self._expiradas += 1
+                raise AsistenteOcupado()
+            raise
+        self._esperas.append(time.monotonic() - inicio)
+
+    def liberar(self):
+        # Ceder el hueco al primer usuario en turno; pasa al final si le quedan peticiones
+        while self._colas:
+            usuario, cola = self._colas.popitem(last=False)
+            espera = cola.popleft()
+            self._pendientes -= 1
+            if cola:
+                self._colas[usuario] = cola
+            if not espera.done():
+                espera.set_result(None)
+                return
+        self._en_curso -= 1
+
+    @asynccontextmanager
+    async def turno(self, usuario: str):
+        await self.adquirir(usuario)
+        try:
+            yield
+        finally:
+            self._completadas += 1
+            self.liberar()
+
+    def metricas(self) -> dict:
+        esperas = sorted(self._esperas)
+        return {
+            "en_curso": self._en_curso,
+            "en_cola": self._pendientes,
+            "usuarios_en_cola": len(self._colas),
+            "max_concurrentes": self.max_concurrentes,
+            "max_cola": self.max_cola,
+            "completadas": self._completadas,
+            "rechazadas": self._rechazadas,
+            "expiradas": self._expiradas,
+            "espera_media": round(sum(esperas) / len(esperas), 3) if esperas else 0.0,
+            "espera_p95": round(esperas[int(len(esperas) * 0.95) - 1], 3) if esperas else 0.0,
+            "espera_max": round(esperas[-1], 3) if esperas else 0.0
+        }
+
+planificador = PlanificadorAsistente()
@@ -0,0 +1,74 @@
+"""
+Prueba de carga del checkout: lanza muchas compras concurrentes de un mismo producto
+contra POST /compras y comprueba que nunca se vende más stock del disponible.
+
+Uso (con el backend arrancado):
+    python prueba_carga_compras.py --producto <id> --token <idToken> [--token <otro>] \
+        [--concurrencia 100] [--url http://localhost:8000]
+
+El producto debe pertenecer a otro usuario y tener menos stock que la concurrencia,
+para que haya checkouts que compitan por las últimas unidades.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime
+from itertools import cycle
+import httpx
+
+async def comprar(client, url, token, producto_id):
+    compra = {
+        "productos": [{"id": producto_id, "quantity": 1}],
+        "total": 0,
+        "metodo_pago": {"tipo": "prueba_carga"},
+        "fecha": datetime.now().isoformat()
+    }
+    response = await client.post(
+        f"{url}/compras",
+        json=compra,
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    return response.status_code, response.text
+
+async def leer_stock(client, url, producto_id):
+    response = await client.get(f"{url}/productos/{producto_id}")
+    response.raise_for_status()
+    return response.json().get("stock", 0)
+
+async def main(args):
+    limits = httpx.Limits(max_connections=args.concurrencia)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        stock_inicial = await leer_stock(client, args.url, args.producto)
+        print(f"Stock inicial: {stock_inicial} | compras concurrentes: {args.concurrencia}")
+
+        tokens = cycle(args.token)
+        inicio = time.perf_counter()
+        resultados = await asyncio.gather(*[
+            comprar(client, args.url, next(tokens), args.producto)
+            for _ in range(args.concurrencia)
+        ])
+        duracion = time.perf_counter() - inicio
+
+        exitos = sum(1 for status, _ in resultados if status == 200)
+        sin_stock = sum(1 for status, texto in resultados if status == 400 and "Stock insuficiente" in texto)
+        errores = [(status, texto) for status, texto in resultados if status not in (200, 400)]
+        stock_final = await leer_stock(client, args.url, args.producto)
+
+    print(f"Completado en {duracion:.2f}s: {exitos} compras, {sin_stock} rechazadas por stock, {len(errores)} errores")
+    print(f"Stock final: {stock_final}")
+    for status, texto in errores[:5]:
+        print(f"  Error {status}: {texto}")
+
+    # Sin sobreventa: cada compra aceptada descuenta exactamente una unidad
+    ok = exitos <= stock_inicial and stock_final == stock_inicial - exitos and stock_final >= 0
+    print("OK: no hay sobreventa" if ok else "FALLO: el stock no cuadra con las compras aceptadas")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga de POST /compras")
+    parser.add_argument("--producto", required=True, help="ID del producto a comprar")
+    parser.add_argument("--token", required=True, action="append", help="idToken de Firebase del comprador (repetible)")
+    parser.add_argument("--concurrencia", type=int, default=100)
+    parser.add_argument("--url", default="http://localhost:8000")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,119 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+import cloudinary.uploader
+
+# Servicio de subida a Cloudinary. cloudinary.uploader es bloqueante, así que las subidas
+# se hacen en un pool propio (para no competir con Firestore) y las de una misma petición
+# se lanzan a la vez: un producto con 5 imágenes tarda lo que la más lenta, no la suma.
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "8"))
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+# A partir de este tamaño se usa la subida por trozos de Cloudinary
+UPLOAD_CHUNK_SIZE = 6 * 1024 * 1024
+# Tope del cuerpo multipart completo (todas las imágenes y campos de una petición)
+MAX_UPLOAD_REQUEST_SIZE = int(os.getenv("MAX_UPLOAD_REQUEST_SIZE", str(50 * 1024 * 1024)))
+
+_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_MAX_WORKERS,
+    thread_name_prefix="cloudinary"
+)
+
+def es_imagen(archivo: Optional[UploadFile]) -> bool:
+    return bool(
+        archivo is not None
+        and getattr(archivo, "filename", None)
+        and getattr(archivo, "content_type", None)
+        and archivo.content_type.startswith("image/")
+    )
+
+def tamano_archivo(archivo: UploadFile) -> int:
+    if getattr(archivo, "size", None) is not None:
+        return archivo.size
+    # Sin tamaño conocido: medir el fichero temporal sin leerlo en memoria
+    posicion = archivo.file.tell()
+    archivo.file.seek(0, os.SEEK_END)
+    tamano = archivo.file.tell()
+    archivo.file.seek(posicion)
+    return tamano
+
+class LimiteSubidas:
+    """
+    Middleware ASGI que corta las peticiones multipart demasiado grandes antes de que
+    Starlette las procese y vuelque a disco: por Content-Length si viene y, si no,
+    contando los bytes a medida que se reciben.
+    """
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_REQUEST_SIZE):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            respuesta = JSONResponse({"detail": self._mensaje()}, status_code=413)
+            return await respuesta(scope, receive, send)
+
+        recibidos = 0
+        async def receive_limitado():
+            nonlocal recibidos
+            message = await receive()
+            if message["type"] == "http.request":
+                recibidos += len(message.get("body", b""))
+                if recibidos > self.max_bytes:
+                    # FastAPI propaga las HTTPException lanzadas al leer el formulario
+                    raise HTTPException(status_code=413, detail=self._mensaje())
+            return message
+
+        await self.app(scope, receive_limitado, send)
+
+    def _mensaje(self) -> str:
+        return f"La petición supera los {self.max_bytes // (1024 * 1024)}MB"
+
+def validar_tamano(archivo: UploadFile, max_bytes: int = MAX_IMAGE_SIZE):
+    # Límite por imagen, ya con el cuerpo recibido (el de la petición entera lo pone LimiteSubidas)
+    if tamano_archivo(archivo) > max_bytes:
+        raise HTTPException(status_code=400, detail=f"La imagen supera los {max_bytes // (1024 * 1024)}MB")
+
+def _subir(archivo: UploadFile, folder: str) -> dict:
+    # Se pasa el fichero temporal de Starlette a Cloudinary. upload() lo lee entero en
+    # memoria (como mucho UPLOAD_CHUNK_SIZE); por encima, upload_large lo lee por trozos
+    archivo.file.seek(0)
+    if tamano_archivo(archivo) > UPLOAD_CHUNK_SIZE:
+        return cloudinary.uploader.upload_large(
+            archivo.file,
+            folder=folder,
+            resource_type="auto",
+            chunk_size=UPLOAD_CHUNK_SIZE
+        )
+    return cloudinary.uploader.upload(
+        archivo.file,
+        folder=folder,
+        resource_type="auto"
+    )
+
+async def subir_archivo(archivo: UploadFile, folder: str, max_bytes: int = MAX_IMAGE_SIZE) -> dict:
+    """Sube un archivo a Cloudinary en el pool de subidas y devuelve la respuesta"""
+    validar_tamano(archivo, max_bytes)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(_subir, archivo, folder))
+
+async def subir_imagenes(archivos: List[UploadFile], folder: str, ignorar_errores: bool = False) -> List[str]:
+    """Sube en paralelo las imágenes válidas y devuelve sus URLs en el orden recibido"""
+    imagenes = [archivo for archivo in archivos or [] if es_imagen(archivo)]
+    # Los límites se comprueban antes de empezar cualquier subida
+    for imagen in imagenes:
+        validar_tamano(imagen)
+    resultados = await asyncio.gather(
+        *[subir_archivo(imagen, folder) for imagen in imagenes],
+        return_exceptions=ignorar_errores
+    )
+    return [r["secure_url"] for r in resultados if not isinstance(r, Exception)]
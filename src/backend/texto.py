@@ -0,0 +1,12 @@
+import re
+import unicodedata
+from typing import Optional
+
+# Utilidades de texto compartidas por la caché de respuestas y el índice del FAQ
+
+def normalizar_texto(texto: Optional[str]) -> str:
+    # Minúsculas, sin tildes, sin signos de puntuación y con espacios simples
+    texto = unicodedata.normalize("NFKD", (texto or "").lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[^\w\s]", " ", texto)
+    return " ".join(texto.split())
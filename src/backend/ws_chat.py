@@ -1,26 +1,100 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
 from typing import Dict, List
 from collections import defaultdict
 from auth import get_current_uid_ws
-from chat_routes import send_message as save_message_rest, mark_chat_as_read
-from firebase_config import db
+from chat_routes import get_chat_participants, save_direct_message, save_direct_messages, mark_chat_as_read
+from middleware import get_cached_user
+from broker_chat import crear_broker
+import os
 import json
+import heapq
 import asyncio
+import logging
 import datetime
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
-# Estructura: chat_id -> set(conexiones WebSocket)
-active_connections: Dict[str, List[WebSocket]] = defaultdict(list)
-# Estructura: chat_id -> {uid: {"name": user_name, "timestamp": datetime}}
+# Mensajes pendientes de envío por conexión; si un cliente lento la llena, se le desconecta
+SEND_QUEUE_SIZE = 100
+# Tiempo máximo de un envío antes de dar la conexión por muerta
+SEND_TIMEOUT = 10
+# Mientras el usuario sigue escribiendo, como mucho un evento de typing por segundo
+TYPING_DEBOUNCE = 1.0
+# Segundos sin eventos de typing tras los que se considera que el usuario dejó de escribir
+TYPING_TIMEOUT = 3.0
+# Modo write-behind opcional: los mensajes de un chat se agrupan durante una ventana
+# corta (o hasta N mensajes) y se guardan en un único batch, en el orden de llegada
+WRITE_BEHIND = os.getenv("WS_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+WRITE_BEHIND_WINDOW = float(os.getenv("WS_WRITE_BEHIND_WINDOW", "0.05"))
+WRITE_BEHIND_MAX_MESSAGES = int(os.getenv("WS_WRITE_BEHIND_MAX_MESSAGES", "50"))
+
+class ClientConnection:
+    """Socket con su cola de salida y una tarea propia que la vacía"""
+    def __init__(self, websocket: WebSocket, chat_id: str, uid: str, participants: List[str]):
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.uid = uid
+        # Participación comprobada al conectar, válida durante toda la conexión
+        self.participants = participants
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.closed = False
+        self.writer = asyncio.get_running_loop().create_task(self._write())
+
+    def send(self, text: str):
+        """Encola sin bloquear; devuelve False si la conexión se ha expulsado"""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            asyncio.get_running_loop().create_task(self.evict(1013))
+            return False
+
+    async def _write(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Conexión muerta o demasiado lenta
+            await self.evict(1011)
+
+    async def evict(self, code: int):
+        if self.closed:
+            return
+        self.closed = True
+        remove_connection(self)
+        if asyncio.current_task() is not self.writer:
+            self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+# Estructura: chat_id -> lista de conexiones
+active_connections: Dict[str, List[ClientConnection]] = defaultdict(list)
+# Estructura: chat_id -> {uid: {"name": user_name, "expires_at": float, "broadcast_at": float}} (reloj del loop)
 typing_users: Dict[str, Dict[str, Dict]] = defaultdict(dict)
+# Reparto de eventos entre workers (en memoria si no hay WS_BROKER_URL)
+broker = crear_broker()
+# Chats con suscripción activa en el broker. Suscribir y desuscribir hacen await, así que
+# se serializan con un lock: si no, un socket que conecta mientras el último se está
+# desuscribiendo quedaría en un chat sin canal y dejaría de recibir eventos.
+subscribed_chats = set()
+subscription_lock = asyncio.Lock()
 
 async def get_user_name(uid: str) -> str:
-    """Obtener el nombre del usuario desde Firestore"""
+    """
+    Obtener el nombre del usuario. Usa la caché de usuarios de middleware, que se
+    invalida al editar el perfil, así que los eventos de typing no leen Firestore.
+    """
     try:
-        user_doc = db.collection("usuarios").document(uid).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data = await get_cached_user(uid)
+        if user_data is not None:
             return user_data.get("nombre", user_data.get("email", uid))
         return uid
     except Exception:
@@ -33,29 +107,122 @@ async def broadcast(chat_id: str, data: dict, exclude_uid: str = None):
         if isinstance(msg.get('timestamp'), datetime.datetime):
             msg['timestamp'] = msg['timestamp'].isoformat()
     
-    for ws in active_connections[chat_id]:
+    # El broker lo entrega a los sockets del chat en todos los workers
+    await broker.publicar(chat_id, {"data": data, "exclude_uid": exclude_uid})
+
+def remove_connection(connection: ClientConnection):
+    connections = active_connections.get(connection.chat_id)
+    if connections and connection in connections:
+        connections.remove(connection)
+
+async def add_connection(connection: ClientConnection):
+    async with subscription_lock:
+        if connection.chat_id not in subscribed_chats:
+            # Primer socket del chat en este worker
+            await broker.suscribir(connection.chat_id, deliver_local)
+            subscribed_chats.add(connection.chat_id)
+        active_connections[connection.chat_id].append(connection)
+
+async def release_chat(chat_id: str):
+    """Desuscribe el chat si ya no le queda ningún socket en este worker"""
+    async with subscription_lock:
+        if active_connections.get(chat_id) or chat_id not in subscribed_chats:
+            return
+        active_connections.pop(chat_id, None)
+        subscribed_chats.discard(chat_id)
+        await broker.desuscribir(chat_id)
+        typing_users.pop(chat_id, None)
+
+async def deliver_local(chat_id: str, event: dict):
+    """Encola un evento recibido del broker en los sockets de este worker"""
+    data = event["data"]
+    exclude_uid = event.get("exclude_uid")
+    # Se serializa una sola vez para todas las conexiones
+    text = json.dumps(data)
+    for connection in list(active_connections.get(chat_id, [])):
+        # Si es un evento de typing, no enviarlo al propio usuario que escribe
+        if data.get('event') == 'typing' and exclude_uid and connection.uid == exclude_uid:
+            continue
+        connection.send(text)
+
+def send_ack(connection: ClientConnection, client_id, message_obj: dict):
+    """Confirma al remitente que su mensaje está guardado"""
+    connection.send(json.dumps({"event": "ack", "client_id": client_id, "message_id": message_obj["id"]}))
+
+class ChatWriteBuffer:
+    """Mensajes de un chat pendientes de guardar en modo write-behind"""
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.pending: List[tuple] = []
+        self.full = asyncio.Event()
+        self.flush_task = None
+        # Los flushes de un chat se ejecutan de uno en uno y en orden (Lock es FIFO)
+        self.lock = asyncio.Lock()
+        self.flushing = 0
+
+    def add(self, connection: ClientConnection, content: str, client_id):
+        self.pending.append((connection, content, client_id))
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush_after_window())
+        if len(self.pending) >= WRITE_BEHIND_MAX_MESSAGES:
+            self.full.set()
+
+    async def _flush_after_window(self):
         try:
-            # Si es un evento de typing y el usuario está excluido, no enviar
-            if data.get('event') == 'typing' and exclude_uid and data.get('user_uid') == exclude_uid:
-                continue
-            await ws.send_text(json.dumps(data))
-        except Exception:
+            await asyncio.wait_for(self.full.wait(), WRITE_BEHIND_WINDOW)
+        except asyncio.TimeoutError:
             pass
+        pending, self.pending = self.pending, []
+        self.full.clear()
+        self.flush_task = None
+        self.flushing += 1
+        try:
+            async with self.lock:
+                for start in range(0, len(pending), WRITE_BEHIND_MAX_MESSAGES):
+                    await self._flush(pending[start:start + WRITE_BEHIND_MAX_MESSAGES])
+        finally:
+            self.flushing -= 1
+        # Sin nada pendiente ni en curso, el buffer del chat ya no hace falta
+        if not self.pending and self.flush_task is None and not self.flushing:
+            write_buffers.pop(self.chat_id, None)
+
+    async def _flush(self, pending: List[tuple]):
+        try:
+            saved = await save_direct_messages(
+                self.chat_id,
+                pending[0][0].participants,
+                [(connection.uid, content, "text") for connection, content, _ in pending]
+            )
+        except Exception as e:
+            print(f"Error guardando mensajes del chat {self.chat_id}:", e)
+            for connection, _, client_id in pending:
+                connection.send(json.dumps({"event": "error", "client_id": client_id, "detail": "No se pudo enviar el mensaje"}))
+            return
+        for (connection, _, client_id), message_obj in zip(pending, saved):
+            await broadcast(self.chat_id, {"event": "message", "message": message_obj})
+            send_ack(connection, client_id, message_obj)
+
+# Estructura: chat_id -> mensajes pendientes (solo en modo write-behind)
+write_buffers: Dict[str, ChatWriteBuffer] = {}
+
+def get_write_buffer(chat_id: str) -> ChatWriteBuffer:
+    if chat_id not in write_buffers:
+        write_buffers[chat_id] = ChatWriteBuffer(chat_id)
+    return write_buffers[chat_id]
 
 @router.websocket("/ws/direct-chats/{chat_id}")
 async def websocket_chat(websocket: WebSocket, chat_id: str, uid: str = Depends(get_current_uid_ws)):
-    active_connections[chat_id].append(websocket)
-    
-    # Iniciar tarea de limpieza si no está corriendo
-    global cleanup_task
-    if cleanup_task is None:
-        try:
-            loop = asyncio.get_running_loop()
-            cleanup_task = loop.create_task(cleanup_typing_users())
-        except Exception:
-            pass
+    try:
+        participants = await get_chat_participants(chat_id, uid)
+    except HTTPException as e:
+        await websocket.close(code=4404 if e.status_code == 404 else 4403)
+        return
+    connection = ClientConnection(websocket, chat_id, uid, participants)
     
     try:
+        await add_connection(connection)
+        # Precargar el nombre para los eventos de typing
+        await get_user_name(uid)
         while True:
             data = await websocket.receive_text()
             try:
@@ -67,16 +234,40 @@ async def websocket_chat(websocket: WebSocket, chat_id: str, uid: str = Depends(
                 content = msg.get("content", "")
                 if not content:
                     continue
-                # Guardar en Firestore y obtener el mensaje guardado
-                message_obj = await save_message_rest(chat_id, type("DirectMessage", (), {"content": content, "type": "text"})(), uid)
+                client_id = msg.get("client_id")
+                if WRITE_BEHIND:
+                    # Se guarda con el resto de mensajes de la ventana; el ack llega tras el flush
+                    get_write_buffer(chat_id).add(connection, content, client_id)
+                    continue
+                # Guardar en Firestore (mensaje y last_message en un solo batch)
+                try:
+                    message_obj = await save_direct_message(chat_id, connection.participants, uid, content)
+                except Exception:
+                    logger.exception(f"Error guardando un mensaje del chat {chat_id}")
+                    connection.send(json.dumps({"event": "error", "client_id": client_id, "detail": "No se pudo enviar el mensaje"}))
+                    continue
                 await broadcast(chat_id, {"event": "message", "message": message_obj})
+                send_ack(connection, client_id, message_obj)
             elif event == "typing":
-                # Obtener el nombre del usuario y almacenar con timestamp
-                user_name = await get_user_name(uid)
-                typing_users[chat_id][uid] = {
-                    "name": user_name,
-                    "timestamp": datetime.datetime.utcnow()
-                }
+                now = asyncio.get_running_loop().time()
+                typing = typing_users[chat_id].get(uid)
+                if typing is not None:
+                    # Ya estaba escribiendo: se prolonga la caducidad sin tocar el heap
+                    typing["expires_at"] = now + TYPING_TIMEOUT
+                    if now - typing["broadcast_at"] < TYPING_DEBOUNCE:
+                        # Ya se ha avisado hace poco
+                        continue
+                    typing["broadcast_at"] = now
+                    user_name = typing["name"]
+                else:
+                    # Obtener el nombre del usuario y programar su caducidad
+                    user_name = await get_user_name(uid)
+                    typing_users[chat_id][uid] = {
+                        "name": user_name,
+                        "expires_at": now + TYPING_TIMEOUT,
+                        "broadcast_at": now
+                    }
+                    schedule_typing_expiry(chat_id, uid, now + TYPING_TIMEOUT)
                 await broadcast(chat_id, {
                     "event": "typing", 
                     "user_uid": uid, 
@@ -94,10 +285,24 @@ async def websocket_chat(websocket: WebSocket, chat_id: str, uid: str = Depends(
                         "typing": False
                     }, exclude_uid=uid)
             elif event == "read":
-                await mark_chat_as_read(chat_id, uid)
+                try:
+                    await mark_chat_as_read(chat_id, uid)
+                except Exception:
+                    logger.exception(f"Error marcando como leído el chat {chat_id}")
+                    connection.send(json.dumps({"event": "error", "detail": "No se pudo marcar el chat como leído"}))
+                    continue
                 await broadcast(chat_id, {"event": "read", "user": uid, "chat_id": chat_id})
     except WebSocketDisconnect:
-        active_connections[chat_id].remove(websocket)
+        pass
+    except Exception:
+        # Al expulsar la conexión el socket se cierra y la recepción falla: es lo esperado
+        if not connection.closed:
+            logger.exception(f"Error en el WebSocket del chat {chat_id}")
+            await connection.evict(1011)
+    finally:
+        connection.closed = True
+        connection.writer.cancel()
+        remove_connection(connection)
         # Limpiar typing del usuario desconectado
         if uid in typing_users[chat_id]:
             user_name = typing_users[chat_id][uid]["name"]
@@ -108,42 +313,53 @@ async def websocket_chat(websocket: WebSocket, chat_id: str, uid: str = Depends(
                 "user_name": user_name, 
                 "typing": False
             })
-        if not active_connections[chat_id]:
-            del active_connections[chat_id]
-            if chat_id in typing_users:
-                del typing_users[chat_id]
-
-# Función para limpiar usuarios que han dejado de escribir (timeout de 3 segundos)
-async def cleanup_typing_users():
-    while True:
-        current_time = datetime.datetime.utcnow()
-        for chat_id in list(typing_users.keys()):
-            for uid in list(typing_users[chat_id].keys()):
-                user_data = typing_users[chat_id][uid]
-                time_diff = current_time - user_data["timestamp"]
-                if time_diff.total_seconds() > 3:  # Timeout de 3 segundos
-                    user_name = user_data["name"]
-                    del typing_users[chat_id][uid]
-                    await broadcast(chat_id, {
-                        "event": "typing", 
-                        "user_uid": uid, 
-                        "user_name": user_name, 
-                        "typing": False
-                    })
-        await asyncio.sleep(1)  # Revisar cada segundo
+        await release_chat(chat_id)
 
-# Variable para la tarea de limpieza
-cleanup_task = None
+# Caducidades de typing ordenadas: (expires_at, chat_id, uid). Cada usuario que escribe
+# tiene una entrada; si ha seguido escribiendo, al llegar su turno se reprograma con la
+# caducidad actualizada, así el trabajo es proporcional a las caducidades y no a los chats.
+typing_expirations: List[tuple] = []
+typing_wakeup = asyncio.Event()
+expiry_task = None
 
-def start_cleanup_task():
-    global cleanup_task
-    if cleanup_task is None:
-        try:
-            loop = asyncio.get_running_loop()
-            cleanup_task = loop.create_task(cleanup_typing_users())
-        except RuntimeError:
-            # No hay un loop corriendo, se iniciará cuando se use FastAPI
-            pass
+def schedule_typing_expiry(chat_id: str, uid: str, expires_at: float):
+    global expiry_task
+    heapq.heappush(typing_expirations, (expires_at, chat_id, uid))
+    if expiry_task is None or expiry_task.done():
+        expiry_task = asyncio.get_running_loop().create_task(expire_typing_users())
+    elif typing_expirations[0][0] == expires_at:
+        # Nueva caducidad más próxima: despertar a la tarea para que ajuste la espera
+        typing_wakeup.set()
 
-# Iniciar la tarea cuando se importe en el contexto de FastAPI
-start_cleanup_task()
\ No newline at end of file
+async def expire_typing_users():
+    loop = asyncio.get_running_loop()
+    while typing_expirations:
+        expires_at, chat_id, uid = typing_expirations[0]
+        delay = expires_at - loop.time()
+        if delay > 0:
+            typing_wakeup.clear()
+            try:
+                await asyncio.wait_for(typing_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        heapq.heappop(typing_expirations)
+        typing = typing_users.get(chat_id, {}).get(uid)
+        if typing is None:
+            # Ya envió stop_typing o se desconectó
+            continue
+        if typing["expires_at"] > expires_at:
+            heapq.heappush(typing_expirations, (typing["expires_at"], chat_id, uid))
+            continue
+        del typing_users[chat_id][uid]
+        if not typing_users[chat_id]:
+            del typing_users[chat_id]
+        try:
+            await broadcast(chat_id, {
+                "event": "typing", 
+                "user_uid": uid, 
+                "user_name": typing["name"], 
+                "typing": False
+            })
+        except Exception as e:
+            print("Error notificando fin de typing:", e)
@@ -29,6 +29,7 @@ const VirtualAssistant = () => {
   const [loadingChats, setLoadingChats] = useState(false);
   const [showDeleteModal, setShowDeleteModal] = useState(false);
   const [chatIdToDelete, setChatIdToDelete] = useState(null);
+  const [olderMessagesCursor, setOlderMessagesCursor] = useState(null);
   const inputRef = useRef(null);
 
   // Control de visibilidad durante la carga y actualización de la ruta
@@ -182,6 +183,7 @@ const VirtualAssistant = () => {
     try {
       // Limpiar el chat seleccionado anterior
       setSelectedChatId(null);
+      setOlderMessagesCursor(null);
       const newChat = await chatManager.createChat(null, [
         {
           role: 'assistant',
@@ -231,13 +233,15 @@ const VirtualAssistant = () => {
 
   const handleSelectChat = async (chatId) => {
     try {
-      const data = await chatManager.getChat(chatId);
+      // Solo la página más reciente; las anteriores se cargan bajo demanda
+      const { messages: page, nextCursor } = await chatManager.getChatMessages(chatId);
       // Mapear mensajes: convertir 'role' a 'type'
-      const mappedMessages = (data.messages || []).map(m => ({
+      const mappedMessages = page.map(m => ({
         type: m.role,
         content: m.content
       }));
       setMessages(mappedMessages);
+      setOlderMessagesCursor(nextCursor);
       setSelectedChatId(chatId);
       setView('chat');
     } catch (error) {
@@ -247,6 +251,19 @@ const VirtualAssistant = () => {
     }
   };
 
+  const handleLoadOlderMessages = async () => {
+    if (!selectedChatId || !olderMessagesCursor) return;
+    try {
+      const { messages: page, nextCursor } = await chatManager.getChatMessages(selectedChatId, olderMessagesCursor);
+      setMessages(prev => [...page.map(m => ({ type: m.role, content: m.content })), ...prev]);
+      setOlderMessagesCursor(nextCursor);
+    } catch (error) {
+      setToastMessage('No se pudieron cargar los mensajes anteriores.');
+      setToastType('error');
+      setShowToast(true);
+    }
+  };
+
   const handleDeleteChat = (chatId) => {
     setChatIdToDelete(chatId);
     setShowDeleteModal(true);
@@ -265,6 +282,7 @@ const VirtualAssistant = () => {
           }
         ]);
         setSelectedChatId(null);
+        setOlderMessagesCursor(null);
       }
       setToastMessage('Chat borrado correctamente.');
       setToastType('success');
@@ -482,6 +500,16 @@ const VirtualAssistant = () => {
                 aria-label="Conversación con el asistente virtual"
                 aria-live="polite"
               >
+                {olderMessagesCursor && (
+                  <div className="flex justify-center">
+                    <button
+                      onClick={handleLoadOlderMessages}
+                      className="text-xs text-purple-600 hover:text-purple-800 font-semibold"
+                    >
+                      Cargar mensajes anteriores
+                    </button>
+                  </div>
+                )}
                 {messages.map((message, index) => (
                   <div
                     key={index}
@@ -0,0 +1,19 @@
+import React from 'react';
+
+// Botón para pedir la siguiente página de un listado del panel (X-Next-Cursor)
+const AdminLoadMore = ({ cursor, loading, onLoadMore }) => {
+  if (!cursor) return null;
+  return (
+    <div className="flex justify-center py-4">
+      <button
+        onClick={onLoadMore}
+        disabled={loading}
+        className="px-4 py-2 text-sm font-semibold text-purple-600 hover:text-purple-800 dark:text-purple-400 dark:hover:text-purple-300 disabled:opacity-50"
+      >
+        {loading ? 'Cargando...' : 'Cargar más'}
+      </button>
+    </div>
+  );
+};
+
+export default AdminLoadMore;
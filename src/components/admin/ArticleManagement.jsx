@@ -6,6 +6,7 @@ import ReactDOM from 'react-dom';
 import { apiManager } from '../../utils/apiManager';
 import { authManager } from '../../utils/authManager';
 import { showAdminToast } from './AdminToast';
+import AdminLoadMore from './AdminLoadMore';
 
 const ArticleManagement = () => {
   const [articles, setArticles] = useState([]);
@@ -18,14 +19,18 @@ const ArticleManagement = () => {
   const [showAdd, setShowAdd] = useState(false);
   const [editArticle, setEditArticle] = useState(null);
   const [detalleArticulo, setDetalleArticulo] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     fetchArticles();
   }, []);
-  const fetchArticles = async () => {
+  const fetchArticles = async (cursor = null) => {
+    if (cursor) setLoadingMore(true);
     try {
-      const data = await apiManager.get('/admin/articles');
-      setArticles(data);
+      const { items, nextCursor: siguiente } = await apiManager.getPage('/admin/articles', cursor);
+      setArticles(prev => cursor ? [...prev, ...items] : items);
+      setNextCursor(siguiente);
     } catch (err) {
       console.error('Error fetching articles:', err);
       let userFriendlyMessage = 'Error al cargar los artículos. Por favor, intenta de nuevo.';
@@ -43,6 +48,7 @@ const ArticleManagement = () => {
       setError(userFriendlyMessage);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
   const handleDeleteArticle = (article) => {
@@ -375,6 +381,7 @@ const ArticleManagement = () => {
             ))}
           </tbody>
         </table>
+        <AdminLoadMore cursor={nextCursor} loading={loadingMore} onLoadMore={() => fetchArticles(nextCursor)} />
       </div>      <AdminDeleteModal
         isOpen={!!deleteArticle}
         onClose={() => setDeleteArticle(null)}
@@ -6,6 +6,7 @@ import LoadingSpinner from '../LoadingSpinner';
 import ReactDOM from 'react-dom';
 import { apiManager } from '../../utils/apiManager';
 import { showAdminToast } from './AdminToast';
+import AdminLoadMore from './AdminLoadMore';
 
 const columns = [
   { key: 'fecha', label: 'FECHA' },
@@ -92,32 +93,42 @@ const CompraManagement = () => {
   const [usuarios, setUsuarios] = useState([]);
   const [showNuevoDetalle, setShowNuevoDetalle] = useState(false);
   const [compraDetalle, setCompraDetalle] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     fetchCompras();
-    fetchUsuarios();
   }, []);
 
-  const fetchCompras = async () => {
-    setLoading(true);
-    setError(null);
+  const fetchCompras = async (cursor = null) => {
+    if (cursor) {
+      setLoadingMore(true);
+    } else {
+      setLoading(true);
+      setError(null);
+    }
     try {
-      const data = await apiManager.get('/admin/compras');
-      setCompras(data);
+      const { items, nextCursor: siguiente } = await apiManager.getPage('/admin/compras', cursor);
+      setCompras(prev => cursor ? [...prev, ...items] : items);
+      setNextCursor(siguiente);
+      fetchUsuarios(items);
     } catch (err) {
       setError(err.message);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
-  const fetchUsuarios = async () => {
-    try {
-      const data = await apiManager.get('/admin/users');
-      setUsuarios(data);
-    } catch (err) {
-      // No bloquea la vista de compras si falla
-    }
+  // Solo se piden los compradores de la página cargada que aún no se conocen
+  const fetchUsuarios = async (nuevasCompras) => {
+    const conocidos = new Set(usuarios.map(u => u.uid || u.id));
+    const uids = [...new Set(nuevasCompras.map(c => c.uid).filter(uid => uid && !conocidos.has(uid)))];
+    if (uids.length === 0) return;
+    // No bloquea la vista de compras si falla algún usuario
+    const resultados = await Promise.allSettled(uids.map(uid => apiManager.get(`/usuarios/uid/${uid}`)));
+    const nuevos = resultados.filter(r => r.status === 'fulfilled').map(r => r.value);
+    setUsuarios(prev => [...prev, ...nuevos]);
   };
   const handleDelete = async () => {
     if (!compraToDelete) return;
@@ -125,7 +136,7 @@ const CompraManagement = () => {
       await apiManager.delete(`/admin/compras/${compraToDelete.id}`);
       setShowDelete(false);
       setCompraToDelete(null);
-      fetchCompras();
+      setCompras(prev => prev.filter(c => c.id !== compraToDelete.id));
       showAdminToast(`Compra #${compraToDelete.id} eliminada correctamente`, 'success');
     } catch (err) {
       showAdminToast('Error al eliminar compra: ' + err.message, 'error');
@@ -292,6 +303,7 @@ const CompraManagement = () => {
                 )}
               </tbody>
             </table>
+            <AdminLoadMore cursor={nextCursor} loading={loadingMore} onLoadMore={() => fetchCompras(nextCursor)} />
           </div>
         )}
         {/* Modal detalle */}
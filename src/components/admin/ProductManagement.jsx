@@ -6,6 +6,7 @@ import ReactDOM from 'react-dom';
 import { authManager } from '../../utils/authManager';
 import { apiManager } from '../../utils/apiManager';
 import { showAdminToast } from './AdminToast';
+import AdminLoadMore from './AdminLoadMore';
 
 const ProductManagement = () => {
   const [products, setProducts] = useState([]);
@@ -18,13 +19,17 @@ const ProductManagement = () => {
   const [editProduct, setEditProduct] = useState(null);
   const [deleteProduct, setDeleteProduct] = useState(null);
   const [detalleProducto, setDetalleProducto] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     fetchProducts();
-  }, []);  const fetchProducts = async () => {
+  }, []);  const fetchProducts = async (cursor = null) => {
+    if (cursor) setLoadingMore(true);
     try {
-      const data = await apiManager.get('/admin/products');
-      setProducts(data);
+      const { items, nextCursor: siguiente } = await apiManager.getPage('/admin/products', cursor);
+      setProducts(prev => cursor ? [...prev, ...items] : items);
+      setNextCursor(siguiente);
     } catch (err) {
       let userFriendlyMessage = 'Error al cargar los productos. Por favor, intenta de nuevo.';
       
@@ -41,6 +46,7 @@ const ProductManagement = () => {
       setError(userFriendlyMessage);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
@@ -394,6 +400,7 @@ const ProductManagement = () => {
             ))}
           </tbody>
         </table>
+        <AdminLoadMore cursor={nextCursor} loading={loadingMore} onLoadMore={() => fetchProducts(nextCursor)} />
       </div>
 
       <ProductFormModal
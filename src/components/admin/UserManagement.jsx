@@ -8,6 +8,7 @@ import PasswordRequirements from '../PasswordRequirements';
 import { apiManager } from '../../utils/apiManager';
 import { authManager } from '../../utils/authManager';
 import { showAdminToast } from './AdminToast';
+import AdminLoadMore from './AdminLoadMore';
 
 const UserFormModal = ({ isOpen, onClose, onSubmit, initialData, mode }) => {
   const [form, setForm] = React.useState({
@@ -201,14 +202,18 @@ const UserManagement = () => {
   const [sortBy, setSortBy] = useState('');
   const [sortOrder, setSortOrder] = useState(null);
   const [detalleUsuario, setDetalleUsuario] = useState(null);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     fetchUsers();
   }, []);
-  const fetchUsers = async () => {
+  const fetchUsers = async (cursor = null) => {
+    if (cursor) setLoadingMore(true);
     try {
-      const data = await apiManager.get('/admin/users');
-      setUsers(data);
+      const { items, nextCursor: siguiente } = await apiManager.getPage('/admin/users', cursor);
+      setUsers(prev => cursor ? [...prev, ...items] : items);
+      setNextCursor(siguiente);
     } catch (err) {
       console.error('Error fetching users:', err);
       let userFriendlyMessage = 'Error al cargar los usuarios. Por favor, intenta de nuevo.';
@@ -226,6 +231,7 @@ const UserManagement = () => {
       setError(userFriendlyMessage);
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };  const handleDeleteUser = (user) => {
     // Obtener el usuario actual (admin logueado)
@@ -530,6 +536,7 @@ const UserManagement = () => {
             ))}
           </tbody>
         </table>
+        <AdminLoadMore cursor={nextCursor} loading={loadingMore} onLoadMore={() => fetchUsers(nextCursor)} />
       </div>
       {/* Modales */}      <AdminDeleteModal
         isOpen={!!deleteUser}
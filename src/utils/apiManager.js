@@ -38,6 +38,20 @@ class ApiManager {
     });
     return this.handleResponse(response);
   }
+  // Listados paginados: devuelve la página y el cursor de la siguiente (null si no hay más)
+  async getPage(endpoint, cursor = null) {
+    const url = cursor
+      ? `${endpoint}${endpoint.includes('?') ? '&' : '?'}start_after=${encodeURIComponent(cursor)}`
+      : endpoint;
+    const headers = await this.getHeaders();
+    const response = await fetch(`${this.baseUrl}${url}`, {
+      method: 'GET',
+      headers,
+      credentials: 'include',
+    });
+    const items = await this.handleResponse(response);
+    return { items, nextCursor: response.headers.get('X-Next-Cursor') };
+  }
   async post(endpoint, data) {
     let options = {
       method: 'POST',
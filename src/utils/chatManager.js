@@ -100,6 +100,23 @@ class ChatManager {
     return this.handleResponse(response);
   }
 
+  // Obtener una página de mensajes de un chat (los más recientes si no hay cursor)
+  async getChatMessages(chatId, before = null, limit = 50) {
+    if (!authManager.isAuthenticated()) {
+      throw new Error('Debes iniciar sesión para ver el chat');
+    }
+    const headers = await this.getHeaders();
+    const params = new URLSearchParams({ limit });
+    if (before) {
+      params.append('before', before);
+    }
+    const response = await fetch(`${this.baseUrl}/chats/${chatId}/messages?${params}`, {
+      headers
+    });
+    const messages = await this.handleResponse(response);
+    return { messages, nextCursor: response.headers.get('X-Next-Cursor') };
+  }
+
   // Añadir mensaje a un chat
   async addMessage(chatId, message) {
     if (!authManager.isAuthenticated()) {
@@ -1,6 +1,11 @@
 // Gestor de WebSocket para chats directos
 // Permite conectar, enviar mensajes, emitir eventos y recibir mensajes/eventos en tiempo real
 
+// Cierres definitivos: 4403 sin acceso al chat, 4404 chat inexistente, 1008 token no válido
+const NO_RECONNECT_CODES = [4403, 4404, 1008];
+const RECONNECT_BASE_DELAY = 2000;
+const RECONNECT_MAX_DELAY = 30000;
+
 class WSChatManager {
   constructor() {
     this.ws = null;
@@ -9,6 +14,7 @@ class WSChatManager {
     this.token = null;
     this.isConnected = false;
     this.reconnectTimeout = null;
+    this.reconnectAttempts = 0;
   }  connect({ chatId, token }) {
     if (this.ws) {
       this.disconnect();
@@ -16,8 +22,10 @@ class WSChatManager {
     this.chatId = chatId;
     this.token = token;
     const wsUrl = `ws://localhost:8000/ws/direct-chats/${chatId}`;
-    this.ws = new WebSocket(wsUrl);    this.ws.onopen = () => {
+    const ws = new WebSocket(wsUrl);
+    this.ws = ws;    this.ws.onopen = () => {
       this.isConnected = true;
+      this.reconnectAttempts = 0;
       // Enviar token de autenticación como primer mensaje
       this.ws.send(JSON.stringify({ event: 'auth', token }));
       this.emit('open');
@@ -30,14 +38,23 @@ class WSChatManager {
       } catch (e) {
         console.error('Error parsing WebSocket message:', e);
       }
-    };this.ws.onclose = () => {
+    };this.ws.onclose = (event) => {
+      // Cierre de una conexión anterior (disconnect o cambio de chat): no reconectar
+      if (this.ws !== ws) return;
+      this.ws = null;
       this.isConnected = false;
-      this.emit('close');
-      // Intentar reconectar automáticamente
+      this.emit('close', event);
+      // Sin permiso, chat inexistente o token rechazado: reconectar no lo arregla
+      if (NO_RECONNECT_CODES.includes(event.code)) return;
+      // Resto de cierres (1011 error del servidor, 1013 cliente lento, red...): reintentar
+      // con espera exponencial para no saturar un servidor que ya va cargado
       if (this.chatId && this.token) {
+        const delay = Math.min(RECONNECT_BASE_DELAY * 2 ** this.reconnectAttempts, RECONNECT_MAX_DELAY);
+        this.reconnectAttempts += 1;
         this.reconnectTimeout = setTimeout(() => {
+          this.reconnectTimeout = null;
           this.connect({ chatId: this.chatId, token: this.token });
-        }, 2000);
+        }, delay);
       }
     };    this.ws.onerror = (e) => {
       this.emit('error', e);
@@ -45,14 +62,16 @@ class WSChatManager {
   }
 
   disconnect() {
+    if (this.reconnectTimeout) {
+      clearTimeout(this.reconnectTimeout);
+      this.reconnectTimeout = null;
+    }
+    this.reconnectAttempts = 0;
     if (this.ws) {
-      this.ws.close();
+      const ws = this.ws;
       this.ws = null;
       this.isConnected = false;
-      if (this.reconnectTimeout) {
-        clearTimeout(this.reconnectTimeout);
-        this.reconnectTimeout = null;
-      }
+      ws.close();
     }
   }
 